@@ -0,0 +1,352 @@
+# benchmark.py
+"""
+Load generator and benchmark suite for the CIDN server.
+
+    python benchmark.py                                  # in-process, through ASGI
+    python benchmark.py --url http://127.0.0.1:8000      # a running uvicorn
+    python benchmark.py --rate 2000 --duration 20 --mix benign=0.8,scan=0.1,packet_drop=0.1
+    python benchmark.py --output bench.json --baseline last.json --tolerance 0.15
+
+Phases:
+  load    registers --devices devices, then sends alerts for --duration
+          seconds. With --rate it is open loop: arrivals are scheduled at a
+          fixed rate and latency is measured from the scheduled time, so a
+          stalled server shows up as latency rather than as a slower client.
+          Without --rate, --concurrency clients send back to back.
+  memory  process RSS growth over the run divided by the blocks written,
+          scaled to 1M blocks (in-process, or with --pid for a remote server)
+  chain   is_chain_valid time (full and incremental) for each --chain-sizes
+          ledger size, on a fresh segmented store
+
+The in-process server runs with the ingest guard (per-device rate limits,
+coalescing, admission control) off, so every alert takes the full CIDN
+path; --guard keeps it on. Alerts absorbed by the coalescer are reported
+as "coalesced" under alert_status (with --wait). A remote server runs
+with whatever guard settings it was started with.
+
+The report is JSON (stdout or --output). With --baseline the run fails
+(exit 1) if throughput drops or p99 latency grows by more than --tolerance,
+or if the baseline was taken with a different --guard setting.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import httpx
+
+try:
+    import psutil
+except ImportError:  # memory figures are skipped without it
+    psutil = None
+
+DEFAULT_MIX = "benign=0.9,scan=0.05,packet_drop=0.05"
+ALERT_METRICS = {
+    "benign": {"packets_sent": 120, "packets_failed": 1},
+    "scan": {"scan_count": 40},
+    "packet_drop": {"packets_sent": 100, "packets_failed": 80},
+}
+
+
+# ---- helpers ----
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+
+def rss(pid=None):
+    if psutil is None:
+        return None
+    return psutil.Process(pid or os.getpid()).memory_info().rss
+
+
+async def scrape(client, name):
+    """Value of an unlabelled gauge on /metrics (first series for labelled ones)."""
+    resp = await client.get("/metrics")
+    for line in resp.text.splitlines():
+        if line.startswith(name + " ") or line.startswith(name + "{"):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+async def drain(client, timeout=120.0):
+    """Wait until queued alerts have been processed and their last batch written."""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if not await scrape(client, "cidn_ingest_queue_depth"):
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)  # the block builder's latency bound
+    return time.perf_counter() - start
+
+
+# ---- targets ----
+class InProcessTarget:
+    """cidn_server.app on a throwaway ledger and CA, driven through httpx's ASGI transport."""
+
+    def __init__(self, guard=False):
+        self.workdir = tempfile.mkdtemp(prefix="cidn-bench-")
+        self.cwd = os.getcwd()
+        self.guard = guard
+
+    async def __aenter__(self):
+        os.environ["CIDN_LEDGER_DIR"] = os.path.join(self.workdir, "ledger")
+        os.environ["CIDN_CA_FILE"] = os.path.join(self.workdir, "certs.json")
+        os.environ.setdefault("CIDN_LOG_LEVEL", "WARNING")
+        if not self.guard:
+            # measure the CIDN path, not the rate limiter and coalescer in front of it
+            for name in ("CIDN_DEVICE_RATE", "CIDN_COALESCE_WINDOW", "CIDN_ADMISSION_RATE"):
+                os.environ[name] = "0"
+        os.chdir(self.workdir)  # no ledger.json here, so the ledger starts empty
+        sys.path.insert(0, self.cwd)
+        import cidn_server
+        self.app = cidn_server.app
+        self.lifespan = self.app.router.lifespan_context(self.app)  # runs the startup/shutdown handlers
+        await self.lifespan.__aenter__()
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=self.app),
+                                        base_url="http://cidn", timeout=60)
+        return self.client
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+        await self.lifespan.__aexit__(*exc)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class RemoteTarget:
+    def __init__(self, url, concurrency):
+        self.url = url
+        self.limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(base_url=self.url, limits=self.limits, timeout=60)
+        return self.client
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+
+# ---- load phase ----
+async def register(client, devices):
+    names = [f"bench-{i}" for i in range(devices)]
+    for i in range(0, devices, 5000):
+        resp = await client.post("/register/batch",
+                                 json={"devices": [{"device_id": d} for d in names[i:i + 5000]]})
+        resp.raise_for_status()
+    return names
+
+
+async def run_load(client, args, names):
+    mix = parse_mix(args.mix)
+    types, weights = list(mix), list(mix.values())
+    rng = random.Random(args.seed)
+    params = {"wait": "true"} if args.wait else {}
+
+    def make_request():
+        alerts = [{"device_id": rng.choice(names), "type": t, "metrics": ALERT_METRICS.get(t, {})}
+                  for t in rng.choices(types, weights, k=args.batch)]
+        if args.batch == 1:
+            return "/alert", alerts[0]
+        return "/alerts/batch", alerts
+
+    latencies = []
+    codes = {}
+    statuses = {}
+
+    async def send(path, body, scheduled):
+        try:
+            resp = await client.post(path, json=body, params=params)
+            code = resp.status_code
+            if code == 200 and args.wait:
+                payload = resp.json()
+                for status in payload.get("results", [payload.get("status")]):
+                    statuses[status] = statuses.get(status, 0) + 1
+        except httpx.HTTPError as e:
+            code = type(e).__name__
+        latencies.append(time.perf_counter() - scheduled)
+        codes[code] = codes.get(code, 0) + 1
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    if args.rate:
+        # open loop: the i-th request is due at start + i / rate, whatever happened before it
+        in_flight = asyncio.Semaphore(args.max_in_flight)
+        tasks = set()
+        i = 0
+        while True:
+            due = start + i / args.rate
+            if due >= deadline:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await in_flight.acquire()
+            path, body = make_request()
+            task = asyncio.create_task(send(path, body, due))
+            task.add_done_callback(lambda _: in_flight.release())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            i += 1
+        await asyncio.gather(*tasks)
+    else:
+        async def client_loop():
+            while time.perf_counter() < deadline:
+                path, body = make_request()
+                await send(path, body, time.perf_counter())
+        await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "alerts": len(latencies) * args.batch,
+        "elapsed_s": elapsed,
+        "requests_per_s": len(latencies) / elapsed,
+        "alerts_per_s": len(latencies) * args.batch / elapsed,
+        "latency_ms": {name: percentile(latencies, q) * 1000 if latencies else None
+                       for name, q in (("p50", 50), ("p99", 99), ("p999", 99.9))},
+        "max_latency_ms": latencies[-1] * 1000 if latencies else None,
+        "http_status": {str(k): v for k, v in codes.items()},
+        "alert_status": statuses,
+    }
+
+
+# ---- chain validation phase ----
+def chain_validation(sizes, events_per_block):
+    from blockchain import Blockchain
+    from ledger_store import SegmentedLedgerStore
+
+    results = []
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix="cidn-bench-chain-")
+        try:
+            chain = Blockchain(store=SegmentedLedgerStore(directory, fsync_every=0, fsync_interval=None),
+                               checkpoint_file=os.path.join(directory, "checkpoint.json"))
+            event = {"event": "benign_alert", "device_id": "bench-0", "trust": 0.5}
+            data = {"event": "batch", "count": events_per_block, "events": [event] * events_per_block}
+            build = time.perf_counter()
+            while len(chain.chain) < size:
+                chain.add_block(data)
+            build = time.perf_counter() - build
+            t = time.perf_counter()
+            valid = chain.is_chain_valid(full=True)
+            full = time.perf_counter() - t
+            chain.add_block(data)
+            t = time.perf_counter()
+            chain.is_chain_valid()
+            incremental = time.perf_counter() - t
+            results.append({"blocks": size, "valid": valid, "build_s": build,
+                            "full_validate_s": full, "incremental_validate_s": incremental,
+                            "bytes": chain.chain.nbytes()})
+            chain.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+# ---- regression gate ----
+def compare(report, baseline, tolerance):
+    failures = []
+    guard, baseline_guard = report["config"].get("guard", False), baseline["config"].get("guard", False)
+    if guard != baseline_guard:
+        failures.append(f"--guard is {guard} but the baseline was taken with {baseline_guard}")
+    new, old = report["load"], baseline["load"]
+    if new["alerts_per_s"] < old["alerts_per_s"] * (1 - tolerance):
+        failures.append(f"throughput {new['alerts_per_s']:.0f}/s < baseline {old['alerts_per_s']:.0f}/s")
+    p99_new, p99_old = new["latency_ms"]["p99"], old["latency_ms"]["p99"]
+    if p99_new is not None and p99_old is not None and p99_new > p99_old * (1 + tolerance):
+        failures.append(f"p99 {p99_new:.2f}ms > baseline {p99_old:.2f}ms")
+    return failures
+
+
+async def run(args):
+    target = RemoteTarget(args.url, args.concurrency) if args.url else InProcessTarget(args.guard)
+    pid = args.pid if args.url else None
+    async with target as client:
+        names = await register(client, args.devices)
+        height_before = await scrape(client, "cidn_ledger_height")
+        rss_before = rss(pid) if (pid or not args.url) else None
+        load = await run_load(client, args, names)
+        load["drain_s"] = await drain(client)
+        load["processed_alerts_per_s"] = load["alerts"] / (load["elapsed_s"] + load["drain_s"])
+        height_after = await scrape(client, "cidn_ledger_height")
+        rss_after = rss(pid) if rss_before is not None else None
+
+    memory = {"rss_before": rss_before, "rss_after": rss_after,
+              "blocks_written": None, "bytes_per_1m_blocks": None}
+    if height_before is not None and height_after is not None:
+        memory["blocks_written"] = int(height_after - height_before)
+        if rss_before is not None and memory["blocks_written"]:
+            memory["bytes_per_1m_blocks"] = (rss_after - rss_before) / memory["blocks_written"] * 1_000_000
+            memory["bytes_per_1m_alerts"] = (rss_after - rss_before) / load["alerts"] * 1_000_000
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "load": load,
+        "memory": memory,
+        "chain": chain_validation(args.chain_sizes, args.events_per_block) if args.chain_sizes else [],
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CIDN server benchmark")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--pid", type=int, help="server PID for memory figures with --url")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="alert type weights, e.g. benign=0.8,scan=0.2")
+    parser.add_argument("--batch", type=int, default=1, help="alerts per request (>1 uses /alerts/batch)")
+    parser.add_argument("--wait", action="store_true", help="wait for each alert to be committed")
+    parser.add_argument("--guard", action="store_true",
+                        help="keep the ingest guard (rate limits, coalescing) on in-process")
+    parser.add_argument("--rate", type=float, default=0, help="open-loop requests/s (0: closed loop)")
+    parser.add_argument("--concurrency", type=int, default=32, help="closed-loop clients")
+    parser.add_argument("--max-in-flight", type=int, default=10000, help="open-loop cap on pending requests")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--chain-sizes", type=lambda s: [int(x) for x in s.split(",") if x],
+                        default=[1000, 10000, 100000], help="ledger sizes for the validation phase")
+    parser.add_argument("--events-per-block", type=int, default=10)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    # server logs go to stderr so stdout carries only the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(report, json.load(f), args.tolerance)
+        for failure in failures:
+            print(f"[Benchmark] ❌ {failure}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+        print("[Benchmark] ✅ within tolerance of baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# block_builder.py
+import hashlib
+import json
+import threading
+import time
+
+# ---- Merkle tree ----
+# Leaves and inner nodes are domain-separated (0x00 / 0x01 prefixes) so a leaf
+# can never be passed off as an inner node. An odd node at the end of a level
+# is promoted unchanged rather than paired with a copy of itself.
+
+
+def leaf_hash(event):
+    payload = json.dumps(event, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(b"\x00" + payload).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+def merkle_levels(leaves):
+    """All levels of the tree, leaves first, root level last."""
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parent = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parent.append(level[-1])
+        levels.append(parent)
+    return levels
+
+
+def merkle_root(events):
+    if not events:
+        return hashlib.sha256(b"").hexdigest()
+    return merkle_levels([leaf_hash(e) for e in events])[-1][0].hex()
+
+
+def merkle_proof(levels, leaf_index):
+    """Sibling path for a leaf as [[sibling_hex, "left"|"right"], ...]."""
+    proof = []
+    i = leaf_index
+    for level in levels[:-1]:
+        sibling = i ^ 1
+        if sibling < len(level):
+            proof.append([level[sibling].hex(), "left" if sibling < i else "right"])
+        i //= 2
+    return proof
+
+
+def verify_proof(event, proof, root):
+    h = leaf_hash(event)
+    for sibling_hex, side in proof:
+        sibling = bytes.fromhex(sibling_hex)
+        h = node_hash(sibling, h) if side == "left" else node_hash(h, sibling)
+    return h.hex() == root
+
+
+def batch_block_data(events, levels=None):
+    """Block data for a batch of events, with the Merkle root over them."""
+    if levels is None:
+        levels = merkle_levels([leaf_hash(e) for e in events])
+    return {
+        "event": "batch",
+        "count": len(events),
+        "merkle_root": levels[-1][0].hex() if events else merkle_root(events),
+        "events": events,
+    }
+
+
+def iter_events(data):
+    """Events recorded in a block's data, whether it is a batch or a single event."""
+    if data.get("event") == "batch":
+        return data.get("events", [])
+    return [data]
+
+
+def inclusion_proof(chain, block_index, leaf_index):
+    """Rebuild the inclusion proof for one event of a batch block already on the chain."""
+    block = chain[block_index]
+    events = iter_events(block.data)
+    if block.data.get("event") != "batch" or not 0 <= leaf_index < len(events):
+        return None
+    levels = merkle_levels([leaf_hash(e) for e in events])
+    return {
+        "block_index": block_index,
+        "leaf_index": leaf_index,
+        "event": events[leaf_index],
+        "merkle_root": block.data["merkle_root"],
+        "proof": merkle_proof(levels, leaf_index),
+    }
+
+
+# ---- Block builder ----
+class Receipt:
+    """Filled in once the event's batch has been written to the chain."""
+
+    def __init__(self, event):
+        self.event = event
+        self.block_index = None
+        self.leaf_index = None
+        self.merkle_root = None
+        self.proof = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "block_index": self.block_index,
+            "leaf_index": self.leaf_index,
+            "merkle_root": self.merkle_root,
+            "proof": self.proof,
+        }
+
+
+class BlockBuilder:
+    """
+    Collects ledger events and writes them as one block per batch, with a
+    Merkle root over the batch. A batch is closed when it reaches `max_events`
+    or when its oldest event is `max_latency` seconds old.
+    """
+
+    def __init__(self, blockchain, max_events=500, max_latency=0.05):
+        self.blockchain = blockchain
+        self.max_events = max_events
+        self.max_latency = max_latency
+        self._pending = []
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="block-builder", daemon=True)
+        self._thread.start()
+
+    def append(self, event):
+        receipt = Receipt(event)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BlockBuilder is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            self._pending.append(receipt)
+            if len(self._pending) >= self.max_events:
+                self._flush_locked()
+        return receipt
+
+    def extend(self, events):
+        """Append several events under one lock acquisition."""
+        receipts = [Receipt(e) for e in events]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BlockBuilder is closed")
+            for receipt in receipts:
+                if not self._pending:
+                    self._oldest = time.monotonic()
+                    self._cond.notify()
+                self._pending.append(receipt)
+                if len(self._pending) >= self.max_events:
+                    self._flush_locked()
+        return receipts
+
+    def flush(self):
+        with self._cond:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return None
+        batch, self._pending, self._oldest = self._pending, [], None
+        events = [r.event for r in batch]
+        levels = merkle_levels([leaf_hash(e) for e in events])
+        root = levels[-1][0].hex()
+        block = self.blockchain.add_block(batch_block_data(events, levels))
+        for i, receipt in enumerate(batch):
+            receipt.block_index = block.index
+            receipt.leaf_index = i
+            receipt.merkle_root = root
+            receipt.proof = merkle_proof(levels, i)
+            receipt._done.set()
+        return block
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                if self._oldest is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._oldest + self.max_latency - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                else:
+                    self._flush_locked()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._flush_locked()
+            self._cond.notify()
+        self._thread.join()
+
+    # ---- auditing ----
+    def get_proof(self, block_index, leaf_index):
+        return inclusion_proof(self.blockchain.chain, block_index, leaf_index)
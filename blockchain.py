@@ -1,19 +1,95 @@
 # blockchain.py
 import hashlib
 import json
+import os
+import struct
+import threading
 import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import metrics
+from block_builder import merkle_levels
+
+# Hash schemes. The ledger.json dump predates compute_hash and hashed the
+# str() concatenation of the fields, so imported blocks keep their own scheme.
+HASH_LEGACY = 0
+HASH_JSON = 1
+HASH_BINARY = 2
+
+# HASH_BINARY blocks hash their canonical encoding:
+#
+#   u8 version | u64 index | f64 timestamp | 32B prev hash | u32 payload length | payload
+#
+# where payload is the data as compact JSON with sorted keys. The encoding is
+# built once; the same bytes are hashed, written by the ledger store and
+# spliced into /ledger responses, so the data is serialized only once.
+BLOCK_HEADER = struct.Struct("<BQd32sI")
+GENESIS_PREV_HASH = "0" * 64
+
+_UNSET = object()
+
+
+def canonical_payload(data):
+    return json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+
 
 class Block:
-    def __init__(self, index, timestamp, data, prev_hash):
+    __slots__ = ("index", "timestamp", "prev_hash", "version", "hash",
+                 "_data", "_encoded", "_dict", "_json")
+
+    def __init__(self, index, timestamp, data, prev_hash, hash=None, version=HASH_BINARY):
+        if version == HASH_BINARY and len(prev_hash) != 64:
+            version = HASH_JSON  # the binary header holds a raw digest; old genesis blocks link to "0"
         self.index = index
         self.timestamp = timestamp
-        self.data = data
+        self._data = data
         self.prev_hash = prev_hash
-        self.hash = self.compute_hash()
+        self.version = version
+        self._encoded = None
+        self._dict = None   # blocks never change, so their serialized forms are cached
+        self._json = None
+        self.hash = hash if hash is not None else self.compute_hash()
+
+    @property
+    def data(self):
+        if self._data is _UNSET:  # decoded lazily for blocks read back from their encoding
+            self._data = json.loads(self._encoded[BLOCK_HEADER.size:])
+        return self._data
+
+    def encoded(self):
+        """Canonical binary encoding of a HASH_BINARY block (the bytes that are hashed)."""
+        if self._encoded is None:
+            payload = canonical_payload(self._data)
+            self._encoded = BLOCK_HEADER.pack(HASH_BINARY, self.index, self.timestamp,
+                                              bytes.fromhex(self.prev_hash), len(payload)) + payload
+        return self._encoded
+
+    @classmethod
+    def from_encoded(cls, encoded, hash):
+        """Rebuild a HASH_BINARY block from encoded(); its data is parsed on first access."""
+        version, index, timestamp, prev, length = BLOCK_HEADER.unpack_from(encoded, 0)
+        if version != HASH_BINARY or len(encoded) != BLOCK_HEADER.size + length:
+            raise ValueError("Not a binary block encoding")
+        block = cls.__new__(cls)
+        block.index = index
+        block.timestamp = timestamp
+        block.prev_hash = prev.hex()
+        block.version = HASH_BINARY
+        block.hash = hash
+        block._data = _UNSET
+        block._encoded = encoded
+        block._dict = None
+        block._json = None
+        return block
 
     def compute_hash(self):
+        if self.version == HASH_BINARY:
+            return hashlib.sha256(self.encoded()).hexdigest()
+        if self.version == HASH_LEGACY:
+            block_string = (str(self.index) + str(self.timestamp) + str(self.data) + self.prev_hash).encode()
+            return hashlib.sha256(block_string).hexdigest()
         block_string = json.dumps({
             "index": self.index,
             "timestamp": self.timestamp,
@@ -22,47 +98,378 @@ class Block:
         }, sort_keys=True).encode()
         return hashlib.sha256(block_string).hexdigest()
 
-    def to_dict(self):
+    def _timestamp_str(self):
         # human-friendly timestamp
-        ts = datetime.fromtimestamp(self.timestamp).strftime("%Y-%m-%d %H:%M:%S")
-        return {
-            "index": self.index,
-            "timestamp": ts,
-            "data": self.data,
-            "prev_hash": self.prev_hash,
-            "hash": self.hash
-        }
+        return datetime.fromtimestamp(self.timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+    def to_dict(self):
+        # the returned dict is shared between callers; treat it as read-only
+        if self._dict is None:
+            self._dict = {
+                "index": self.index,
+                "timestamp": self._timestamp_str(),
+                "data": self.data,
+                "prev_hash": self.prev_hash,
+                "hash": self.hash
+            }
+        return self._dict
+
+    def to_json(self):
+        """to_dict() as compact JSON bytes, as served by /ledger."""
+        if self._json is None:
+            if self.version == HASH_BINARY:
+                # reuse the canonical payload instead of serializing the data again
+                self._json = b"".join((
+                    b'{"index":%d,"timestamp":"%s","data":' % (self.index, self._timestamp_str().encode()),
+                    self.encoded()[BLOCK_HEADER.size:],
+                    b',"prev_hash":"%s","hash":"%s"}' % (self.prev_hash.encode(), self.hash.encode()),
+                ))
+            else:
+                self._json = json.dumps(self.to_dict(), separators=(",", ":")).encode()
+        return self._json
+
+    @classmethod
+    def from_dict(cls, d):
+        """Rebuild a block from a raw ledger.json entry, keeping its original hash."""
+        block = cls(d["index"], d["timestamp"], d["data"], d["prev_hash"], hash=d["hash"], version=HASH_JSON)
+        if block.compute_hash() != block.hash:
+            block.version = HASH_LEGACY
+        return block
+
+
+def range_root(hashes):
+    """Merkle root over a run of block hashes, as recorded in archive anchors."""
+    leaves = [hashlib.sha256(b"\x00" + bytes.fromhex(h)).digest() for h in hashes]
+    return merkle_levels(leaves)[-1][0].hex()
+
+
+# ---- range verification (runs inside ProcessPoolExecutor workers) ----
+_worker_stores = {}
+
+
+def _first_invalid_in(blocks):
+    """First block in `blocks` whose hash or link (within the range) is wrong."""
+    prev = None
+    for block in blocks:
+        if block.hash != block.compute_hash():
+            return block.index
+        if prev is not None and block.prev_hash != prev.hash:
+            return block.index
+        prev = block
+    return None
+
+
+def _verify_stored_range(directory, start, end):
+    from ledger_store import SegmentedLedgerStore
+    store = _worker_stores.get(directory)
+    if store is None or len(store) < end:
+        if store is not None:
+            store.close()
+        store = _worker_stores[directory] = SegmentedLedgerStore(directory, readonly=True, cache_size=0)
+    return _first_invalid_in(store[i] for i in range(start, end))
 
 
 class Blockchain:
-    def __init__(self):
-        self.chain = []
-        self.create_genesis_block()
+    """
+    `store` is anything list-like (len, indexing, append); by default the chain
+    lives in memory. Pass a `ledger_store.SegmentedLedgerStore` to persist it
+    and to be able to archive() old blocks.
+    """
+
+    def __init__(self, store=None, import_from=None, checkpoint_file=None):
+        self.chain = store if store is not None else []
+        self.checkpoint_file = checkpoint_file
+        self.verified_height = 0  # blocks [0, verified_height) are known to be valid
+        self.listeners = []       # callables invoked with every newly added block
+        self._lock = threading.Lock()
+        if not len(self.chain):
+            if import_from and os.path.exists(import_from):
+                self.import_json(import_from)
+            else:
+                self.create_genesis_block()
+        self._load_checkpoint()
 
     def create_genesis_block(self):
-        genesis = Block(0, time.time(), {"event": "genesis"}, "0")
+        genesis = Block(0, time.time(), {"event": "genesis"}, GENESIS_PREV_HASH)
         self.chain.append(genesis)
 
     def add_block(self, data: dict):
-        prev_block = self.chain[-1]
-        new_block = Block(
-            index=len(self.chain),
-            timestamp=time.time(),
-            data=data,
-            prev_hash=prev_block.hash
-        )
-        self.chain.append(new_block)
+        # serialized so two writers can never link to the same parent
+        with self._lock:
+            prev_block = self.chain[-1]
+            with metrics.timed("hash"):
+                new_block = Block(
+                    index=len(self.chain),
+                    timestamp=time.time(),
+                    data=data,
+                    prev_hash=prev_block.hash
+                )
+            with metrics.timed("persist"):
+                self.chain.append(new_block)
+            for listener in self.listeners:
+                listener(new_block)
         return new_block
 
-    def is_chain_valid(self):
-        for i in range(1, len(self.chain)):
+    def head(self):
+        """(height, hash of the newest block), read together."""
+        with self._lock:
+            return len(self.chain), self.chain[-1].hash
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def refresh(self):
+        """
+        For a chain on a read-only store that another process appends to:
+        pick up the new blocks and pass them to the listeners.
+        """
+        with self._lock:
+            old = len(self.chain)
+            if not self.chain.refresh():
+                return 0
+            for i in range(old, len(self.chain)):
+                block = self.chain[i]
+                for listener in self.listeners:
+                    listener(block)
+            return len(self.chain) - old
+
+    def import_json(self, path):
+        """One-off import of a ledger.json dump into an empty chain."""
+        if len(self.chain):
+            raise ValueError("Can only import into an empty chain")
+        with open(path, "r") as f:
+            for d in json.load(f):
+                self.chain.append(Block.from_dict(d))
+        print(f"[Ledger] 📥 Imported {len(self.chain)} blocks from {path}")
+
+    # ---- archival ----
+    def archives(self):
+        """Meta of each archived range (see archive()), oldest first."""
+        return self.chain.archives() if hasattr(self.chain, "archives") else []
+
+    def archive(self, before):
+        """
+        Move sealed ledger segments whose newest block is older than `before`
+        into compressed archive files. Each range is checked first, then gets
+        an anchor block on the live chain recording its first/last index, the
+        hash it links to, its last hash and the Merkle root of its block
+        hashes; validation checks the range against that anchor instead of
+        decompressing it. Returns the anchors written.
+        """
+        if not hasattr(self.chain, "archivable"):
+            return []
+        anchors = []
+        for first, count in self.chain.archivable():
+            last = first + count - 1
+            if self.chain[last].timestamp >= before:
+                break  # segments are in chain order, so the rest are newer
+            bad = self.find_first_invalid(first, last + 1)
+            if bad is not None:
+                print(f"[Ledger] ⚠️ Not archiving blocks {first}-{last}: block {bad} is invalid")
+                break
+            hashes = [self.chain[i].hash for i in range(first, last + 1)]
+            anchor = {
+                "event": "ledger_archived",
+                "first_index": first,
+                "last_index": last,
+                "prev_hash": self.chain[first].prev_hash,
+                "last_hash": hashes[-1],
+                "merkle_root": range_root(hashes),
+            }
+            block = self.add_block(anchor)
+            with metrics.timed("archive"):
+                self.chain.archive(first, anchor, block.index, block.hash)
+            anchors.append(anchor)
+            print(f"[Ledger] 🗄️ Archived blocks {first}-{last}, anchored in block {block.index}")
+        return anchors
+
+    def verify_archives(self):
+        """
+        Decompress every archived range and check its blocks against its
+        anchor (hashes, links and Merkle root). Returns the first invalid
+        block index or None.
+        """
+        for meta in self.archives():
+            anchor = meta["anchor"]
+            first, last = meta["first_index"], meta["last_index"]
+            if anchor["first_index"] != first or anchor["last_index"] != last:
+                return first
+            prev_hash = anchor["prev_hash"]
+            hashes = []
+            for i in range(first, last + 1):
+                try:
+                    block = self.chain[i]
+                except (ValueError, zlib.error):  # corrupt frame
+                    return i
+                if block.hash != block.compute_hash() or block.prev_hash != prev_hash:
+                    return i
+                prev_hash = block.hash
+                hashes.append(block.hash)
+            if prev_hash != anchor["last_hash"] or range_root(hashes) != anchor["merkle_root"]:
+                return first
+        return None
+
+    def _bad_anchor(self, archives):
+        """
+        First archived range whose stored anchor disagrees with its anchor
+        block on the chain, or None. Anchors that were themselves archived
+        are covered by the Merkle root of the range holding them.
+        """
+        for meta in archives:
+            i = meta["anchor_index"]
+            if any(m["first_index"] <= i <= m["last_index"] for m in archives):
+                continue
+            if i >= len(self.chain):
+                return meta["first_index"]
+            block = self.chain[i]
+            if block.hash != meta["anchor_hash"] or block.data != meta["anchor"]:
+                return meta["first_index"]
+        return None
+
+    @staticmethod
+    def _archive_at(archives, i):
+        for meta in archives:
+            if meta["first_index"] <= i <= meta["last_index"]:
+                return meta
+        return None
+
+    def _hash_at(self, i, archives):
+        """Hash of block i, taken from an anchor when i ends an archived range."""
+        meta = self._archive_at(archives, i)
+        if meta is not None and i == meta["last_index"]:
+            return meta["anchor"]["last_hash"]
+        return self.chain[i].hash
+
+    # ---- validation ----
+    def find_first_invalid(self, start=0, end=None):
+        """
+        Index of the first block in [start, end) with a bad hash or a broken
+        link to its predecessor, or None if that range is valid. Archived
+        ranges are not decompressed: their anchor stands in for them, so only
+        the links at either end of the range are checked.
+        """
+        end = len(self.chain) if end is None else end
+        archives = self.archives()
+        k = 0  # next archived range that may hold i
+        prev_hash = None
+        i = max(start, 1)
+        while i < end:
+            while k < len(archives) and archives[k]["last_index"] < i:
+                k += 1
+            meta = archives[k] if k < len(archives) and archives[k]["first_index"] <= i else None
+            if meta is not None:
+                anchor = meta["anchor"]
+                if i == meta["first_index"]:
+                    if prev_hash is None:
+                        prev_hash = self._hash_at(i - 1, archives)
+                    if anchor["prev_hash"] != prev_hash:
+                        return i
+                prev_hash = anchor["last_hash"]
+                i = meta["last_index"] + 1
+                continue
             current = self.chain[i]
-            prev = self.chain[i - 1]
+            if prev_hash is None:
+                prev_hash = self._hash_at(i - 1, archives)
             if current.hash != current.compute_hash():
-                return False
-            if current.prev_hash != prev.hash:
-                return False
+                return i
+            if current.prev_hash != prev_hash:
+                return i
+            prev_hash = current.hash
+            i += 1
+        return None
+
+    def is_chain_valid(self, full=False):
+        """
+        Validate the chain. By default only blocks appended since the last
+        verified checkpoint are checked; `full=True` rescans from genesis.
+        Archived ranges are checked against their anchors either way; use
+        verify_archives() to check their contents.
+        """
+        end = len(self.chain)
+        start = 0 if full else self.verified_height
+        if self._bad_anchor(self.archives()) is not None:
+            return False
+        if self.find_first_invalid(start, end) is not None:
+            return False
+        self.checkpoint(end)
         return True
 
+    def verify_parallel(self, workers=None, chunk_size=None):
+        """
+        Full verification split into ranges across a process pool. Each worker
+        checks hashes and links inside its range; the links across range
+        boundaries and archived ranges (against their anchors) are checked
+        here. Returns the first invalid index or None.
+        """
+        end = len(self.chain)
+        archives = self.archives()
+        workers = workers or os.cpu_count() or 1
+        chunk_size = chunk_size or max(1024, -(-end // (workers * 4)))
+        runs, s = [], 1
+        for meta in archives:
+            if meta["first_index"] > s:
+                runs.append((s, meta["first_index"]))
+            s = max(s, meta["last_index"] + 1)
+        if s < end:
+            runs.append((s, end))
+        ranges = [(s, min(s + chunk_size, e)) for rs, e in runs for s in range(rs, e, chunk_size)]
+
+        directory = getattr(self.chain, "directory", None)
+        if directory is not None:
+            self.chain.sync()  # workers read the segment files directly
+
+        bad = []
+        first_bad_anchor = self._bad_anchor(archives)
+        if first_bad_anchor is not None:
+            bad.append(first_bad_anchor)
+        for meta in archives:
+            if meta["first_index"] > 0 and \
+                    meta["anchor"]["prev_hash"] != self._hash_at(meta["first_index"] - 1, archives):
+                bad.append(meta["first_index"])
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            if directory is not None:
+                futures = [pool.submit(_verify_stored_range, directory, s, e) for s, e in ranges]
+            else:
+                futures = [pool.submit(_first_invalid_in, self.chain[s:e]) for s, e in ranges]
+            for (s, _), fut in zip(ranges, futures):
+                first = fut.result()
+                if first is not None:
+                    bad.append(first)
+                if self.chain[s].prev_hash != self._hash_at(s - 1, archives):
+                    bad.append(s)
+
+        if bad:
+            return min(bad)
+        self.checkpoint(end)
+        return None
+
+    # ---- checkpoints ----
+    def checkpoint(self, height):
+        """Record that blocks [0, height) have been verified."""
+        if height <= self.verified_height:
+            return
+        self.verified_height = height
+        if self.checkpoint_file:
+            tmp = self.checkpoint_file + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"height": height, "hash": self.chain[height - 1].hash}, f)
+            os.replace(tmp, self.checkpoint_file)
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_file or not os.path.exists(self.checkpoint_file):
+            return
+        with open(self.checkpoint_file, "r") as f:
+            cp = json.load(f)
+        height = cp.get("height", 0)
+        # a checkpoint only counts if the chain still has the block it vouched for
+        if 0 < height <= len(self.chain) and self.chain[height - 1].hash == cp.get("hash"):
+            self.verified_height = height
+        else:
+            print(f"[Ledger] ⚠️ Ignoring stale checkpoint at height {height}")
+
     def to_list(self):
         return [block.to_dict() for block in self.chain]
+
+    def close(self):
+        if hasattr(self.chain, "close"):
+            self.chain.close()
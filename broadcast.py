@@ -0,0 +1,158 @@
+# broadcast.py
+"""
+Fan-out of server-sent events to many subscribers.
+
+    events = Broadcaster()
+    await events.start()
+    events.publish("block", {...}, id=42)     # from any thread
+    return StreamingResponse(events.stream(sub), media_type="text/event-stream")
+
+Published events are collected and flushed on the event loop: each flush
+encodes its events once into a single SSE chunk, and every subscriber's
+buffer gets a reference to that same chunk. So the work per event does not
+grow with the number of subscribers; only the sockets do.
+
+A subscriber's buffer holds at most `max_buffer` events. One that falls
+further behind (a stalled connection) has its buffer dropped and gets a
+single "resync" event instead, telling it to reload the current state;
+nobody else waits for it. close() ends every stream, e.g. so a server
+shutting down does not wait on them.
+"""
+import asyncio
+import json
+import threading
+from collections import deque
+
+RESYNC = b"event: resync\ndata: {}\n\n"
+HEARTBEAT = b": ping\n\n"
+
+
+def encode_event(event, data, id=None):
+    """One event in text/event-stream framing."""
+    head = f"id: {id}\n" if id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+class BroadcasterFull(Exception):
+    """Raised when a new subscriber would exceed max_subscribers."""
+
+
+class Subscriber:
+    def __init__(self):
+        self.chunks = deque()  # (bytes, number of events in them)
+        self.buffered = 0
+        self.wake = asyncio.Event()
+        self.resyncs = 0
+
+
+class Broadcaster:
+    def __init__(self, max_buffer=1000, max_subscribers=1000, heartbeat=15.0, retry_ms=2000):
+        self.max_buffer = max_buffer
+        self.max_subscribers = max_subscribers
+        self.heartbeat = heartbeat
+        self.retry_ms = retry_ms
+        self.subscribers = set()
+        self.published = 0
+        self.resyncs = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._loop = None
+        self.closed = False
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+
+    def __bool__(self):
+        # lets publishers skip building events nobody would receive
+        return bool(self.subscribers)
+
+    def publish(self, event, data, id=None):
+        """Queue an event for every current subscriber. Thread-safe; never blocks on them."""
+        if not self.subscribers or self._loop is None:
+            return
+        frame = encode_event(event, data, id)
+        with self._lock:
+            self._pending.append(frame)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        try:
+            self._loop.call_soon_threadsafe(self._flush)
+        except RuntimeError:  # loop closed during shutdown
+            pass
+
+    def _flush(self):
+        with self._lock:
+            frames, self._pending = self._pending, []
+            self._scheduled = False
+        if not frames:
+            return
+        chunk = b"".join(frames)
+        count = len(frames)
+        self.published += count
+        for sub in list(self.subscribers):  # /events handlers may subscribe from other threads
+            if sub.buffered + count > self.max_buffer:
+                # too far behind: what it missed is replaced by one resync
+                sub.chunks.clear()
+                sub.chunks.append((RESYNC, 1))
+                sub.buffered = 1
+                sub.resyncs += 1
+                self.resyncs += 1
+            else:
+                sub.chunks.append((chunk, count))
+                sub.buffered += count
+            sub.wake.set()
+
+    def close(self):
+        """End all streams and refuse new subscribers. Safe to call from a signal handler."""
+        self.closed = True
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wake_all)
+            except RuntimeError:
+                pass
+
+    def _wake_all(self):
+        for sub in list(self.subscribers):
+            sub.wake.set()
+
+    def subscribe(self):
+        if self.closed:
+            raise BroadcasterFull("closed")
+        if len(self.subscribers) >= self.max_subscribers:
+            raise BroadcasterFull(f"{len(self.subscribers)} subscribers already")
+        sub = Subscriber()
+        self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        self.subscribers.discard(sub)
+
+    async def stream(self, sub, first=b""):
+        """
+        Bytes for a StreamingResponse: `first`, then the subscriber's events
+        as they arrive, with a comment line every `heartbeat` seconds of
+        silence. Unsubscribes when the client goes away.
+        """
+        try:
+            yield f"retry: {self.retry_ms}\n\n".encode() + first
+            while not self.closed:
+                if not sub.chunks:
+                    sub.wake.clear()
+                    try:
+                        await asyncio.wait_for(sub.wake.wait(), self.heartbeat)
+                    except asyncio.TimeoutError:
+                        yield HEARTBEAT
+                        continue
+                    if not sub.chunks:
+                        continue  # woken by close()
+                chunks = list(sub.chunks)
+                sub.chunks.clear()
+                sub.buffered = 0
+                yield b"".join(chunk for chunk, _ in chunks) if len(chunks) > 1 else chunks[0][0]
+        finally:
+            self.unsubscribe(sub)
+
+    def stats(self):
+        return {"subscribers": len(self.subscribers), "published": self.published, "resyncs": self.resyncs}
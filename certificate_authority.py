@@ -1,14 +1,58 @@
 import uuid
 import json
+import logging
 import os
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
+from cryptography.hazmat.primitives import serialization
+
+import metrics
+
+logger = logging.getLogger("cidn.ca")
+
+_NO_KEY = object()  # cached marker for a PEM that does not parse
+
 
 class CertificateAuthority:
-    def __init__(self, storage_file="certs.json"):
+    """
+    Issues and revokes device certificates. All lookups are served from
+    memory. Changes are appended to a journal next to `storage_file` and
+    group-committed (one write + fsync per `commit_every` changes or every
+    `commit_interval` seconds); once the journal holds `compact_after`
+    entries it is folded into a fresh snapshot of `storage_file`.
+
+    Parsed public keys are kept in an LRU of `key_cache_size` entries, so
+    verifying an alert does not re-parse the device's PEM every time.
+    """
+
+    def __init__(self, storage_file="certs.json", commit_every=64, commit_interval=0.2,
+                 compact_after=10000, key_cache_size=4096):
         self.storage_file = storage_file
+        self.journal_file = storage_file + ".journal" if storage_file else None
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.compact_after = compact_after
         self.issued_certs = {}  # device_id -> cert
+        self.key_cache_size = key_cache_size
+        self._keys = OrderedDict()  # device_id -> parsed public key (LRU)
+        self._key_lock = threading.Lock()
+        self.key_cache_hits = 0
+        self.key_cache_misses = 0
+
+        self._pending = []          # journal lines not yet written
+        self._journal_entries = 0   # entries in the journal file since the last snapshot
+        self._lock = threading.RLock()
+        self._journal = None
+        self._stop = threading.Event()
+        self._flusher = None
         self.load()
+        if self.journal_file:
+            self._journal = open(self.journal_file, "a")
+            if commit_interval:
+                self._flusher = threading.Thread(target=self._flush_loop, name="ca-journal", daemon=True)
+                self._flusher.start()
 
     def register_device(self, device_id, pub_key_pem):
         cert = {
@@ -18,18 +62,47 @@ class CertificateAuthority:
             "revoked": False,
             "issued_at": datetime.utcnow().isoformat() + "Z"
         }
-        self.issued_certs[device_id] = cert
-        self.save()
-        print(f"[CA] ✅ Registered {device_id} with provided public key")
+        with self._lock:
+            self.issued_certs[device_id] = cert
+            self._log({"op": "register", "cert": cert})
+        self._forget_key(device_id)
+        logger.info(f"[CA] ✅ Registered {device_id} with provided public key")
         return cert
 
+    def register_devices(self, devices):
+        """
+        Register many (device_id, pub_key_pem) pairs at once; the journal is
+        committed once for the whole batch.
+        """
+        issued_at = datetime.utcnow().isoformat() + "Z"
+        certs = []
+        with self._lock:
+            for device_id, pub_key_pem in devices:
+                cert = {
+                    "cert_id": str(uuid.uuid4()),
+                    "device_id": device_id,
+                    "public_key_pem": pub_key_pem,
+                    "revoked": False,
+                    "issued_at": issued_at
+                }
+                self.issued_certs[device_id] = cert
+                self._forget_key(device_id)
+                if self.journal_file:
+                    self._pending.append(json.dumps({"op": "register", "cert": cert}, separators=(",", ":")) + "\n")
+                certs.append(cert)
+            self.commit()
+        logger.info(f"[CA] ✅ Registered {len(certs)} devices")
+        return certs
+
     def revoke_certificate(self, device_id):
-        cert = self.issued_certs.get(device_id)
-        if cert and not cert["revoked"]:
-            cert["revoked"] = True
-            self.save()
-            print(f"[CA] ❌ Certificate revoked for {device_id}")
-            return True
+        with self._lock:
+            cert = self.issued_certs.get(device_id)
+            if cert and not cert["revoked"]:
+                cert["revoked"] = True
+                self._log({"op": "revoke", "device_id": device_id})
+                self._forget_key(device_id)
+                logger.warning(f"[CA] ❌ Certificate revoked for {device_id}")
+                return True
         return False
 
     def is_revoked(self, device_id):
@@ -43,12 +116,125 @@ class CertificateAuthority:
         cert = self.issued_certs.get(device_id)
         return cert["public_key_pem"] if cert else None
 
+    def get_public_key(self, device_id):
+        """
+        Parsed public key of a registered, unrevoked device, or None (unknown,
+        revoked, or a PEM that does not parse). Served from the key cache.
+        """
+        with self._key_lock:
+            key = self._keys.get(device_id)
+            if key is not None:
+                self._keys.move_to_end(device_id)
+                self.key_cache_hits += 1
+                return None if key is _NO_KEY else key
+            self.key_cache_misses += 1
+
+        cert = self.issued_certs.get(device_id)
+        if cert is None or cert["revoked"]:
+            return None
+        try:
+            key = serialization.load_pem_public_key(cert["public_key_pem"].encode())
+        except (ValueError, TypeError, AttributeError):
+            key = _NO_KEY
+
+        if self.key_cache_size:
+            with self._key_lock:
+                # a revoke or re-register that raced the parse has already
+                # dropped the entry; only cache if the cert is still the same
+                if self.issued_certs.get(device_id) is cert and not cert["revoked"]:
+                    self._keys[device_id] = key
+                    if len(self._keys) > self.key_cache_size:
+                        self._keys.popitem(last=False)
+        return None if key is _NO_KEY else key
+
+    def _forget_key(self, device_id):
+        with self._key_lock:
+            self._keys.pop(device_id, None)
+
     # Persistence
+    def _log(self, entry):
+        if not self.journal_file:
+            return
+        self._pending.append(json.dumps(entry, separators=(",", ":")) + "\n")
+        if len(self._pending) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """Group-commit pending journal entries with a single write and fsync."""
+        with self._lock:
+            if not self._pending or self._journal is None:
+                return
+            with metrics.timed("ca_commit"):
+                self._journal.write("".join(self._pending))
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+            self._journal_entries += len(self._pending)
+            self._pending = []
+            if self._journal_entries >= self.compact_after:
+                self.save()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.commit_interval):
+            self.commit()
+
     def save(self):
-        with open(self.storage_file, "w") as f:
-            json.dump(self.issued_certs, f, indent=2)
+        """Write a full snapshot atomically and start a new, empty journal."""
+        if not self.storage_file:
+            return
+        with self._lock, metrics.timed("ca_save"):
+            tmp = self.storage_file + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.issued_certs, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.storage_file)
+            # replaying an entry that is already in the snapshot is harmless,
+            # so a crash between these two steps loses nothing
+            if self._journal is not None:
+                self._journal.truncate(0)
+            self._pending = []
+            self._journal_entries = 0
+
+    def journal_bytes(self):
+        with self._lock:
+            return os.fstat(self._journal.fileno()).st_size if self._journal is not None else 0
+
+    def journal_entries(self):
+        return self._journal_entries + len(self._pending)
 
     def load(self):
-        if os.path.exists(self.storage_file):
+        if self.storage_file and os.path.exists(self.storage_file):
             with open(self.storage_file, "r") as f:
                 self.issued_certs = json.load(f)
+        if self.journal_file and os.path.exists(self.journal_file):
+            self._replay_journal()
+
+    def _replay_journal(self):
+        valid = 0
+        with open(self.journal_file, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # torn write from a crash; drop it and everything after
+                if not line.endswith(b"\n"):
+                    break
+                if entry["op"] == "register":
+                    self.issued_certs[entry["cert"]["device_id"]] = entry["cert"]
+                elif entry["op"] == "revoke" and entry["device_id"] in self.issued_certs:
+                    self.issued_certs[entry["device_id"]]["revoked"] = True
+                valid += len(line)
+                self._journal_entries += 1
+        if valid != os.path.getsize(self.journal_file):
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(valid)
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            self.commit()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
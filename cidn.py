@@ -1,32 +1,123 @@
 import json
 import base64
+import binascii
 import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 from blockchain import Blockchain
+from block_builder import batch_block_data, iter_events
+from ledger_index import trust_value
+import metrics
+from peer_trust import PeerTrust
+from rules import MALICIOUS_TYPES, RuleEngine, default_rules, valid_metrics
+from trust_table import TrustTable
 
 logger = logging.getLogger("cidn")
 
+SIGNATURE_PADDING = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+VERIFY_INLINE_MAX = 16  # batches with fewer signed alerts are verified on the calling thread
+ALERT_TYPES = MALICIOUS_TYPES | {"benign"}
+
+# default trust changes applied by receive_alert(s) (CIDN.alert_reward etc.), re-checked on replay
+ALERT_REWARD = 0.05     # benign alert
+ALERT_PENALTY = 0.3     # malicious alert
+REVOKE_THRESHOLD = 0.1  # auto-revoke at or below this trust
+REPLAY_TOLERANCE = 1e-9
+MALICIOUS_ALERT_EVENTS = frozenset(f"{t}_alert" for t in MALICIOUS_TYPES)
+MAX_RATINGS = 10000  # per feedback report
+MAX_RATING_COUNT = 1000000
+
+
+def alert_type_label(event_type):
+    """Alert type as a metrics label; unknown types share one label to bound cardinality."""
+    return event_type if isinstance(event_type, str) and event_type in ALERT_TYPES else "other"
+
+
+def canonical_alert(alert):
+    """
+    Bytes a device signs: the alert without its "signature" field, as compact
+    JSON with sorted keys.
+    """
+    body = {k: v for k, v in alert.items() if k != "signature"}
+    return json.dumps(body, sort_keys=True, separators=(",", ":")).encode()
+
+
+def _counted(entry, count):
+    """Ledger entry for an alert standing in for `count` coalesced ones; plain entries stay as they were."""
+    if count != 1:
+        entry["count"] = count
+    return entry
+
+
+def repeat_delta(trust, delta, count, floor=None):
+    """
+    Trust after `count` alerts each moving it by `delta`, clamped to [0, 1],
+    as if they had arrived one by one: stops at the clamp, or once trust is
+    at or below `floor` (the auto-revoke threshold, after which the rest
+    would be rejected).
+    """
+    for _ in range(count):
+        trust = min(1.0, max(0.0, trust + delta))
+        if trust == 0.0 or trust == 1.0 or (floor is not None and trust <= floor):
+            break
+    return trust
+
+
 class CIDN:
     """
     CIDN coordinates devices, verifies alerts, evaluates behavior-based rules,
     updates trust, and logs events to the blockchain.
     """
 
-    def __init__(self, ca, blockchain=None):
+    def __init__(self, ca, blockchain=None, builder=None, verify_workers=None):
         self.ca = ca
         self.devices = {}  # device_id -> device object or str
-        self.trust = {}    # device_id -> trust score [0..1]
-        self.revoked = set()
+        self.trust = TrustTable()         # device_id -> trust score [0..1], column-backed
+        self.revoked = self.trust.revoked  # set-like view of the table's revoked column
         self.blockchain = blockchain or Blockchain()
+        self.builder = builder  # block_builder.BlockBuilder; batches events into Merkle blocks
 
         # parameters (tunable)
         self.initial_trust = 0.5
+        self.alert_reward = ALERT_REWARD
+        self.alert_penalty = ALERT_PENALTY
+        self.revoke_threshold = REVOKE_THRESHOLD
         self.scan_threshold = 10          # scans per monitoring window considered suspicious
         self.packet_drop_threshold = 0.5  # forwarding rate below this is suspicious
         self.high_penalty = 0.4
         self.medium_penalty = 0.2
         self.recovery_rate = 0.05  # per benign event
+        self.require_signatures = False  # reject unsigned alerts and feedback
+        self.evaluate_rules = False  # run the rule engine on every alert receive_alerts accepts
+        self._rules = None  # rules.RuleEngine, built on first use
+        self.peers = PeerTrust(self.trust, initial_trust=self.initial_trust)  # peer feedback, EigenTrust
+
+        self.verify_workers = verify_workers or os.cpu_count() or 1
+        self._verify_pool = None
+
+    # ---- ledger ----
+    def record_event(self, event: dict):
+        """
+        Log an event to the ledger. With a block builder the event joins the
+        current batch and a Receipt (with its inclusion proof once written) is
+        returned; otherwise it gets a block of its own.
+        """
+        if self.builder is not None:
+            return self.builder.append(event)
+        return self.blockchain.add_block(event)
+
+    def record_events(self, events):
+        """Log several events together: into the current batch, or as one batch block."""
+        if not events:
+            return []
+        if self.builder is not None:
+            return self.builder.extend(events)
+        return self.blockchain.add_block(batch_block_data(events))
 
     # ---- device lifecycle ----
     def add_device(self, device_obj_or_id, cert=None):
@@ -40,78 +131,342 @@ class CIDN:
 
         self.devices[dev_id] = device_obj_or_id
         self.trust[dev_id] = self.initial_trust
-        self.blockchain.add_block({"event": "register", "device_id": dev_id, "trust": self.trust[dev_id]})
+        self.revoked.discard(dev_id)
+        self.record_event({"event": "register", "device_id": dev_id, "trust": self.trust[dev_id]})
         logger.info(f"[CIDN] ✅ Device {dev_id} added with trust {self.trust[dev_id]}")
         return True
 
+    def add_devices(self, devices):
+        """
+        Add many devices (Device objects or ids) with a single ledger entry.
+        """
+        dev_ids = []
+        for device_obj_or_id in devices:
+            dev_id = device_obj_or_id if isinstance(device_obj_or_id, str) else device_obj_or_id.device_id
+            self.devices[dev_id] = device_obj_or_id
+            self.trust[dev_id] = self.initial_trust
+            self.revoked.discard(dev_id)
+            dev_ids.append(dev_id)
+        if dev_ids:
+            self.record_event({"event": "register_batch", "devices": dev_ids, "trust": self.initial_trust})
+            logger.info(f"[CIDN] ✅ {len(dev_ids)} devices added with trust {self.initial_trust}")
+        return len(dev_ids)
+
     # ---- alert ingestion & verification ----
-    # cidn.py
+    def verify_alert(self, alert: dict):
+        """
+        Check an alert's signature: base64 RSA-PSS/SHA-256 over
+        canonical_alert(alert), against the device's CA-registered key.
+        Unsigned alerts pass unless require_signatures is set.
+        """
+        signature = alert.get("signature")
+        if signature is None:
+            return not self.require_signatures
+        key = self.ca.get_public_key(alert.get("device_id"))
+        if key is None:
+            return False
+        try:
+            key.verify(base64.b64decode(signature, validate=True), canonical_alert(alert),
+                       SIGNATURE_PADDING, hashes.SHA256())
+        except (InvalidSignature, binascii.Error, TypeError, ValueError):
+            return False
+        return True
+
+    def verify_alerts(self, alerts):
+        """
+        verify_alert for a batch. Signed alerts are split across a thread pool
+        (RSA verification releases the GIL); returns one bool per alert.
+        """
+        results = [None] * len(alerts)
+        signed = []
+        for pos, alert in enumerate(alerts):
+            if alert.get("signature") is None:
+                results[pos] = not self.require_signatures
+            else:
+                signed.append(pos)
+
+        if len(signed) < VERIFY_INLINE_MAX or self.verify_workers == 1:
+            for pos in signed:
+                results[pos] = self.verify_alert(alerts[pos])
+            return results
 
-    # cidn.py
+        if self._verify_pool is None:
+            self._verify_pool = ThreadPoolExecutor(max_workers=self.verify_workers,
+                                                   thread_name_prefix="cidn-verify")
+
+        def verify_chunk(chunk):
+            for pos in chunk:
+                results[pos] = self.verify_alert(alerts[pos])
+
+        step = -(-len(signed) // self.verify_workers)
+        chunks = [signed[i:i + step] for i in range(0, len(signed), step)]
+        for _ in self._verify_pool.map(verify_chunk, chunks):
+            pass
+        return results
 
     def receive_alert(self, alert: dict):
         device_id = alert.get("device_id")
         event_type = alert.get("type")
+        if not isinstance(event_type, str):
+            event_type = None  # malformed; keeps the set lookups below safe
+        result = self._receive_alert(alert, device_id, event_type)
+        metrics.inc("cidn_alerts_total", type=alert_type_label(event_type), result=result)
+        return result == "ok"
 
+    def _receive_alert(self, alert, device_id, event_type):
         if not device_id or device_id not in self.trust:
-            print(f"[CIDN] ❌ Unknown device {device_id} attempted alert")
-            return False
+            logger.warning(f"[CIDN] ❌ Unknown device {device_id} attempted alert")
+            return "unknown_device"
 
-        if self.ca.is_revoked(device_id):
-            print(f"[CIDN] ❌ Device {device_id} certificate revoked, rejecting alert")
-            return False
+        if not valid_metrics(alert.get("metrics")):
+            logger.warning(f"[CIDN] ❌ Malformed metrics in alert from {device_id}")
+            return "invalid"
+
+        with metrics.timed("revocation_check"):
+            revoked = self.ca.is_revoked(device_id)
+        if revoked:
+            logger.warning(f"[CIDN] ❌ Device {device_id} certificate revoked, rejecting alert")
+            return "revoked"
+
+        with metrics.timed("verify"):
+            valid = self.verify_alert(alert)
+        if not valid:
+            logger.warning(f"[CIDN] ❌ Invalid or missing signature on alert from {device_id}")
+            return "bad_signature"
+
+        self.trust.count_alerts(device_id, 1, int(event_type in MALICIOUS_TYPES))
 
         # --- Benign ---
         if event_type == "benign":
-            self.trust[device_id] = min(1.0, self.trust[device_id] + 0.05)
-            self.blockchain.add_block({"event": "benign_alert", "device_id": device_id, "trust": self.trust[device_id]})
-            print(f"[CIDN] ✅ Benign alert from {device_id}, trust ↑ {self.trust[device_id]}")
-            return True
+            self.trust[device_id] = min(1.0, self.trust[device_id] + self.alert_reward)
+            self.record_event({"event": "benign_alert", "device_id": device_id, "trust": self.trust[device_id]})
+            logger.info(f"[CIDN] ✅ Benign alert from {device_id}, trust ↑ {self.trust[device_id]}")
+            return "ok"
 
         # --- Malicious types ---
-        malicious_types = {"malicious", "scan", "malicious_scan", "ddos", "packet_drop"}
-        if event_type in malicious_types:
-            self.trust[device_id] = max(0.0, self.trust[device_id] - 0.3)
-            self.blockchain.add_block({"event": f"{event_type}_alert", "device_id": device_id, "trust": self.trust[device_id]})
-            print(f"[CIDN] ⚠️ {event_type} alert from {device_id}, trust ↓ {self.trust[device_id]}")
+        if event_type in MALICIOUS_TYPES:
+            self.trust[device_id] = max(0.0, self.trust[device_id] - self.alert_penalty)
+            self.record_event({"event": f"{event_type}_alert", "device_id": device_id, "trust": self.trust[device_id]})
+            logger.info(f"[CIDN] ⚠️ {event_type} alert from {device_id}, trust ↓ {self.trust[device_id]}")
 
             # Auto-revoke if trust too low
-            if self.trust[device_id] <= 0.1:
+            if self.trust[device_id] <= self.revoke_threshold:
                 self.ca.revoke_certificate(device_id)
-                print(f"[CIDN] ❌ Device {device_id} trust too low → revoked")
-                return False
-            return True
+                self.revoked.add(device_id)
+                if self._rules is not None:
+                    self._rules.forget(device_id)
+                self.record_event({"event": "revoke", "device_id": device_id, "reason": "low_trust"})
+                logger.warning(f"[CIDN] ❌ Device {device_id} trust too low → revoked")
+                return "auto_revoked"
+            return "ok"
 
         # --- Unknown ---
-        print(f"[CIDN] ❓ Unknown alert type {event_type} from {device_id}")
-        return False
+        logger.warning(f"[CIDN] ❓ Unknown alert type {event_type} from {device_id}")
+        return "unsupported_type"
 
+    def receive_alerts(self, alerts, counts=None, now=None):
+        """
+        Batch version of receive_alert. Alerts are grouped by device; each
+        device's trust is updated in one pass over its alerts (same deltas and
+        auto-revoke rule as receive_alert) and its revocation is checked once.
+        Signatures are checked up front with verify_alerts. All resulting
+        ledger entries are recorded together.
 
-    # ---- evaluation rules ----
-    def evaluate_and_update(self, device_id, alert_payload):
-        metrics = alert_payload.get("metrics", {})
-        msg_type = alert_payload.get("type", "").lower()
-        details = alert_payload.get("details", {})
-
-        if "malicious" in str(details).lower() or "malware" in str(details).lower():
-            self.adjust_trust(device_id, -self.high_penalty, reason="malicious_keyword")
-        elif msg_type in ["info", "benign", "heartbeat"]:
-            self.adjust_trust(device_id, +self.recovery_rate, reason="benign_event")
-
-        scan_count = int(metrics.get("scan_count", 0))
-        if scan_count >= self.scan_threshold:
-            self.adjust_trust(device_id, -self.high_penalty, reason=f"scan_count={scan_count}")
-
-        packets_sent = int(metrics.get("packets_sent", 0))
-        packets_failed = int(metrics.get("packets_failed", 0))
-        if packets_sent > 0:
-            forwarding_rate = (packets_sent - packets_failed) / packets_sent
-            if forwarding_rate < self.packet_drop_threshold:
-                self.adjust_trust(device_id, -self.high_penalty, reason=f"forwarding_rate={forwarding_rate:.2f}")
-            elif forwarding_rate < 0.8:
-                self.adjust_trust(device_id, -self.medium_penalty, reason=f"forwarding_rate={forwarding_rate:.2f}")
+        `counts`, if given, is how many identical alerts each one stands for
+        (see ingest_guard). Such an alert moves trust as that many alerts
+        would one by one (repeat_delta); its entry carries the count and the
+        alert counters advance by it.
+
+        With evaluate_rules, each accepted alert is then folded into the rule
+        engine's windows, in order. The rules that fire are applied on top of
+        the alert's own delta (a benign alert can also earn recovery_rate, a
+        scan also high_penalty) and logged as one trust_update; a device that
+        rules bring down to the revoke threshold is revoked. This is a
+        different trust policy, so the server leaves it off unless CIDN_RULES
+        is set. `now` is the rule windows' clock (default: time.time()).
+
+        Returns one status per alert, in input order: "ok" or "rejected".
+        """
+        with metrics.timed("verify"):
+            valid = self.verify_alerts(alerts)
+        results = ["unknown_device"] * len(alerts)
+        by_device = {}
+        invalid = set()  # positions with malformed metrics, found before any state changes
+        for pos, alert in enumerate(alerts):
+            device_id = alert.get("device_id")
+            by_device.setdefault(device_id if isinstance(device_id, str) else None, []).append(pos)
+            if "metrics" in alert and not valid_metrics(alert["metrics"]):
+                invalid.add(pos)
+
+        entries = []
+        rejected_devices = 0
+        reward, penalty, threshold = self.alert_reward, self.alert_penalty, self.revoke_threshold
+        rules = self.rule_engine() if self.evaluate_rules else None
+        now = time.time() if now is None else now
+        with metrics.timed("trust_update"):
+            for device_id, positions in by_device.items():
+                if not device_id or device_id not in self.trust:
+                    rejected_devices += 1
+                    continue
+                with metrics.timed("revocation_check"):
+                    revoked = self.ca.is_revoked(device_id)
+                if revoked:
+                    rejected_devices += 1
+                    for pos in positions:
+                        results[pos] = "revoked"
+                    continue
+
+                trust = self.trust[device_id]
+                seen = malicious = 0
+                for pos in positions:
+                    if pos in invalid:
+                        results[pos] = "invalid"
+                        continue
+                    if not valid[pos]:
+                        results[pos] = "bad_signature"
+                        continue
+                    n = counts[pos] if counts is not None else 1
+                    seen += n
+                    event_type = alerts[pos].get("type")
+                    if not isinstance(event_type, str):
+                        event_type = None  # malformed; keeps the set lookups below safe
+                    if event_type == "benign":
+                        trust = repeat_delta(trust, reward, n) if n != 1 else min(1.0, trust + reward)
+                        entries.append(_counted({"event": "benign_alert", "device_id": device_id, "trust": trust}, n))
+                    elif event_type in MALICIOUS_TYPES:
+                        malicious += n
+                        trust = repeat_delta(trust, -penalty, n, threshold) if n != 1 else max(0.0, trust - penalty)
+                        entries.append(_counted({"event": f"{event_type}_alert", "device_id": device_id,
+                                                 "trust": trust}, n))
+                    else:
+                        results[pos] = "unsupported_type"
+                        continue
+                    lowered = event_type != "benign"
+                    fired = rules.observe(device_id, alerts[pos], now, n) if rules is not None else ()
+                    if fired:
+                        old = trust
+                        for _, delta, _ in fired:
+                            trust = min(1.0, max(0.0, trust + delta))
+                            lowered = lowered or delta < 0
+                        entries.append({"event": "trust_update", "device_id": device_id, "old": old, "new": trust,
+                                        "reason": "; ".join(f"{name}: {reason}" for name, _, reason in fired)})
+                    if lowered and trust <= threshold:
+                        # later alerts from this device are rejected, as they would be one by one
+                        self.ca.revoke_certificate(device_id)
+                        self.revoked.add(device_id)
+                        if rules is not None:
+                            rules.forget(device_id)
+                        entries.append({"event": "revoke", "device_id": device_id, "reason": "low_trust"})
+                        logger.warning(f"[CIDN] ❌ Device {device_id} trust too low → revoked")
+                        results[pos] = "auto_revoked"
+                        for later in positions[positions.index(pos) + 1:]:
+                            results[later] = "revoked"
+                        break
+                    results[pos] = "ok"
+                self.trust[device_id] = trust
+                self.trust.count_alerts(device_id, seen, malicious)
+
+        self.record_events(entries)
+        statuses = ["ok" if r == "ok" else "rejected" for r in results]
+        if metrics.ENABLED:
+            for (event_type, result), n in Counter(
+                    (alert_type_label(a.get("type")), r) for a, r in zip(alerts, results)).items():
+                metrics.inc("cidn_alerts_total", n, type=event_type, result=result)
+        logger.info(f"[CIDN] 📦 Batch of {len(alerts)} alerts: {statuses.count('ok')} accepted, "
+                    f"{rejected_devices} unknown or revoked devices, {results.count('bad_signature')} bad signatures, "
+                    f"{len(invalid)} malformed")
+        return statuses
+
+    # ---- peer feedback ----
+    def receive_feedback(self, reports):
+        """
+        Record what devices observed about each other. A report is
+        {"device_id": rater, "ratings": [{"device_id": peer, "positive": n,
+        "negative": n}, ...]}, signed like an alert. Ratings of unknown
+        devices or of the rater itself are skipped; each report with ratings
+        left becomes one "peer_feedback" ledger entry.
+
+        Returns one status per report: "ok", "unknown_device", "revoked",
+        "bad_signature" or "invalid".
+        """
+        valid = self.verify_alerts(reports)
+        slots = self.trust.slots
+        statuses, entries = [], []
+        for report, signed_ok in zip(reports, valid):
+            rater = report.get("device_id")
+            ratings = report.get("ratings")
+            if not isinstance(rater, str) or rater not in slots:
+                statuses.append("unknown_device")
+            elif rater in self.revoked:
+                statuses.append("revoked")
+            elif not signed_ok:
+                statuses.append("bad_signature")
+            elif not isinstance(ratings, list) or len(ratings) > MAX_RATINGS:
+                statuses.append("invalid")
             else:
-                self.adjust_trust(device_id, +self.recovery_rate, reason=f"forwarding_rate={forwarding_rate:.2f}")
+                rows = []
+                for rating in ratings:
+                    counts = (rating.get("positive", 0), rating.get("negative", 0)) if isinstance(rating, dict) else ()
+                    if len(counts) != 2 or not all(type(c) is int and 0 <= c <= MAX_RATING_COUNT for c in counts):
+                        rows = None
+                        break
+                    peer = rating.get("device_id")
+                    if isinstance(peer, str) and peer != rater and peer in slots and any(counts):
+                        rows.append([peer, *counts])
+                if rows is None:
+                    statuses.append("invalid")
+                    continue
+                if rows:
+                    self._add_feedback(rater, rows)
+                    entries.append({"event": "peer_feedback", "device_id": rater, "ratings": rows})
+                statuses.append("ok")
+        self.record_events(entries)
+        logger.info(f"[CIDN] 🤝 Feedback from {statuses.count('ok')} of {len(reports)} devices, "
+                    f"{sum(len(e['ratings']) for e in entries)} ratings")
+        return statuses
+
+    def _add_feedback(self, rater, rows):
+        slots = self.trust.slots
+        rows = [row for row in rows if row[0] in slots]
+        if rater in slots and rows:
+            self.peers.add([slots[rater]] * len(rows), [slots[peer] for peer, _, _ in rows],
+                           [row[1] for row in rows], [row[2] for row in rows])
+
+    def peer_trust(self, device_id):
+        """A device's own trust, its EigenTrust score from peer feedback, and the blend of both."""
+        slot = self.trust.slots.get(device_id)
+        if slot is None:
+            return None
+        own = float(self.trust.trust[slot])
+        peer = float(self.peers.scores()[slot])
+        return {"device_id": device_id, "trust": own, "peer_trust": peer, "blended": self.peers.blend(own, peer)}
+
+    # ---- evaluation rules ----
+    def rule_engine(self):
+        """Sliding-window rule engine, compiled from the current parameters on first use."""
+        if self._rules is None:
+            self._rules = RuleEngine(default_rules(
+                scan_threshold=self.scan_threshold,
+                packet_drop_threshold=self.packet_drop_threshold,
+                high_penalty=self.high_penalty,
+                medium_penalty=self.medium_penalty,
+                recovery_rate=self.recovery_rate,
+            ))
+        return self._rules
+
+    def evaluate_and_update(self, device_id, alert_payload, now=None):
+        """
+        Fold an alert into the device's behavior windows and apply the trust
+        change of every rule that fires (see rules.default_rules). Alerts
+        with malformed metrics are ignored.
+        """
+        if not valid_metrics(alert_payload.get("metrics")):
+            logger.warning(f"[CIDN] ❌ Malformed metrics in alert from {device_id}, rules not evaluated")
+            return
+        with metrics.timed("rules"):
+            fired = self.rule_engine().observe(device_id, alert_payload, now)
+        for name, delta, reason in fired:
+            self.adjust_trust(device_id, delta, reason=f"{name}: {reason}")
 
         if self.trust.get(device_id, 0) <= 0:
             self.revoke_device(device_id)
@@ -121,25 +476,258 @@ class CIDN:
         new = max(0.0, min(1.0, old + delta))
         self.trust[device_id] = new
         logger.info(f"[CIDN] 🔎 Trust of {device_id} changed {old:.2f} -> {new:.2f} (reason: {reason})")
-        self.blockchain.add_block({"event": "trust_update", "device_id": device_id, "old": old, "new": new, "reason": reason})
+        self.record_event({"event": "trust_update", "device_id": device_id, "old": old, "new": new, "reason": reason})
         return new
 
     def revoke_device(self, device_id):
         if self.ca.revoke_certificate(device_id):
             self.revoked.add(device_id)
-            self.blockchain.add_block({"event": "revoke", "device_id": device_id})
+            if self._rules is not None:
+                self._rules.forget(device_id)
+            self.record_event({"event": "revoke", "device_id": device_id})
             logger.warning(f"[CIDN] 🔒 Device {device_id} revoked and logged.")
 
+    # ---- fleet-wide operations ----
+    def adjust_fleet(self, delta, device_ids=None, reason=""):
+        """
+        Apply a trust delta to a group of devices (the whole fleet when
+        device_ids is None) in one vectorized step, logged as one ledger event.
+        """
+        changed = self.trust.apply_delta(delta, device_ids)
+        self.record_event({"event": "fleet_adjust", "delta": delta, "devices": device_ids,
+                           "changed": changed, "reason": reason})
+        logger.info(f"[CIDN] 🔎 Trust of {changed} devices changed by {delta:+.2f} (reason: {reason})")
+        return changed
+
+    def fleet_stats(self, bins=10):
+        return {
+            **self.trust.stats(),
+            "percentiles": self.trust.percentiles(),
+            "histogram": self.trust.histogram(bins),
+        }
+
+    # ---- replicas ----
+    def apply_ledger_event(self, event):
+        """
+        Bring trust/revoked state in line with one event read back from the
+        ledger. Used by read-only replicas that follow a chain they don't write.
+        """
+        kind = event.get("event")
+        if kind == "fleet_adjust":
+            self.trust.apply_delta(event["delta"], event.get("devices"))
+            return
+        if kind == "register_batch":
+            for dev_id in event.get("devices") or ():
+                self.devices[dev_id] = dev_id
+                self.trust[dev_id] = event["trust"]
+                self.revoked.discard(dev_id)
+            return
+        device_id = event.get("device_id")
+        if device_id is None:
+            return
+        if kind == "peer_feedback":
+            self._add_feedback(device_id, event.get("ratings") or [])
+            return
+        if kind == "revoke":
+            self.revoked.add(device_id)
+            return
+        value = trust_value(event)
+        if value is not None:
+            self.trust[device_id] = value
+            if kind == "register":
+                self.devices[device_id] = device_id
+                self.revoked.discard(device_id)
+            elif kind and kind.endswith("_alert"):
+                n = event.get("count", 1)
+                self.trust.count_alerts(device_id, n, n * int(kind in MALICIOUS_ALERT_EVENTS))
+
+    def replay(self, blocks, check=True, max_examples=10):
+        """
+        Apply ledger blocks to the trust table, with the same effect as
+        apply_ledger_event on each of their events but without per-event
+        overhead: the columns are worked on as plain lists and written back
+        once at the end. With `check`, the trust each event claims is
+        compared with the value recomputed from the state before it (alert
+        deltas, the old value of trust updates, fleet adjustments, low-trust
+        revokes). Returns {"blocks", "events", "mismatches", "examples"}.
+        """
+        ids, columns = self.trust.export()
+        slots = dict(self.trust.slots)
+        trust = columns["trust"].tolist()
+        updated = columns["updated"].tolist()
+        revoked = columns["revoked_flags"].tolist()
+        alerts = columns["alerts"].tolist()
+        malicious = columns["malicious"].tolist()
+        devices = self.devices
+        feedback = ([], [], [], [])  # rater slots, ratee slots, positive, negative
+        report = {"blocks": 0, "events": 0, "mismatches": 0, "examples": []}
+
+        def mismatch(block, event, expected):
+            report["mismatches"] += 1
+            if len(report["examples"]) < max_examples:
+                report["examples"].append({"block": block.index, "event": event, "expected": expected})
+
+        def slot_of(device_id):
+            slot = slots.get(device_id)
+            if slot is None:
+                slot = slots[device_id] = len(ids)
+                ids.append(device_id)
+                trust.append(0.0)
+                updated.append(0.0)
+                revoked.append(False)
+                alerts.append(0)
+                malicious.append(0)
+            return slot
+
+        for block in blocks:
+            report["blocks"] += 1
+            events = iter_events(block.data)
+            report["events"] += len(events)
+            ts = block.timestamp
+            for event in events:
+                kind = event.get("event")
+                if kind == "benign_alert" or kind in MALICIOUS_ALERT_EVENTS:
+                    slot = slots.get(event.get("device_id"))
+                    value = event.get("trust")
+                    if slot is None or value is None:
+                        if check and slot is None:
+                            mismatch(block, event, "unknown device")
+                        if value is None or event.get("device_id") is None:
+                            continue
+                        slot = slot_of(event["device_id"])
+                    elif check:
+                        n = event.get("count", 1)
+                        if kind == "benign_alert":
+                            expected = repeat_delta(trust[slot], self.alert_reward, n)
+                        else:
+                            expected = repeat_delta(trust[slot], -self.alert_penalty, n, self.revoke_threshold)
+                        if abs(expected - value) > REPLAY_TOLERANCE:
+                            mismatch(block, event, {"trust": expected})
+                    trust[slot] = value
+                    updated[slot] = ts
+                    n = event.get("count", 1)
+                    alerts[slot] += n
+                    if kind != "benign_alert":
+                        malicious[slot] += n
+                    continue
+
+                if kind == "register_batch":
+                    value = event["trust"]
+                    for device_id in event.get("devices") or ():
+                        devices[device_id] = device_id
+                        slot = slot_of(device_id)
+                        trust[slot] = value
+                        updated[slot] = ts
+                        revoked[slot] = False
+                    continue
+
+                if kind == "fleet_adjust":
+                    targets = range(len(ids)) if event.get("devices") is None else \
+                        [slots[d] for d in event["devices"] if d in slots]
+                    changed = 0
+                    for slot in targets:
+                        if not revoked[slot]:
+                            trust[slot] = min(1.0, max(0.0, trust[slot] + event["delta"]))
+                            updated[slot] = ts
+                            changed += 1
+                    if check and "changed" in event and changed != event["changed"]:
+                        mismatch(block, event, {"changed": changed})
+                    continue
+
+                device_id = event.get("device_id")
+                if device_id is None:
+                    continue
+                slot = slots.get(device_id)
+                if kind == "peer_feedback":
+                    for peer, positive, negative in event.get("ratings") or ():
+                        if slot is not None and peer in slots:
+                            for column, value in zip(feedback, (slot, slots[peer], positive, negative)):
+                                column.append(value)
+                    continue
+                if kind == "revoke":
+                    if slot is None:
+                        if check:
+                            mismatch(block, event, "unknown device")
+                        continue
+                    if check and event.get("reason") == "low_trust" and \
+                            trust[slot] > self.revoke_threshold + REPLAY_TOLERANCE:
+                        mismatch(block, event, {"trust": trust[slot]})
+                    revoked[slot] = True
+                    continue
+
+                value = trust_value(event)
+                if value is None:
+                    continue
+                if check and kind == "trust_update":
+                    expected = trust[slot] if slot is not None else self.initial_trust
+                    if abs(expected - event.get("old", expected)) > REPLAY_TOLERANCE:
+                        mismatch(block, event, {"old": expected})
+                if slot is None:
+                    slot = slot_of(device_id)
+                trust[slot] = value
+                updated[slot] = ts
+                if kind == "register":
+                    devices[device_id] = device_id
+                    revoked[slot] = False
+
+        self.trust.load(ids, {"trust": trust, "updated": updated, "revoked_flags": revoked,
+                              "alerts": alerts, "malicious": malicious})
+        if feedback[0]:
+            self.peers.add(*feedback)
+        return report
+
+    # ---- snapshots ----
+    def snapshot_state(self):
+        """
+        (height, head_hash, ids, columns) for SnapshotStore.save. Call on the
+        writer thread: pending batched events are flushed first, so the table
+        reflects exactly the blocks up to `height`.
+        """
+        if self.builder is not None:
+            self.builder.flush()
+        ids, columns = self.trust.export()
+        columns.update(self.peers.export())
+        height, head_hash = self.blockchain.head()  # other threads may append anchor blocks
+        return height, head_hash, ids, columns
+
+    def restore(self, snapshots=None, check=True):
+        """
+        Rebuild the trust table at startup: load the newest snapshot that
+        belongs to this ledger, then replay the blocks after it (or the whole
+        ledger when there is none). Returns the replay report.
+        """
+        start = time.perf_counter()
+        chain = self.blockchain.chain
+        height, source = 0, "ledger"
+        for candidate in (snapshots.heights() if snapshots is not None else []):
+            if candidate > len(chain):
+                continue
+            try:
+                meta, ids, columns = snapshots.load(candidate)
+            except (OSError, ValueError, KeyError) as e:  # pruned meanwhile, or unreadable
+                logger.warning(f"[CIDN] ⚠️ Cannot load snapshot at height {candidate}: {e}")
+                continue
+            if chain[candidate - 1].hash != meta["head_hash"]:
+                logger.warning(f"[CIDN] ⚠️ Snapshot at height {candidate} does not match the ledger, skipping")
+                continue
+            self.trust.load(ids, columns)
+            self.peers.load(columns)
+            self.devices = {device_id: device_id for device_id in ids}
+            height, source = candidate, f"snapshot at height {candidate}"
+            break
+
+        report = self.replay((chain[i] for i in range(height, len(chain))), check=check)
+        report["source"] = source
+        report["seconds"] = time.perf_counter() - start
+        print(f"[CIDN] ♻️ Restored {len(self.trust)} devices from {source} + {report['events']} events "
+              f"in {report['seconds']:.2f}s ({report['mismatches']} mismatches)")
+        for example in report["examples"]:
+            logger.warning(f"[CIDN] ⚠️ Ledger mismatch: {example}")
+        return report
+
     # Utility
     def get_trust(self, device_id):
         return self.trust.get(device_id, None)
 
-    def list_devices(self):
-        return [
-            {
-                "device_id": dev_id,
-                "trust": self.trust.get(dev_id, 0),
-                "revoked": dev_id in self.revoked or self.ca.is_revoked(dev_id)
-            }
-            for dev_id in self.trust
-        ]
+    def list_devices(self, offset=0, limit=None):
+        return self.trust.rows(offset, limit)
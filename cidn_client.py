@@ -0,0 +1,337 @@
+# cidn_client.py
+"""
+Shared HTTP client for devices, monitors and the test scripts.
+
+    client = CIDNClient("http://127.0.0.1:8000", spool_path="alerts.spool")
+    client.register_many([(device_id, public_key), ...])
+    client.queue_alert(alert)      # batched and sent in the background
+    client.get_trust(device_id)
+    client.close()                 # flush what is queued and stop
+
+All requests go through one pooled requests.Session, so connections are
+reused. Alerts passed to queue_alert() are collected by a background thread
+and posted to /alerts/batch once `batch_size` are waiting or every
+`flush_interval` seconds. Failed requests are retried with jittered
+exponential backoff (honouring Retry-After on 429/503). A batch that still
+cannot be delivered is appended to an NDJSON spool file, which is replayed,
+oldest first, before anything newer is sent once the server answers again.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("cidn.client")
+
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+
+class CIDNUnavailable(Exception):
+    """The server could not be reached, or stayed busy, for all retry attempts."""
+
+
+# ---- spool ----
+class AlertSpool:
+    """
+    Append-only NDJSON file of alerts waiting for the server. Replay
+    progress is kept as a byte offset in `path + ".offset"`, and the file is
+    truncated once everything in it has been delivered. When appending would
+    exceed `max_bytes`, the oldest undelivered alerts are dropped.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._generation = 0  # bumped when a compaction rewrites the file
+        self.offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path, "r") as f:
+                self.offset = int(f.read().strip() or 0)
+        if self.offset > self._size():
+            self._set_offset(0)
+
+    def _size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def _set_offset(self, offset):
+        self.offset = offset
+        tmp = self.offset_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+        os.replace(tmp, self.offset_path)
+
+    def pending_bytes(self):
+        return self._size() - self.offset
+
+    def __bool__(self):
+        return self.pending_bytes() > 0
+
+    def append(self, alerts):
+        data = b"".join(json.dumps(a, separators=(",", ":")).encode() + b"\n" for a in alerts)
+        with self._lock:
+            if self._size() + len(data) > self.max_bytes:
+                self._compact(self.max_bytes - len(data))
+            with open(self.path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _compact(self, budget):
+        """Rewrite the spool with the newest undelivered lines that fit in `budget` bytes."""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            lines = f.read().splitlines(keepends=True)
+        kept, size = [], 0
+        for line in reversed(lines):
+            if size + len(line) > budget:
+                break
+            kept.append(line)
+            size += len(line)
+        self.dropped += len(lines) - len(kept)
+        logger.warning(f"[Client] ⚠️ Spool full, dropped {len(lines) - len(kept)} oldest alerts")
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(reversed(kept))
+        os.replace(tmp, self.path)
+        self._generation += 1
+        self._set_offset(0)
+
+    def replay(self, send, batch_size=500):
+        """
+        Pass spooled alerts to send(alerts) in order, in batches, recording
+        progress after each. Stops at the first exception (which propagates).
+        The lock is not held while sending, so appends never wait on the
+        network. Returns the number of alerts sent.
+        """
+        sent = 0
+        while True:
+            with self._lock:
+                generation, start = self._generation, self.offset
+                if not os.path.exists(self.path):
+                    break
+                with open(self.path, "rb") as f:
+                    f.seek(start)
+                    lines = [f.readline() for _ in range(batch_size)]
+                lines = [line for line in lines if line.endswith(b"\n")]  # not a torn last line
+                if not lines:
+                    break
+            send([json.loads(line) for line in lines])
+            sent += len(lines)
+            with self._lock:
+                if self._generation == generation:  # not compacted meanwhile
+                    self._set_offset(start + sum(len(line) for line in lines))
+        with self._lock:
+            if self.offset and self.offset >= self._size():
+                open(self.path, "wb").close()
+                self._set_offset(0)
+        return sent
+
+
+# ---- client ----
+class CIDNClient:
+    def __init__(self, base_url="http://127.0.0.1:8000", timeout=5.0, retries=4, backoff=0.25,
+                 max_backoff=10.0, batch_size=500, flush_interval=0.5, max_pending=100000,
+                 spool_path=None, spool_max_bytes=64 * 1024 * 1024, pool_size=16):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.spool = AlertSpool(spool_path, spool_max_bytes) if spool_path else None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.counters = {"sent": 0, "spooled": 0, "replayed": 0, "rejected": 0, "dropped": 0, "retries": 0}
+
+        self._pending = []
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._closing = False
+        self._thread = None
+
+    # ---- requests ----
+    def _delay(self, attempt, response=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))  # full jitter
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get("Retry-After", 0)))
+            except ValueError:
+                pass
+        return delay
+
+    def request(self, method, path, retries=None, **kwargs):
+        """
+        Send a request, retrying connection errors and 429/502/503/504.
+        Raises CIDNUnavailable once the retries are used up.
+        """
+        retries = self.retries if retries is None else retries
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.base_url + path
+        for attempt in range(retries + 1):
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = f"HTTP {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            if attempt == retries:
+                break
+            self.counters["retries"] += 1
+            time.sleep(self._delay(attempt, response))
+        raise CIDNUnavailable(f"{method} {path} failed after {retries + 1} attempts: {error}")
+
+    def get_json(self, path, **kwargs):
+        return self.request("GET", path, **kwargs).json()
+
+    def post_json(self, path, payload, **kwargs):
+        return self.request("POST", path, json=payload, **kwargs).json()
+
+    # ---- API ----
+    def register(self, device_id, public_key="auto_discovered"):
+        return self.post_json("/register", {"device_id": device_id, "public_key": public_key})
+
+    def register_many(self, pairs):
+        """Register [(device_id, public_key)] with one request."""
+        devices = [{"device_id": d, "public_key": k} for d, k in pairs]
+        return self.post_json("/register/batch", {"devices": devices}, timeout=max(self.timeout, 30))
+
+    def send_alert(self, alert, wait=True):
+        """Send one alert now; with wait, returns its status once it is on the ledger."""
+        return self.post_json("/alert", alert, params={"wait": str(wait).lower()})
+
+    def send_alerts(self, alerts, wait=False):
+        """Post a list of alerts to /alerts/batch now."""
+        response = self.request("POST", "/alerts/batch", params={"wait": str(wait).lower()},
+                                data=json.dumps(alerts, separators=(",", ":")),
+                                headers={"Content-Type": "application/json"})
+        response.raise_for_status()
+        return response.json()
+
+    def get_trust(self, device_id):
+        return self.get_json(f"/trust/{device_id}")
+
+    def list_devices(self, offset=0, limit=None):
+        params = {"offset": offset}
+        if limit is not None:
+            params["limit"] = limit
+        return self.get_json("/devices", params=params)
+
+    def log_test(self, test, status):
+        return self.post_json("/log_test", {"test": test, "status": status})
+
+    # ---- batching ----
+    def queue_alert(self, alert):
+        """Queue an alert for the background batcher; never blocks on the network."""
+        self.queue_alerts([alert])
+
+    def queue_alerts(self, alerts):
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("CIDNClient is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="cidn-client-batcher", daemon=True)
+                self._thread.start()
+            room = self.max_pending - len(self._pending)
+            overflow = alerts[room:] if room < len(alerts) else []
+            self._pending.extend(alerts[:max(0, room)])
+            self._cond.notify()
+        if overflow:
+            self._spool(overflow)
+
+    def flush(self, timeout=None):
+        """Wait until every queued alert has been sent or spooled. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify()
+            while self._pending or self._inflight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=30.0):
+        """Flush, stop the batcher and close the session."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.session.close()
+
+    def stats(self):
+        return {**self.counters, "pending": len(self._pending),
+                "spool_bytes": self.spool.pending_bytes() if self.spool is not None else 0,
+                "spool_dropped": self.spool.dropped if self.spool is not None else 0}
+
+    def _spool(self, alerts):
+        if self.spool is None:
+            self.counters["dropped"] += len(alerts)
+            logger.warning(f"[Client] ⚠️ Dropped {len(alerts)} alerts (no spool configured)")
+            return
+        self.spool.append(alerts)
+        self.counters["spooled"] += len(alerts)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._pending) < self.batch_size and not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                self._inflight = len(batch)
+                closing = self._closing and not self._pending
+            try:
+                self._deliver(batch)
+            except Exception:
+                logger.exception("[Client] ❌ Batcher error")
+            with self._cond:
+                self._inflight = 0
+                self._cond.notify_all()
+            if closing:
+                return
+
+    def _deliver(self, batch):
+        # spooled alerts are older, so they go first; while they cannot be
+        # delivered, new ones join them in the spool to keep the order
+        if self.spool:
+            try:
+                self.counters["replayed"] += self.spool.replay(self._send_batch, self.batch_size)
+            except CIDNUnavailable:
+                if batch:
+                    self._spool(batch)
+                return
+        if not batch:
+            return
+        try:
+            self._send_batch(batch)
+            self.counters["sent"] += len(batch)
+        except CIDNUnavailable as e:
+            logger.warning(f"[Client] ⚠️ {e}; spooling {len(batch)} alerts")
+            self._spool(batch)
+
+    def _send_batch(self, alerts):
+        try:
+            self.send_alerts(alerts)
+        except requests.HTTPError as e:
+            # the server refused the batch itself (e.g. 400); resending would not help
+            self.counters["rejected"] += len(alerts)
+            logger.warning(f"[Client] ⚠️ Batch of {len(alerts)} alerts rejected: {e}")
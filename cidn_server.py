@@ -1,63 +1,352 @@
+import asyncio
+import os
+import json
+import signal
+import threading
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from certificate_authority import CertificateAuthority
-from cidn import CIDN
-from blockchain import Blockchain
-import scapy.all as scapy
-from scapy.all import ARP, Ether, srp
+from starlette.concurrency import run_in_threadpool
+from block_builder import inclusion_proof, iter_events
+from broadcast import Broadcaster, BroadcasterFull, encode_event
+from ledger_index import LedgerIndex, trust_value
+from ingest import IngestPipeline, QueueFull
+from sequencer import (QUEUE_DEPTH, WRITER_BATCH, SequencerClient, final_snapshot, instrument, open_core,
+                       open_guard, open_replica, open_snapshots, start_background)
+from discovery import DiscoveryJobs
+import metrics
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
 
+LEDGER_PAGE_SIZE = 100
+LEDGER_MAX_PAGE = 1000
+DASHBOARD_BLOCKS = 50
+DASHBOARD_DEVICES = 200
+# live /events stream
+EVENTS_BUFFER = int(os.environ.get("CIDN_EVENTS_BUFFER", "1000"))  # events a subscriber may fall behind by
+EVENTS_MAX_SUBSCRIBERS = int(os.environ.get("CIDN_EVENTS_MAX_SUBSCRIBERS", "1000"))
+EVENTS_MAX_DEVICES = 1000  # per block; beyond this the event says "reload devices" instead
+DEVICES_PAGE_SIZE = 1000
+DEVICES_MAX_PAGE = 100000
+# Set to run as one of several workers sharing state through sequencer.py
+SEQUENCER_SOCKET = os.environ.get("CIDN_SEQUENCER_SOCKET")
+REPLICA_POLL_INTERVAL = float(os.environ.get("CIDN_REPLICA_POLL_INTERVAL", "0.05"))
+# where workers share discovery job status, so any worker can answer for a job
+DISCOVERY_DIR = os.environ.get("CIDN_DISCOVERY_DIR", "discovery_jobs")
+DISCOVERY_OPTIONS = ("methods", "ports", "timeout", "rate", "count_refused")
+DISCOVERY_PAGE_SIZE = 1000
+
+metrics.setup_logging()
+
 # Core system
-ca = CertificateAuthority()
-blockchain = Blockchain()
-cidn = CIDN(ca, blockchain)
+if SEQUENCER_SOCKET:
+    # worker: writes go to the sequencer, reads come from a replica of its ledger
+    ca = builder = None
+    blockchain, cidn = open_replica()
+    pipeline = SequencerClient(SEQUENCER_SOCKET, on_commit=blockchain.refresh)
+else:
+    ca, blockchain, builder, cidn = open_core()
+    pipeline = IngestPipeline(cidn, max_depth=QUEUE_DEPTH, max_batch=WRITER_BATCH, guard=open_guard())
+ledger_index = LedgerIndex(blockchain)
+instrument(blockchain, cidn, ca, pipeline if not SEQUENCER_SOCKET else None)
+discovery = DiscoveryJobs(register=pipeline.register_many, known=lambda d: cidn.get_trust(d) is not None,
+                          directory=DISCOVERY_DIR if SEQUENCER_SOCKET else None)
+events = Broadcaster(max_buffer=EVENTS_BUFFER, max_subscribers=EVENTS_MAX_SUBSCRIBERS)
+metrics.gauge("cidn_event_subscribers", lambda: len(events.subscribers), "Open /events streams")
 
-# ---------------- Device Discovery ----------------
-def discover_devices(ip_range="192.168.0.1/24"):
-    devices = []
-    try:
-        arp_req = ARP(pdst=ip_range)
-        broadcast = Ether(dst="ff:ff:ff:ff:ff:ff")
-        arp_req_broadcast = broadcast / arp_req
-        answered = srp(arp_req_broadcast, timeout=2, verbose=False)[0]
 
-        for _, received in answered:
-            devices.append({
-                "ip": received.psrc,
-                "mac": received.hwsrc
-            })
-    except Exception as e:
-        print("[Discovery Error]", e)
+def block_summary(block):
+    """A block as the dashboard shows it: no event bodies, just how many of each kind."""
+    kinds = {}
+    for event in iter_events(block.data):
+        kind = event.get("event")
+        kinds[kind] = kinds.get(kind, 0) + 1
+    return {"index": block.index, "timestamp": block.to_dict()["timestamp"], "hash": block.hash,
+            "prev_hash": block.prev_hash, "events": kinds}
+
+
+def block_update(block):
+    """
+    block_summary plus the device changes the block records, as
+    {device_id: {"trust": ..., "revoked": ...}} (only the fields that
+    changed). "devices" is null when the block changes too many devices,
+    or the whole fleet, to list; clients reload them instead.
+    """
+    update = block_summary(block)
+    devices = {}
+    for event in iter_events(block.data):
+        kind = event.get("event")
+        if kind == "fleet_adjust" or len(devices) > EVENTS_MAX_DEVICES:
+            devices = None
+            break
+        if kind == "register_batch":
+            for device_id in event.get("devices") or ():
+                devices[device_id] = {"trust": event["trust"], "revoked": False}
+            continue
+        device_id = event.get("device_id")
+        if device_id is None:
+            continue
+        if kind == "revoke":
+            devices.setdefault(device_id, {})["revoked"] = True
+            continue
+        value = trust_value(event)
+        if value is not None:
+            change = devices.setdefault(device_id, {})
+            change["trust"] = value
+            if kind == "register":
+                change["revoked"] = False
+    if devices is not None and len(devices) > EVENTS_MAX_DEVICES:
+        devices = None
+    update["devices"] = devices
+    return update
+
+
+def publish_block(block):
+    # runs on whichever thread appended (or, on a replica, picked up) the block
+    if events:
+        events.publish("block", block_update(block), id=block.index)
+
+
+blockchain.subscribe(publish_block)
+
+
+def queue_full():
+    return JSONResponse(content={"error": "Ingestion queue full, retry later"},
+                        status_code=429, headers={"Retry-After": "1"})
+
+
+@app.exception_handler(ConnectionError)
+async def sequencer_unavailable(request: Request, exc: ConnectionError):
+    # multi-worker mode: the sequencer connection dropped (see SequencerClient)
+    return JSONResponse(content={"error": f"Ledger writer unavailable: {exc}"},
+                        status_code=503, headers={"Retry-After": "5"})
+
+
+async def follow_ledger():
+    while True:
+        await run_in_threadpool(blockchain.refresh)
+        await asyncio.sleep(REPLICA_POLL_INTERVAL)
+
+
+if SEQUENCER_SOCKET:
+    @app.middleware("http")
+    async def read_latest(request: Request, call_next):
+        # catch up with the sequencer's ledger so reads see writes made
+        # through any worker, not just the last poll
+        if request.method == "GET":
+            blockchain.refresh()
+        return await call_next(request)
+
+
+def close_events_on_exit():
+    """
+    uvicorn waits for open responses before it runs the shutdown handlers,
+    and /events streams never finish on their own; end them as soon as the
+    server is told to exit, then let its own handler run.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+        if callable(previous):
+            def handler(signum, frame, previous=previous):
+                events.close()
+                previous(signum, frame)
+            signal.signal(sig, handler)
+
+
+@app.on_event("startup")
+async def start_pipeline():
+    await events.start()
+    close_events_on_exit()
+    await pipeline.start()
+    if SEQUENCER_SOCKET:
+        app.state.follower = asyncio.create_task(follow_ledger())
+    else:
+        app.state.snapshots = open_snapshots()
+        app.state.background = start_background(pipeline, cidn, app.state.snapshots)
+
 
-    return devices
+@app.on_event("shutdown")
+async def close_ledger():
+    await discovery.close()
+    if SEQUENCER_SOCKET:
+        app.state.follower.cancel()
+    else:
+        for task in app.state.background:
+            task.cancel()
+    await pipeline.stop()
+    if not SEQUENCER_SOCKET:
+        final_snapshot(cidn, app.state.snapshots)
+    if builder is not None:
+        builder.close()
+    blockchain.close()
+    if ca is not None:
+        ca.close()
+    metrics.stop_logging()
 
 # ---------------- Endpoints ----------------
 
+# State-changing endpoints hand their work to the ingest pipeline (or the
+# sequencer), whose single writer applies it in order; read endpoints serve
+# the current state directly.
+
 @app.post("/register")
-def register_device(payload: dict):
+async def register_device(payload: dict):
     device_id = payload.get("device_id")
     public_key = payload.get("public_key", "fake_public_key")
 
     if not device_id:
         return JSONResponse(content={"error": "Missing device_id"}, status_code=400)
 
-    cert = ca.register_device(device_id, public_key)
-    cidn.add_device(device_id)
+    try:
+        cert = await pipeline.register(device_id, public_key)
+    except QueueFull:
+        return queue_full()
     return {"certificate": cert, "public_key": public_key}
 
 
+@app.post("/register/batch")
+async def register_devices(payload: dict):
+    """
+    Register many devices at once: {"devices": [{"device_id", "public_key"}, ...]}.
+    Certificates are persisted once and a single ledger entry is written.
+    """
+    entries = payload.get("devices") or []
+    if not isinstance(entries, list) or not all(isinstance(e, dict) for e in entries):
+        return JSONResponse(content={"error": "Expected a list of device objects"}, status_code=400)
+    pairs = []
+    for entry in entries:
+        device_id = entry.get("device_id")
+        if not device_id:
+            return JSONResponse(content={"error": "Missing device_id"}, status_code=400)
+        pairs.append((device_id, entry.get("public_key", "fake_public_key")))
+
+    try:
+        certs = await pipeline.register_many(pairs)
+    except QueueFull:
+        return queue_full()
+    return {"registered": len(certs), "certificates": certs}
+
+
 @app.post("/alert")
-def receive_alert(alert: dict):
-    result = cidn.receive_alert(alert)
-    return {"status": "ok"} if result else {"status": "rejected"}
+async def receive_alert(alert: dict, wait: bool = False):
+    """
+    Queue an alert. Returns 202 straight away, or with ?wait=true the alert's
+    status once its ledger entry is on the chain.
+    """
+    try:
+        statuses = await pipeline.alerts([alert], wait=wait)
+    except QueueFull:
+        return queue_full()
+    if statuses is None:
+        return JSONResponse(content={"status": "queued"}, status_code=202)
+    return {"status": statuses[0]}
+
+
+@app.post("/alerts/batch")
+async def receive_alerts(request: Request, wait: bool = False):
+    """
+    Ingest many alerts in one request. The body is either a JSON array of
+    alerts (or {"alerts": [...]}) or NDJSON with one alert per line
+    (Content-Type: application/x-ndjson). Returns 202 once queued, or with
+    ?wait=true a status per alert once committed; "coalesced" alerts were
+    merged into an earlier one and are counted apart from the rejected.
+    """
+    body = await request.body()
+    try:
+        with metrics.timed("parse"):
+            if "ndjson" in request.headers.get("content-type", ""):
+                alerts = [json.loads(line) for line in body.splitlines() if line.strip()]
+            else:
+                alerts = json.loads(body)
+                if isinstance(alerts, dict):
+                    alerts = alerts.get("alerts", [])
+    except ValueError as e:
+        return JSONResponse(content={"error": f"Invalid body: {e}"}, status_code=400)
+    if not isinstance(alerts, list) or not all(isinstance(a, dict) for a in alerts):
+        return JSONResponse(content={"error": "Expected a list of alert objects"}, status_code=400)
+
+    try:
+        statuses = await pipeline.alerts(alerts, wait=wait)
+    except QueueFull:
+        return queue_full()
+    if statuses is None:
+        return JSONResponse(content={"queued": len(alerts)}, status_code=202)
+    accepted = statuses.count("ok")
+    coalesced = statuses.count("coalesced")  # merged into an earlier alert, not refused
+    return {"accepted": accepted, "coalesced": coalesced,
+            "rejected": len(statuses) - accepted - coalesced, "results": statuses}
 
 
 @app.get("/devices")
-def list_devices():
-    return cidn.list_devices()
+def list_devices(offset: int = 0, limit: int = DEVICES_PAGE_SIZE):
+    devices = cidn.list_devices(max(0, offset), max(1, min(limit, DEVICES_MAX_PAGE)))
+    return JSONResponse(content=devices)
+
+
+@app.get("/fleet/stats")
+def fleet_stats(bins: int = 10):
+    """Fleet-wide trust summary: counts, mean, percentiles and a histogram."""
+    return cidn.fleet_stats(max(1, min(bins, 100)))
+
+
+@app.get("/fleet/lowest")
+def fleet_lowest(k: int = 10, include_revoked: bool = False):
+    return cidn.trust.lowest(max(1, min(k, DEVICES_MAX_PAGE)), include_revoked)
+
+
+@app.post("/fleet/adjust")
+async def fleet_adjust(payload: dict):
+    """
+    Apply a trust delta to many devices at once:
+    {"delta": 0.05, "device_ids": [...] (omit for the whole fleet), "reason": "..."}.
+    """
+    delta = payload.get("delta")
+    if not isinstance(delta, (int, float)):
+        return JSONResponse(content={"error": "Missing numeric delta"}, status_code=400)
+    try:
+        changed = await pipeline.adjust_fleet(delta, payload.get("device_ids"), payload.get("reason", ""))
+    except QueueFull:
+        return queue_full()
+    return {"changed": changed}
+
+
+@app.post("/peer/feedback")
+async def peer_feedback(request: Request):
+    """
+    Devices' observations of each other: one report {"device_id": rater,
+    "ratings": [{"device_id": peer, "positive": 3, "negative": 0}, ...]},
+    a list of them, or {"reports": [...]}. Returns a status per report.
+    """
+    try:
+        reports = json.loads(await request.body())
+    except ValueError as e:
+        return JSONResponse(content={"error": f"Invalid body: {e}"}, status_code=400)
+    if isinstance(reports, dict):
+        reports = reports["reports"] if "reports" in reports else [reports]
+    if not isinstance(reports, list) or not all(isinstance(r, dict) for r in reports):
+        return JSONResponse(content={"error": "Expected feedback report objects"}, status_code=400)
+    try:
+        statuses = await pipeline.feedback(reports)
+    except QueueFull:
+        return queue_full()
+    return {"accepted": statuses.count("ok"), "results": statuses}
+
+
+@app.get("/peer/trust/{device_id}")
+def get_peer_trust(device_id: str):
+    """Own trust, EigenTrust peer trust and their blend; may recompute the peer scores first."""
+    result = cidn.peer_trust(device_id)
+    if result is None:
+        return JSONResponse(content={"error": "Device not found"}, status_code=404)
+    return result
+
+
+@app.get("/peer/stats")
+def get_peer_stats():
+    return {"edges": len(cidn.peers), **cidn.peers.stats()}
 
 
 @app.get("/trust/{device_id}")
@@ -69,49 +358,216 @@ def get_trust(device_id: str):
 
 
 @app.get("/ledger")
-def get_ledger():
-    return [block.to_dict() for block in cidn.blockchain.chain]
+def get_ledger(cursor: int = 0, limit: int = LEDGER_PAGE_SIZE, device_id: str = None,
+               event: str = None, since: float = None, until: float = None):
+    """
+    One page of blocks starting at index `cursor`. Pass the returned
+    `next_cursor` to get the next page; it is null on the last page.
+
+    With any of device_id / event / since / until (epoch seconds) the page
+    holds the matching events instead, looked up through the ledger index.
+    """
+    cursor = max(0, cursor)
+    limit = max(1, min(limit, LEDGER_MAX_PAGE))
+    if device_id is not None or event is not None or since is not None or until is not None:
+        events, next_cursor = ledger_index.query(device_id, event, since, until, cursor, limit)
+        return {"events": events, "next_cursor": next_cursor}
+
+    chain = cidn.blockchain.chain
+    height = len(chain)
+    end = min(cursor + limit, height)
+    blocks = b",".join(block.to_json() for block in chain[cursor:end])
+    next_cursor = str(end).encode() if end < height else b"null"
+    body = b'{"blocks":[' + blocks + b'],"next_cursor":' + next_cursor + b"}"
+    return Response(content=body, media_type="application/json")
+
+
+@app.get("/trust/{device_id}/history")
+def get_trust_history(device_id: str, since: float = None, until: float = None, bucket: float = None):
+    """Trust over time for a device; `bucket` downsamples to one point per N seconds."""
+    if device_id not in ledger_index.by_device:
+        return JSONResponse(content={"error": "Device not found"}, status_code=404)
+    history = ledger_index.trust_history(device_id, since, until, bucket)
+    return {"device_id": device_id, "history": history}
+
+
+@app.get("/ledger/export")
+def export_ledger():
+    """Stream the whole ledger as NDJSON, one block per line."""
+    chain = cidn.blockchain.chain
+    height = len(chain)
+
+    def lines():
+        for i in range(height):
+            yield chain[i].to_json() + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/ledger/archives")
+def get_ledger_archives():
+    """Archived block ranges with their anchors. Their blocks are still served by /ledger."""
+    return {"archives": cidn.blockchain.archives()}
+
+
+@app.get("/proof/{block_index}/{leaf_index}")
+def get_proof(block_index: int, leaf_index: int):
+    """Merkle inclusion proof for one event inside a batch block."""
+    if not 0 <= block_index < len(cidn.blockchain.chain):
+        return JSONResponse(content={"error": "Block not found"}, status_code=404)
+    proof = inclusion_proof(cidn.blockchain.chain, block_index, leaf_index)
+    if proof is None:
+        return JSONResponse(content={"error": "Event not found in a batch block"}, status_code=404)
+    return proof
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Stage latencies, alert counters and ledger/CA gauges in Prometheus text format."""
+    if SEQUENCER_SOCKET:
+        # the writer-side metrics live in the sequencer; label each process's series
+        text = metrics.render((await pipeline.metrics(), {"process": "sequencer"}),
+                              (metrics.snapshot(), {"process": f"worker-{os.getpid()}"}))
+    else:
+        text = metrics.render()
+    return Response(content=text, media_type="text/plain; version=0.0.4")
+
+
+def dashboard_state(blocks, devices):
+    chain = cidn.blockchain.chain
+    newest = chain[-max(1, min(blocks, LEDGER_MAX_PAGE)):]
+    return {
+        "height": len(chain),
+        "devices": cidn.list_devices(limit=max(1, min(devices, DEVICES_MAX_PAGE))),
+        "ledger": [block_summary(block) for block in reversed(newest)],  # newest first
+    }
 
 
 @app.get("/dashboard", response_class=HTMLResponse)
-def dashboard(request: Request):
-    devices = cidn.list_devices()
-    ledger = [block.to_dict() for block in cidn.blockchain.chain][::-1]  # newest first
-    return templates.TemplateResponse("dashboard.html", {
-        "request": request,
-        "devices": devices,
-        "ledger": ledger
-    })
+def dashboard(request: Request, blocks: int = DASHBOARD_BLOCKS, devices: int = DASHBOARD_DEVICES):
+    """
+    The newest blocks and the first page of devices; the page then follows
+    /events and updates itself, so it only needs loading once.
+    """
+    state = dashboard_state(blocks, devices)
+    return templates.TemplateResponse(request, "dashboard.html", state)
+
+
+@app.get("/dashboard/state")
+def get_dashboard_state(blocks: int = DASHBOARD_BLOCKS, devices: int = DASHBOARD_DEVICES):
+    """What /dashboard renders, as JSON; dashboards reload it after a "resync" event."""
+    return dashboard_state(blocks, devices)
+
+
+@app.get("/events")
+def stream_events(request: Request):
+    """
+    Server-sent events: a "block" event (see block_update) for every block
+    appended from now on, with the block index as the event id. A client
+    reconnecting with Last-Event-ID first gets the blocks it missed, or a
+    "resync" event if that is more than a ledger page; "resync" also
+    replaces the events of a client that falls too far behind.
+    """
+    try:
+        sub = events.subscribe()
+    except BroadcasterFull:
+        return JSONResponse(content={"error": "Too many event subscribers"},
+                            status_code=503, headers={"Retry-After": "5"})
+    first = b""
+    last_id = request.headers.get("last-event-id", "")
+    if last_id.isdigit():
+        chain = cidn.blockchain.chain
+        height = len(chain)
+        start = int(last_id) + 1
+        if height - start > LEDGER_MAX_PAGE:
+            first = encode_event("resync", {})
+        else:
+            # subscribed first, so live events may repeat some of these; clients skip
+            # blocks they already have
+            first = b"".join(encode_event("block", block_update(chain[i]), id=i) for i in range(start, height))
+    return StreamingResponse(events.stream(sub, first), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def start_discovery(ip_range, options):
+    try:
+        return discovery.start(ip_range, **options), None
+    except (ValueError, TypeError) as e:
+        return None, JSONResponse(content={"error": str(e)}, status_code=400)
+    except RuntimeError as e:
+        return None, JSONResponse(content={"error": str(e)}, status_code=429, headers={"Retry-After": "5"})
+
+
+@app.post("/discover")
+async def start_discover(payload: dict):
+    """
+    Start scanning a range in the background:
+    {"ip_range": "10.0.0.0/16", "methods": ["arp", "icmp", "tcp"], "ports": [80, 443, 22],
+    "timeout": 0.5, "rate": 5000, "count_refused": true} (all but ip_range optional).
+    Hosts are registered as they are found. Returns the job id right away.
+    """
+    options = {key: payload[key] for key in DISCOVERY_OPTIONS if key in payload}
+    job, error = start_discovery(payload.get("ip_range", "192.168.0.1/24"), options)
+    if error is not None:
+        return error
+    return JSONResponse(content={"job_id": job.id, "status": job.status,
+                                 "status_url": f"/discover/{job.id}",
+                                 "results_url": f"/discover/{job.id}/results"}, status_code=202)
 
 
 @app.get("/discover")
-def auto_discover(ip_range: str = "192.168.0.1/24"):
+async def auto_discover(ip_range: str = "192.168.0.1/24"):
     """
-    Discover devices and auto-register them in CIDN.
+    Discover devices and auto-register them in CIDN, waiting for the scan
+    to finish. Prefer POST /discover for large ranges.
     """
-    discovered = discover_devices(ip_range)
-    registered = []
+    job, error = start_discovery(ip_range, {})
+    if error is not None:
+        return error
+    await asyncio.shield(job.task)
+    return {"discovered": [{"ip": h["ip"], "mac": h["mac"]} for h in job.hosts],
+            "registered": job.registered}
+
+
+@app.get("/discover/{job_id}")
+def discover_status(job_id: str):
+    """Progress of a discovery job: stage, hosts probed and found, devices registered."""
+    status = discovery.status(job_id)
+    if status is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return status
 
-    for d in discovered:
-        mac = d["mac"]
-        if not ca.has_device(mac):
-            cert = ca.register_device(mac, "fake_public_key")
-            cidn.add_device(mac)
-            registered.append(cert)
 
-    return {"discovered": discovered, "registered": registered}
+@app.get("/discover/{job_id}/results")
+def discover_results(job_id: str, offset: int = 0, limit: int = DISCOVERY_PAGE_SIZE):
+    """Hosts a job has found so far, in the order they were found."""
+    offset = max(0, offset)
+    hosts = discovery.results(job_id, offset, max(1, min(limit, DEVICES_MAX_PAGE)))
+    if hosts is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return {"job_id": job_id, "hosts": hosts, "offset": offset}
+
+
+@app.delete("/discover/{job_id}")
+def cancel_discover(job_id: str):
+    if not discovery.cancel(job_id):
+        return JSONResponse(content={"error": "No running job with that id on this worker"}, status_code=404)
+    return {"job_id": job_id, "status": "cancelling"}
 
 
 # ---------------- Test Logging Endpoint ----------------
 @app.post("/log_test")
-def log_test(payload: dict):
+async def log_test(payload: dict):
     """
     Allows test_cases.py to log results directly into the blockchain.
     These will then appear in the dashboard under Ledger.
     """
-    cidn.blockchain.add_block({
-        "event": "test_result",
-        "test": payload.get("test"),
-        "status": payload.get("status")
-    })
+    try:
+        await pipeline.record_event({
+            "event": "test_result",
+            "test": payload.get("test"),
+            "status": payload.get("status")
+        })
+    except QueueFull:
+        return queue_full()
     return {"status": "logged"}
@@ -1,11 +1,53 @@
 # device_client.py
-import requests
 import socket
 import time
 import json
+import base64
+import os
 from datetime import datetime
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from cidn_client import CIDNClient, CIDNUnavailable
 
 SERVER_URL = "http://127.0.0.1:8000"  # change to coordinator IP for network runs
+KEY_FILE = "device_key.pem"
+SPOOL_FILE = "device_alerts.spool"  # alerts kept here while the server is unreachable
+
+client = CIDNClient(SERVER_URL, spool_path=SPOOL_FILE)
+
+def load_or_create_key(path=KEY_FILE):
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return serialization.load_pem_private_key(f.read(), password=None)
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return key
+
+def public_key_pem(private_key):
+    return private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+
+def register(device_id, private_key):
+    try:
+        r = client.request("POST", "/register",
+                           json={"device_id": device_id, "public_key": public_key_pem(private_key)})
+        print("Register response:", r.status_code)
+    except CIDNUnavailable as e:
+        print("Failed to register:", e)
+
+def sign_alert(payload, private_key):
+    """Add a "signature" field; the encoding must match cidn.canonical_alert."""
+    body = {k: v for k, v in payload.items() if k != "signature"}
+    message = json.dumps(body, sort_keys=True, separators=(",", ":")).encode()
+    signature = private_key.sign(
+        message,
+        padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+        hashes.SHA256())
+    payload["signature"] = base64.b64encode(signature).decode()
+    return payload
 
 def make_alert(device_id, alert_type="benign", details=None, metrics=None):
     payload = {
@@ -20,20 +62,23 @@ def make_alert(device_id, alert_type="benign", details=None, metrics=None):
 
 def send_alert(payload):
     try:
-        r = requests.post(f"{SERVER_URL}/alert", json=payload, timeout=5)
-        print("Server response:", r.status_code, r.json())
-    except Exception as e:
-        print("Failed to send alert:", e)
+        print("Server response:", client.send_alert(payload, wait=True))
+    except CIDNUnavailable as e:
+        client.queue_alert(payload)  # spooled until the server is back
+        print("Failed to send alert, queued for retry:", e)
 
 def demo():
     dev_id = socket.gethostname()
+    key = load_or_create_key()
+    register(dev_id, key)
     # benign alert
     a1 = make_alert(dev_id, "benign", {"msg": "normal traffic"}, {"packets_sent": 120, "packets_failed": 1})
-    send_alert(a1)
+    send_alert(sign_alert(a1, key))
     time.sleep(1)
     # suspicious scan
     a2 = make_alert(dev_id, "scan", {"msg": "port scan"}, {"scan_count": 40, "packets_sent": 200, "packets_failed": 10})
-    send_alert(a2)
+    send_alert(sign_alert(a2, key))
+    client.close()
 
 if __name__ == "__main__":
     demo()
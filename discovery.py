@@ -0,0 +1,511 @@
+# discovery.py
+"""
+Concurrent network discovery, run as background jobs.
+
+    engine = DiscoveryEngine()
+    hosts = await engine.scan("192.168.0.0/24")
+
+    jobs = DiscoveryJobs(register=pipeline.register_many)
+    job = jobs.start("10.0.0.0/16")
+    jobs.status(job.id)
+
+A scan runs its methods in order, each probing only the hosts the ones
+before it did not find:
+
+  arp   one scapy ARP sweep (root only, ranges up to ARP_MAX_HOSTS); finds
+        on-link hosts and their MACs
+  icmp  echo requests from a single raw (root) or unprivileged ping socket,
+        paced at `rate` packets/s, replies collected as they arrive
+  tcp   connects to a few ports per host with up to `concurrency` sockets in
+        flight; a refused connection means the host is up
+
+Methods the process is not permitted to use are skipped. Nothing spawns a
+process per address and nothing blocks the event loop.
+"""
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import resource
+import socket
+import struct
+import time
+import uuid
+
+from ingest import QueueFull
+
+logger = logging.getLogger("cidn.discovery")
+
+METHODS = ("arp", "icmp", "tcp")
+TCP_PORTS = (80, 443, 22)
+ARP_MAX_HOSTS = 4096            # larger ranges skip ARP; scapy builds one packet per address
+MAX_HOSTS = 65536               # largest range a scan accepts (a /16)
+FD_RESERVE = 256                # descriptors left for everything else when raising the limit
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_HEADER = struct.Struct("!BBHHH")
+ICMP_PAYLOAD = b"cidn-discovery"
+ICMP_RCVBUF = 4 * 1024 * 1024
+
+
+def targets(network):
+    """Addresses to scan: a CIDR string, or an iterable of addresses."""
+    if isinstance(network, str):
+        net = ipaddress.ip_network(network, strict=False)
+        if net.version != 4:
+            raise ValueError("Only IPv4 ranges can be scanned")
+        if net.num_addresses > MAX_HOSTS + 2:
+            raise ValueError(f"{network} has more than {MAX_HOSTS} addresses")
+        return [str(ip) for ip in net.hosts()]
+    return [str(ipaddress.IPv4Address(ip)) for ip in network]
+
+
+def raise_fd_limit(wanted):
+    """Raise the soft open-file limit towards `wanted`; returns the limit now in effect."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted and soft != resource.RLIM_INFINITY:
+        soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft
+
+
+# ---- ICMP ----
+def icmp_checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def echo_request(ident, seq):
+    header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = icmp_checksum(header + ICMP_PAYLOAD)
+    return ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + ICMP_PAYLOAD
+
+
+def open_icmp_socket():
+    """(socket, is_raw) for sending echo requests, or (None, False) if ICMP is not permitted."""
+    for kind, raw in ((socket.SOCK_RAW, True), (socket.SOCK_DGRAM, False)):
+        try:
+            sock = socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+        sock.setblocking(False)
+        try:  # replies arrive in bursts while the sweep is sending
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ICMP_RCVBUF)
+        except OSError:
+            pass
+        return sock, raw
+    return None, False
+
+
+# ---- progress ----
+class ScanProgress:
+    """Counters a running scan updates; read by the job endpoints."""
+
+    def __init__(self):
+        self.total = 0
+        self.stage = None
+        self.stage_total = 0
+        self.probed = 0
+        self.found = 0
+        self.skipped = []   # methods that were not permitted or not applicable
+
+    def begin(self, stage, n):
+        self.stage = stage
+        self.stage_total = n
+        self.probed = 0
+
+    def to_dict(self):
+        return {"total": self.total, "stage": self.stage, "stage_total": self.stage_total,
+                "probed": self.probed, "found": self.found, "skipped": list(self.skipped)}
+
+
+# ---- engine ----
+class DiscoveryEngine:
+    """
+    Probes an IPv4 range with bounded asyncio concurrency. `timeout` is how
+    long a probe waits for an answer; `rate` paces ICMP echo requests and
+    `concurrency` caps the TCP sockets in flight. With count_refused=False
+    a TCP probe only counts hosts that accept the connection.
+    """
+
+    def __init__(self, methods=METHODS, ports=TCP_PORTS, timeout=0.5, concurrency=4096,
+                 rate=5000, arp_timeout=2.0, count_refused=True):
+        if isinstance(methods, str) or not isinstance(methods, (list, tuple)):
+            raise ValueError("methods must be a list of method names")
+        unknown = set(methods) - set(METHODS)
+        if unknown:
+            raise ValueError(f"Unknown discovery methods: {sorted(unknown)}")
+        if isinstance(ports, str) or not isinstance(ports, (list, tuple)) or not ports \
+                or not all(type(p) is int and 1 <= p <= 65535 for p in ports):
+            raise ValueError("ports must be a non-empty list of port numbers from 1 to 65535")
+        for name, value in (("timeout", timeout), ("rate", rate), ("arp_timeout", arp_timeout)):
+            if type(value) not in (int, float) or not value > 0:
+                raise ValueError(f"{name} must be a number > 0")
+        if type(concurrency) is not int or concurrency < 1:
+            raise ValueError("concurrency must be an integer >= 1")
+        if not isinstance(count_refused, bool):
+            raise ValueError("count_refused must be true or false")
+        self.methods = tuple(methods)
+        self.ports = tuple(ports)
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.rate = rate
+        self.arp_timeout = arp_timeout
+        self.count_refused = count_refused
+
+    async def scan(self, network, on_found=None, progress=None):
+        """
+        Scan `network` (see targets()) and return the live hosts as
+        [{"ip", "mac", "method", "rtt_ms"}]. on_found(host) is called as each
+        one is found.
+        """
+        hosts = targets(network)
+        progress = progress or ScanProgress()
+        progress.total = len(hosts)
+        found = {}
+
+        def report(ip, method, mac=None, rtt=None):
+            if ip in found:
+                return
+            host = found[ip] = {"ip": ip, "mac": mac, "method": method,
+                                "rtt_ms": None if rtt is None else round(rtt * 1000, 2)}
+            progress.found += 1
+            if on_found is not None:
+                on_found(host)
+
+        probes = {"arp": self._arp, "icmp": self._icmp, "tcp": self._tcp}
+        for method in self.methods:
+            pending = [ip for ip in hosts if ip not in found]
+            if not pending:
+                break
+            progress.begin(method, len(pending))
+            if not await probes[method](pending, report, progress):
+                progress.skipped.append(method)
+        return list(found.values())
+
+    async def _arp(self, hosts, report, progress):
+        if len(hosts) > ARP_MAX_HOSTS or os.geteuid() != 0:
+            return False
+        try:
+            from scapy.all import ARP, Ether, srp
+        except ImportError:
+            return False
+
+        def sweep():
+            answered = srp(Ether(dst="ff:ff:ff:ff:ff:ff") / ARP(pdst=hosts),
+                           timeout=self.arp_timeout, verbose=False)[0]
+            return [(received.psrc, received.hwsrc) for _, received in answered]
+
+        try:
+            answers = await asyncio.get_running_loop().run_in_executor(None, sweep)
+        except Exception as e:
+            logger.warning(f"[Discovery] ⚠️ ARP sweep unavailable: {e}")
+            return False
+        wanted = set(hosts)
+        for ip, mac in answers:
+            if ip in wanted:
+                report(ip, "arp", mac=mac)
+        progress.probed = len(hosts)
+        return True
+
+    async def _icmp(self, hosts, report, progress):
+        sock, raw = open_icmp_socket()
+        if sock is None:
+            return False
+        loop = asyncio.get_running_loop()
+        ident = os.getpid() & 0xFFFF
+        waiting = set(hosts)
+        sent_at = {}
+
+        def on_readable():
+            while True:
+                try:
+                    data, (addr, _) = sock.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    return
+                if raw:
+                    data = data[(data[0] & 0x0F) * 4:]  # raw sockets deliver the IP header too
+                if len(data) < ICMP_HEADER.size or data[0] != ICMP_ECHO_REPLY:
+                    continue
+                # a ping socket only sees its own replies; a raw one sees every reply
+                if raw and ICMP_HEADER.unpack_from(data)[3] != ident:
+                    continue
+                if addr in waiting:
+                    waiting.discard(addr)
+                    report(addr, "icmp", rtt=time.perf_counter() - sent_at[addr])
+
+        loop.add_reader(sock.fileno(), on_readable)
+        try:
+            start = time.perf_counter()
+            for seq, ip in enumerate(hosts):
+                sent_at[ip] = time.perf_counter()
+                try:
+                    await loop.sock_sendto(sock, echo_request(ident, seq & 0xFFFF), (ip, 0))
+                except OSError:
+                    pass  # unreachable or broadcast address
+                progress.probed = seq + 1
+                ahead = start + (seq + 1) / self.rate - time.perf_counter()
+                if ahead > 0.002:
+                    await asyncio.sleep(ahead)
+            deadline = time.perf_counter() + self.timeout
+            while waiting and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+        finally:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+        return True
+
+    async def _tcp(self, hosts, report, progress):
+        if not self.ports:
+            return False
+        limit = raise_fd_limit(self.concurrency + FD_RESERVE)
+        sockets = max(len(self.ports), min(self.concurrency, limit - FD_RESERVE))
+        loop = asyncio.get_running_loop()
+
+        async def connect(ip, port):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), self.timeout)
+                return True
+            except ConnectionRefusedError:
+                return self.count_refused
+            except (OSError, asyncio.TimeoutError):
+                return False
+            finally:
+                sock.close()
+
+        async def probe(ip):
+            start = time.perf_counter()
+            pending = {asyncio.ensure_future(connect(ip, port)) for port in self.ports}
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    if any(task.result() for task in done):
+                        report(ip, "tcp", rtt=time.perf_counter() - start)
+                        return
+            finally:
+                for task in pending:
+                    task.cancel()
+
+        queue = iter(hosts)
+
+        async def worker():
+            for ip in queue:  # shared iterator: each host goes to one worker
+                await probe(ip)
+                progress.probed += 1
+
+        await asyncio.gather(*(worker() for _ in range(min(len(hosts), sockets // len(self.ports)))))
+        return True
+
+
+# ---- jobs ----
+class DiscoveryJob:
+    def __init__(self, network, engine):
+        self.id = uuid.uuid4().hex[:12]
+        self.network = network
+        self.engine = engine
+        self.status = "running"
+        self.progress = ScanProgress()
+        self.hosts = []
+        self.registered = 0
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.task = None
+
+    def to_dict(self):
+        end = self.finished or time.time()
+        return {"job_id": self.id, "network": self.network, "status": self.status,
+                "started": self.started, "finished": self.finished,
+                "elapsed": round(end - self.started, 3), "registered": self.registered,
+                "error": self.error, **self.progress.to_dict()}
+
+
+class DiscoveryJobs:
+    """
+    Runs discovery scans as asyncio tasks and registers what they find
+    while they run, in batches of up to `register_batch` hosts or every
+    `register_interval` seconds. Hosts are registered under their MAC when
+    ARP found one, else their IP.
+
+    `register(pairs)` is an async callable like IngestPipeline.register_many
+    and `known(device_id)` skips devices that are already registered. With a
+    `directory`, job status and results are also written there, so other
+    server workers can answer for jobs they did not start.
+    """
+
+    def __init__(self, register=None, known=None, directory=None, keep=20, max_running=2,
+                 register_batch=256, register_interval=1.0, publish_interval=1.0, **engine_options):
+        self.register = register
+        self.known = known
+        self.directory = directory
+        self.keep = keep
+        self.max_running = max_running
+        self.register_batch = register_batch
+        self.register_interval = register_interval
+        self.publish_interval = publish_interval
+        self.engine_options = engine_options
+        self.jobs = {}  # job id -> DiscoveryJob, oldest first
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self, network, **options):
+        """
+        Start scanning `network` and return the job. Raises ValueError for a
+        bad range or options, RuntimeError when max_running jobs are running.
+        """
+        targets(network)  # validate before accepting the job
+        engine = DiscoveryEngine(**{**self.engine_options, **options})
+        if sum(job.status == "running" for job in self.jobs.values()) >= self.max_running:
+            raise RuntimeError(f"{self.max_running} discovery jobs are already running")
+        job = DiscoveryJob(network, engine)
+        self.jobs[job.id] = job
+        self._prune()
+        job.task = asyncio.create_task(self._run(job))
+        print(f"[Discovery] 🔍 Job {job.id} scanning {network}")
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.task is None or job.task.done():
+            return False
+        job.task.cancel()
+        return True
+
+    def status(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        saved = self._load(job_id)
+        return saved and saved["status"]
+
+    def results(self, job_id, offset=0, limit=None):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            hosts = job.hosts
+        else:
+            saved = self._load(job_id)
+            if saved is None:
+                return None
+            hosts = saved["hosts"]
+        end = len(hosts) if limit is None else offset + limit
+        return hosts[offset:end]
+
+    async def close(self):
+        """Cancel running jobs and wait for them to stop."""
+        tasks = [job.task for job in self.jobs.values() if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # ---- running ----
+    async def _run(self, job):
+        found = asyncio.Queue()
+
+        def on_found(host):
+            job.hosts.append(host)
+            found.put_nowait(host)
+
+        registrar = asyncio.create_task(self._register_found(job, found))
+        publisher = asyncio.create_task(self._publish_loop(job)) if self.directory is not None else None
+        try:
+            await job.engine.scan(job.network, on_found=on_found, progress=job.progress)
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except Exception as e:
+            logger.exception(f"[Discovery] ❌ Job {job.id} failed")
+            job.status, job.error = "failed", str(e)
+        found.put_nowait(None)
+        try:
+            await registrar
+        except asyncio.CancelledError:
+            registrar.cancel()
+        job.finished = time.time()
+        if publisher is not None:
+            publisher.cancel()
+        self._save(job)
+        print(f"[Discovery] ✅ Job {job.id} {job.status}: {len(job.hosts)} hosts up of "
+              f"{job.progress.total}, {job.registered} registered in {job.finished - job.started:.1f}s")
+
+    async def _register_found(self, job, found):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = loop.time() + self.register_interval
+        while True:
+            try:
+                host = await asyncio.wait_for(found.get(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                host = False
+            if host is None:
+                break
+            if host:
+                batch.append(host["mac"] or host["ip"])
+            if len(batch) >= self.register_batch or loop.time() >= deadline:
+                batch = await self._register_batch(job, batch)
+                deadline = loop.time() + self.register_interval
+        for _ in range(10):  # the rest, retrying while the ingest queue is full
+            batch = await self._register_batch(job, batch)
+            if not batch:
+                break
+            await asyncio.sleep(1.0)
+
+    async def _register_batch(self, job, batch):
+        """Register a batch; returns what is left to retry."""
+        if self.register is None or not batch:
+            return []
+        device_ids = [d for d in dict.fromkeys(batch) if self.known is None or not self.known(d)]
+        if not device_ids:
+            return []
+        try:
+            await self.register([(device_id, "auto_discovered") for device_id in device_ids])
+        except QueueFull:
+            return device_ids
+        except Exception as e:
+            logger.warning(f"[Discovery] ⚠️ Registering {len(device_ids)} hosts failed: {e}")
+            return []
+        job.registered += len(device_ids)
+        return []
+
+    # ---- shared state for other workers ----
+    async def _publish_loop(self, job):
+        while True:
+            await asyncio.sleep(self.publish_interval)
+            self._save(job)
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"job-{job_id}.json")
+
+    def _save(self, job):
+        if self.directory is None:
+            return
+        path = self._path(job.id)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"status": job.to_dict(), "hosts": job.hosts}, f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    def _load(self, job_id):
+        if self.directory is None or not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(job_id), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status != "running"]
+        for job_id in finished[:max(0, len(self.jobs) - self.keep)]:
+            del self.jobs[job_id]
+            if self.directory is not None and os.path.exists(self._path(job_id)):
+                os.unlink(self._path(job_id))
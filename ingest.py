@@ -0,0 +1,224 @@
+# ingest.py
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("cidn.ingest")
+
+_STOP = object()
+
+
+class QueueFull(Exception):
+    """Raised when accepting more work would exceed the pipeline's queue depth."""
+
+
+class IngestPipeline:
+    """
+    Single-writer ingestion pipeline for the CIDN server.
+
+    Request handlers only enqueue work. One writer task drains the queue in
+    order and runs every state change (trust updates, registrations, ledger
+    appends) on a dedicated writer thread, so changes never interleave and
+    the chain cannot fork. Consecutive alert submissions are merged into one
+    `CIDN.receive_alerts` call of up to `max_batch` alerts.
+
+    Queue depth is counted in alerts (other calls count as one); submissions
+    that would exceed `max_depth` raise QueueFull.
+
+    With an `ingest_guard.IngestGuard`, alerts are rate limited and
+    coalesced before they are queued; the ones it stops get its status
+    instead of CIDN's.
+    """
+
+    def __init__(self, cidn, max_depth=100000, max_batch=5000, guard=None):
+        self.cidn = cidn
+        self.max_depth = max_depth
+        self.max_batch = max_batch
+        self.guard = guard
+        self.depth = 0
+        self._queue = None
+        self._task = None
+        self._drainer = None
+        self._loop = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cidn-writer")
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        if self.guard is not None and self.guard.window > 0:
+            self._drainer = asyncio.create_task(self._drain_windows())
+
+    async def stop(self):
+        """Process everything already queued, then stop the writer."""
+        if self._task is None:
+            return
+        if self._drainer is not None:
+            self._drainer.cancel()
+            self._drainer = None
+        if self.guard is not None:
+            self._enqueue_closed(self.guard.expired(float("inf")))
+        self._queue.put_nowait(_STOP)
+        await self._task
+        self._task = None
+        self._executor.shutdown(wait=True)
+
+    # ---- producers ----
+    def _reserve(self, n):
+        if self._task is None:
+            raise RuntimeError("IngestPipeline is not running")
+        if self.depth + n > self.max_depth:
+            raise QueueFull(f"queue depth {self.depth} + {n} exceeds {self.max_depth}")
+        self.depth += n
+
+    async def alerts(self, alerts, wait=False):
+        """
+        Queue alerts for processing. With wait=True, returns their statuses
+        once their ledger entries are on the chain; otherwise returns None as
+        soon as they are queued.
+        """
+        self._reserve(len(alerts))
+        guarded = None
+        if self.guard is not None:
+            closed, admitted, guarded = self.guard.admit(alerts)
+            self.depth -= len(alerts) - len(admitted)
+            self._enqueue_closed(closed)
+            alerts = admitted
+        future = self._loop.create_future() if wait and alerts else None
+        if alerts:
+            self._queue.put_nowait(("alerts", alerts, future, None))
+        if not wait:
+            return None
+        statuses = await future if future is not None else []
+        if guarded is None:
+            return statuses
+        it = iter(statuses)
+        return [status if status is not None else next(it) for status in guarded]
+
+    def _enqueue_closed(self, closed):
+        """Queue the alerts standing in for closed coalescing windows, with their counts."""
+        if closed:
+            self.depth += len(closed)
+            self._queue.put_nowait(("alerts", [alert for alert, _ in closed], None,
+                                    [count for _, count in closed]))
+
+    async def _drain_windows(self):
+        # windows also close while a device is quiet, not only when its next alert arrives
+        interval = max(0.05, self.guard.window / 2)
+        while True:
+            await asyncio.sleep(interval)
+            self._enqueue_closed(self.guard.expired())
+
+    async def call(self, fn, *args):
+        """Run fn(*args) on the writer, in order with queued alerts, and return its result."""
+        self._reserve(1)
+        future = self._loop.create_future()
+        self._queue.put_nowait(("call", (fn, args), future))
+        return await future
+
+    # Registrations and test logs are rare, so they are committed to the chain
+    # before returning instead of waiting for the block builder's timer.
+    async def register(self, device_id, public_key):
+        return await self.call(self._register, device_id, public_key)
+
+    async def register_many(self, pairs):
+        return await self.call(self._register_many, pairs)
+
+    async def record_event(self, event):
+        await self.call(self._record_event, event)
+
+    async def adjust_fleet(self, delta, device_ids=None, reason=""):
+        return await self.call(self._adjust_fleet, delta, device_ids, reason)
+
+    async def feedback(self, reports):
+        return await self.call(self.cidn.receive_feedback, reports)
+
+    def _register(self, device_id, public_key):
+        cert = self.cidn.ca.register_device(device_id, public_key)
+        self.cidn.add_device(device_id)
+        self._commit()
+        return cert
+
+    def _register_many(self, pairs):
+        certs = self.cidn.ca.register_devices(pairs)
+        self.cidn.add_devices([device_id for device_id, _ in pairs])
+        self._commit()
+        return certs
+
+    def _record_event(self, event):
+        self.cidn.record_event(event)
+        self._commit()
+
+    def _adjust_fleet(self, delta, device_ids, reason):
+        changed = self.cidn.adjust_fleet(delta, device_ids, reason)
+        self._commit()
+        return changed
+
+    def _commit(self):
+        if self.cidn.builder is not None:
+            self.cidn.builder.flush()
+
+    # ---- writer ----
+    async def _run(self):
+        carry = None
+        while True:
+            item = carry if carry is not None else await self._queue.get()
+            carry = None
+            if item is _STOP:
+                break
+            if item[0] == "call":
+                await self._run_call(item)
+                continue
+
+            group = [item]
+            count = len(item[1])
+            while count < self.max_batch and not self._queue.empty():
+                nxt = self._queue.get_nowait()
+                if nxt is _STOP or nxt[0] != "alerts":
+                    carry = nxt
+                    break
+                group.append(nxt)
+                count += len(nxt[1])
+            await self._run_alerts(group, count)
+
+    async def _run_call(self, item):
+        _, (fn, args), future = item
+        try:
+            result = await self._loop.run_in_executor(self._executor, fn, *args)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.depth -= 1
+
+    async def _run_alerts(self, group, count):
+        alerts = [a for _, items, _, _ in group for a in items]
+        counts = None
+        if any(item_counts is not None for _, _, _, item_counts in group):
+            counts = [c for _, items, _, item_counts in group for c in (item_counts or [1] * len(items))]
+        want_commit = any(future is not None for _, _, future, _ in group)
+
+        def work():
+            statuses = self.cidn.receive_alerts(alerts, counts)
+            if want_commit:
+                self._commit()
+            return statuses
+
+        try:
+            statuses = await self._loop.run_in_executor(self._executor, work)
+        except Exception as e:
+            logger.exception("[Ingest] ❌ Failed to process %d alerts", count)
+            for _, _, future, _ in group:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+        else:
+            pos = 0
+            for _, items, future, _ in group:
+                if future is not None and not future.done():
+                    future.set_result(statuses[pos:pos + len(items)])
+                pos += len(items)
+        finally:
+            self.depth -= count
@@ -0,0 +1,138 @@
+# ingest_guard.py
+"""
+Admission control in front of CIDN.receive_alerts.
+
+Every alert submitted to the ingest pipeline goes through three checks, in
+order:
+
+  coalesce   an alert with the same (device, type) as one admitted less than
+             `window` seconds ago is absorbed. When the window closes, the
+             latest absorbed alert is sent on once, carrying how many it
+             stands for, so a flood becomes at most two ledger entries per
+             window. CIDN moves trust by the full count (as many penalties
+             as alerts, see cidn.repeat_delta), so bursting does not delay
+             revocation. Only alerts that need no signature check are
+             coalesced: signed alerts, and every alert when
+             `require_signatures` is set, go on one by one to be verified,
+             so forged alerts cannot inflate a count.
+  device     a token bucket per device (`device_rate` alerts/s, `device_burst`
+             deep). The bucket table is an LRU of at most `max_devices`
+             entries; an evicted device starts again with a full bucket.
+  admission  one fleet-wide token bucket. Under overload the excess alerts
+             of each submission are shed up front instead of growing the
+             writer's queue.
+
+Stopped alerts get the status "coalesced", "rate_limited" or "shed" and
+are counted in cidn_guard_alerts_total. A rate or window of 0 turns that
+check off. The guard runs on the event loop only, so it takes no locks.
+"""
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class IngestGuard:
+    def __init__(self, device_rate=20.0, device_burst=50, max_devices=100000, window=1.0,
+                 admission_rate=50000.0, admission_burst=100000, require_signatures=False,
+                 clock=time.monotonic):
+        self.device_rate = device_rate
+        self.device_burst = device_burst
+        self.max_devices = max_devices
+        self.window = window
+        self.admission_rate = admission_rate
+        self.admission_burst = admission_burst
+        self.require_signatures = require_signatures  # as CIDN's: then nothing is coalesced
+        self.clock = clock
+        self.buckets = OrderedDict()  # device_id -> [tokens, last refill], least recently used first
+        # (device_id, type) -> [closes_at, absorbed count, latest absorbed alert]. Windows all
+        # last `window` seconds, so insertion order is also closing order.
+        self.windows = {}
+        self.admission = [admission_burst, clock()]
+        self.counters = {"coalesced": 0, "rate_limited": 0, "shed": 0}
+
+    def _take(self, bucket, rate, burst, now):
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def _device_bucket(self, device_id):
+        bucket = self.buckets.get(device_id)
+        if bucket is None:
+            bucket = self.buckets[device_id] = [self.device_burst, self.clock()]
+            if len(self.buckets) > self.max_devices:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(device_id)
+        return bucket
+
+    def admit(self, alerts):
+        """
+        (closed, admitted alerts, statuses). `closed` is expired() at this
+        moment and must be processed before the admitted alerts; statuses
+        has one entry per input alert, None for the admitted ones and the
+        reason for the others.
+        """
+        now = self.clock()
+        closed = self.expired(now)
+        admitted = []
+        statuses = [None] * len(alerts)
+        for pos, alert in enumerate(alerts):
+            device_id = alert.get("device_id")
+            if not isinstance(device_id, str):
+                device_id = None  # malformed; CIDN rejects it, but it still needs a hashable key
+            event_type = alert.get("type")
+            key = (device_id, event_type if isinstance(event_type, str) else None)
+            coalesce = self.window > 0 and not self.require_signatures and alert.get("signature") is None
+
+            if coalesce:
+                state = self.windows.get(key)
+                if state is not None and state[0] > now:
+                    state[1] += 1
+                    state[2] = alert
+                    statuses[pos] = "coalesced"
+                    continue
+            if self.device_rate > 0 and \
+                    not self._take(self._device_bucket(device_id), self.device_rate, self.device_burst, now):
+                statuses[pos] = "rate_limited"
+                continue
+            if self.admission_rate > 0 and \
+                    not self._take(self.admission, self.admission_rate, self.admission_burst, now):
+                statuses[pos] = "shed"
+                continue
+            admitted.append(alert)
+            if coalesce:
+                self.windows[key] = [now + self.window, 0, None]
+
+        for reason in self.counters:
+            n = statuses.count(reason)
+            if n:
+                self.counters[reason] += n
+                metrics.inc("cidn_guard_alerts_total", n, reason=reason)
+        return closed, admitted, statuses
+
+    def expired(self, now=None):
+        """
+        Close the windows that have run out and return [(alert, count)] for
+        those that absorbed alerts: the latest absorbed alert and how many
+        alerts it stands for.
+        """
+        now = self.clock() if now is None else now
+        out = []
+        windows = self.windows
+        while windows:
+            key = next(iter(windows))
+            closes_at, absorbed, latest = windows[key]
+            if closes_at > now:
+                break
+            del windows[key]
+            if absorbed:
+                out.append((latest, absorbed))
+        return out
+
+    def stats(self):
+        return {**self.counters, "devices": len(self.buckets), "open_windows": len(self.windows)}
@@ -0,0 +1,172 @@
+# ledger_index.py
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import groupby
+
+from block_builder import iter_events
+
+
+def trust_value(event):
+    """Trust score an event reports for its device, if any."""
+    if "new" in event:
+        return event["new"]
+    return event.get("trust")
+
+
+def is_fleet_wide(event):
+    """True for events that concern every device, e.g. fleet_adjust with "devices": null."""
+    return "devices" in event and event["devices"] is None
+
+
+def mentions(event, device_id):
+    return event.get("device_id") == device_id or is_fleet_wide(event) \
+        or device_id in (event.get("devices") or ())
+
+
+class LedgerIndex:
+    """
+    In-process secondary indexes over the ledger, kept up to date as blocks
+    are appended:
+
+      device_id  -> block indices that mention the device
+      event type -> block indices containing that event
+      block time -> block index (sorted, for since/until ranges)
+      fleet      -> block indices with whole-fleet events, which concern
+                    every device and are merged into each device's list
+
+    Index lists are compact arrays in block order, so every lookup is a
+    bisect plus a walk over the matching entries only.
+    """
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.by_device = defaultdict(lambda: array("Q"))
+        self.by_event = defaultdict(lambda: array("Q"))
+        self.fleet = array("Q")
+        # Running max of block timestamps, so the array stays sorted even if
+        # the wall clock steps backwards between two blocks.
+        self.times = array("d")
+        for block in blockchain.chain:
+            self.add(block)
+        blockchain.subscribe(self.add)
+
+    def add(self, block):
+        ts = block.timestamp
+        if self.times and ts < self.times[-1]:
+            ts = self.times[-1]
+        self.times.append(ts)
+        for event in iter_events(block.data):
+            device_id = event.get("device_id")
+            if device_id is not None:
+                self._add(self.by_device[device_id], block.index)
+            for dev in event.get("devices") or ():
+                self._add(self.by_device[dev], block.index)
+            if is_fleet_wide(event):
+                self._add(self.fleet, block.index)
+            self._add(self.by_event[event.get("event")], block.index)
+
+    @staticmethod
+    def _add(indices, block_index):
+        if not indices or indices[-1] != block_index:
+            indices.append(block_index)
+
+    # ---- queries ----
+    def block_range(self, since=None, until=None):
+        """[lo, hi) block indices whose timestamps fall within [since, until]."""
+        lo = 0 if since is None else bisect_left(self.times, since)
+        hi = len(self.times) if until is None else bisect_right(self.times, until)
+        return lo, hi
+
+    def candidates(self, device_id=None, event=None, since=None, until=None, cursor=0):
+        """Block indices >= cursor that may match, taken from the narrowest index."""
+        lo, hi = self.block_range(since, until)
+        lo = max(lo, cursor)
+        lists = []
+        if device_id is not None:
+            lists.append((self.by_device.get(device_id, ()), self.fleet))
+        if event is not None:
+            lists.append((self.by_event.get(event, ()),))
+        if not lists:
+            return range(lo, hi)
+        narrowest = min(lists, key=lambda parts: sum(map(len, parts)))
+        walks = [self._walk(part, lo, hi) for part in narrowest if part]
+        if len(walks) <= 1:
+            return walks[0] if walks else iter(())
+        return (index for index, _ in groupby(heapq.merge(*walks)))
+
+    @staticmethod
+    def _walk(indices, lo, hi):
+        for i in range(bisect_left(indices, lo), bisect_left(indices, hi)):
+            yield indices[i]
+
+    def query(self, device_id=None, event=None, since=None, until=None, cursor=0, limit=100):
+        """
+        Events matching all given filters, oldest first, as
+        ({"block_index", "leaf_index", "timestamp", "data"} list, next_cursor).
+        """
+        chain = self.blockchain.chain
+        results = []
+        for block_index in self.candidates(device_id, event, since, until, cursor):
+            block = chain[block_index]
+            for leaf, e in enumerate(iter_events(block.data)):
+                if device_id is not None and not mentions(e, device_id):
+                    continue
+                if event is not None and e.get("event") != event:
+                    continue
+                results.append({
+                    "block_index": block_index,
+                    "leaf_index": leaf,
+                    "timestamp": block.timestamp,
+                    "data": e,
+                })
+            if len(results) >= limit:
+                return results, block_index + 1
+        return results, None
+
+    def trust_history(self, device_id, since=None, until=None, bucket=None):
+        """
+        Trust time series for a device as [{"t", "trust"}]. With `bucket`
+        (seconds), points are downsampled to one per bucket carrying the last,
+        min and max trust seen in it.
+
+        Fleet adjustments carry a delta rather than a score, so they are
+        applied to the last known point (skipped before the first one, and
+        while the device is revoked, as CIDN.adjust_fleet does).
+        """
+        chain = self.blockchain.chain
+        points = []
+        revoked = False
+        for block_index in self.candidates(device_id, None, since, until):
+            block = chain[block_index]
+            for e in iter_events(block.data):
+                if not mentions(e, device_id):
+                    continue
+                kind = e.get("event")
+                if kind == "revoke":
+                    revoked = True
+                elif kind in ("register", "register_batch"):
+                    revoked = False
+                if kind == "fleet_adjust":
+                    if not points or revoked:
+                        continue
+                    value = min(1.0, max(0.0, points[-1]["trust"] + e.get("delta", 0.0)))
+                else:
+                    value = trust_value(e)
+                if value is not None:
+                    points.append({"t": block.timestamp, "trust": value})
+        if not bucket:
+            return points
+
+        buckets = []
+        for p in points:
+            start = p["t"] - p["t"] % bucket
+            if buckets and buckets[-1]["t"] == start:
+                b = buckets[-1]
+                b["trust"] = p["trust"]
+                b["min"] = min(b["min"], p["trust"])
+                b["max"] = max(b["max"], p["trust"])
+            else:
+                buckets.append({"t": start, "trust": p["trust"], "min": p["trust"], "max": p["trust"]})
+        return buckets
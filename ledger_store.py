@@ -0,0 +1,533 @@
+# ledger_store.py
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+from blockchain import HASH_BINARY, Block
+
+# ---- record format ----
+# Every block is one record in an append-only segment file:
+#
+#   u32 body length | u32 crc32(body) | body
+#
+# For HASH_BINARY blocks the body is the block's canonical encoding
+# (Block.encoded(), which starts with the version byte) followed by the 32B
+# raw hash, so nothing is serialized again on write. Older blocks use
+#
+# body = u8 hash version | u64 index | f64 timestamp | 32B raw hash
+#        | u8 prev kind (0 = raw digest, 1 = literal) | prev hash | data JSON
+#
+# A record whose length or crc does not check out marks the end of the valid
+# log; everything after it is a torn write and gets truncated on open.
+RECORD_HEADER = struct.Struct("<II")
+BODY_HEADER = struct.Struct("<BQd32sB")
+SEGMENT_PREFIX = "seg-"
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+# ---- archive format ----
+# A sealed segment can be moved into an immutable, compressed archive file:
+#
+#   8B magic | u32 meta length | meta JSON | u64 first block of each frame
+#   | u64 offset of each frame (+ end) | frames
+#
+# Each frame is the zlib-compressed run of the segment's original records
+# (about ARCHIVE_FRAME_BYTES of them), so a read decompresses one frame, not
+# the whole archive. The meta holds the archived range's anchor, which can
+# be checked against the live chain without decompressing anything.
+ARCHIVE_PREFIX = "arc-"
+ARCHIVE_SUFFIX = ".zarc"
+ARCHIVE_MAGIC = b"CIDNARC1"
+ARCHIVE_HEADER = struct.Struct("<8sI")
+ARCHIVE_FRAME_BYTES = 1024 * 1024
+ARCHIVE_FRAME_CACHE = 2  # decompressed frames kept per archive
+
+
+def encode_block(block):
+    if block.version == HASH_BINARY:
+        return block.encoded() + bytes.fromhex(block.hash)
+    prev = block.prev_hash
+    if len(prev) == 64:
+        prev_kind, prev_bytes = 0, bytes.fromhex(prev)
+    else:
+        raw = prev.encode()
+        prev_kind, prev_bytes = 1, bytes([len(raw)]) + raw
+    data = json.dumps(block.data, separators=(",", ":")).encode()
+    head = BODY_HEADER.pack(block.version, block.index, block.timestamp,
+                            bytes.fromhex(block.hash), prev_kind)
+    return head + prev_bytes + data
+
+
+def decode_block(body):
+    if body[0] == HASH_BINARY:
+        return Block.from_encoded(bytes(body[:-32]), bytes(body[-32:]).hex())
+    version, index, timestamp, digest, prev_kind = BODY_HEADER.unpack_from(body, 0)
+    pos = BODY_HEADER.size
+    if prev_kind == 0:
+        prev_hash = body[pos:pos + 32].hex()
+        pos += 32
+    else:
+        size = body[pos]
+        prev_hash = bytes(body[pos + 1:pos + 1 + size]).decode()
+        pos += 1 + size
+    data = json.loads(bytes(body[pos:]))
+    return Block(index, timestamp, data, prev_hash, hash=digest.hex(), version=version)
+
+
+class _Segment:
+    def __init__(self, path, first_index):
+        self.path = path
+        self.first_index = first_index
+        self.offsets = array("Q")  # record offset of each block in this segment
+        self.size = 0
+        self._map = None
+        self._mapped_size = 0
+
+    @property
+    def count(self):
+        return len(self.offsets)
+
+    def body(self, index):
+        offset = self.offsets[index - self.first_index]
+        buf = self.view(offset + RECORD_HEADER.size)
+        length, _ = RECORD_HEADER.unpack_from(buf, offset)
+        if len(buf) < offset + RECORD_HEADER.size + length:
+            buf = self.view(offset + RECORD_HEADER.size + length)
+        start = offset + RECORD_HEADER.size
+        return buf[start:start + length]
+
+    def view(self, end):
+        """Return a memory map covering at least `end` bytes of the segment."""
+        if self._map is None or self._mapped_size < end:
+            self.close_map()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped_size = len(self._map)
+        return self._map
+
+    def close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._mapped_size = 0
+
+
+class _ArchivedSegment:
+    """A segment moved into an archive file; blocks are read back one frame at a time."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, meta_len = ARCHIVE_HEADER.unpack(f.read(ARCHIVE_HEADER.size))
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError(f"{os.path.basename(path)} is not a ledger archive")
+            self.meta = json.loads(f.read(meta_len))
+            frames = self.meta["frames"]
+            self.frame_firsts = array("Q")
+            self.frame_firsts.frombytes(f.read(8 * frames))
+            self.frame_offsets = array("Q")
+            self.frame_offsets.frombytes(f.read(8 * (frames + 1)))
+            self.data_start = f.tell()
+        self.first_index = self.meta["first_index"]
+        self.count = self.meta["count"]
+        self.size = os.path.getsize(path)
+        self._frames = OrderedDict()  # frame number -> (records, record offsets)
+
+    def _frame(self, n):
+        frame = self._frames.get(n)
+        if frame is not None:
+            self._frames.move_to_end(n)
+            return frame
+        with open(self.path, "rb") as f:
+            f.seek(self.data_start + self.frame_offsets[n])
+            records = zlib.decompress(f.read(self.frame_offsets[n + 1] - self.frame_offsets[n]))
+        offsets = array("Q")
+        pos = 0
+        while pos < len(records):
+            length, _ = RECORD_HEADER.unpack_from(records, pos)
+            offsets.append(pos)
+            pos += RECORD_HEADER.size + length
+        frame = self._frames[n] = (records, offsets)
+        if len(self._frames) > ARCHIVE_FRAME_CACHE:
+            self._frames.popitem(last=False)
+        return frame
+
+    def body(self, index):
+        rel = index - self.first_index
+        n = bisect_right(self.frame_firsts, rel) - 1
+        records, offsets = self._frame(n)
+        offset = offsets[rel - self.frame_firsts[n]]
+        length, _ = RECORD_HEADER.unpack_from(records, offset)
+        start = offset + RECORD_HEADER.size
+        return records[start:start + length]
+
+    def close_map(self):
+        self._frames.clear()
+
+
+class SegmentedLedgerStore:
+    """
+    Append-only, segmented on-disk block store.
+
+    Behaves like the list `Blockchain.chain` used to be (len, indexing,
+    slicing, iteration, append) but keeps only an offset index and a small
+    cache of decoded blocks in memory.
+
+    With readonly=True (verification workers, server replicas) it never
+    writes, and refresh() picks up blocks the writer appended since.
+
+    Sealed segments can be moved into compressed archive files with
+    archive(); their blocks keep their indices and stay readable.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 fsync_every=256, fsync_interval=1.0, cache_size=4096, readonly=False):
+        self.directory = directory
+        self.readonly = readonly                # readers never truncate or append
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every          # records per fsync (0 = only on sync/close)
+        self.fsync_interval = fsync_interval    # max seconds between fsyncs (None = off)
+        self.cache_size = cache_size
+
+        self.segments = []
+        self._firsts = []        # first block index of each segment, for bisect
+        self._count = 0
+        self._cache = OrderedDict()
+        self._last = None
+        self._lock = threading.RLock()
+        self._fh = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    # ---- startup & crash recovery ----
+    def _open(self):
+        hot, archived = {}, {}
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                hot[int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])] = name
+            elif name.startswith(ARCHIVE_PREFIX) and name.endswith(ARCHIVE_SUFFIX):
+                archived[int(name[len(ARCHIVE_PREFIX):-len(ARCHIVE_SUFFIX)])] = name
+        firsts = sorted(hot.keys() | archived.keys())
+        for pos, first in enumerate(firsts):
+            if first in archived:
+                seg = _ArchivedSegment(os.path.join(self.directory, archived[first]))
+                if first in hot and not self.readonly:
+                    # archived, but the process stopped before removing the original
+                    self._remove_segment_files(os.path.join(self.directory, hot[first]))
+            else:
+                seg = _Segment(os.path.join(self.directory, hot[first]), first)
+                is_last = pos == len(firsts) - 1
+                if is_last or not self._load_index(seg):
+                    self._scan(seg)
+                    if not is_last and not self.readonly:
+                        self._write_index(seg)
+            if seg.first_index != self._count:
+                raise ValueError(f"Ledger segment {os.path.basename(seg.path)} does not continue "
+                                 f"the chain at {self._count}")
+            self.segments.append(seg)
+            self._firsts.append(seg.first_index)
+            self._count += seg.count
+
+        if self.readonly:
+            if not self.segments:
+                raise FileNotFoundError(f"No ledger segments in {self.directory}")
+        else:
+            if not self.segments or isinstance(self.segments[-1], _ArchivedSegment):
+                self._new_segment(self._count)
+            # unbuffered: every record reaches the OS at once, so mmap readers
+            # and read-only replicas see it without waiting for an fsync
+            self._fh = open(self.segments[-1].path, "ab", buffering=0)
+        if self._count:
+            self._last = self._read(self._count - 1)
+
+    def _load_index(self, seg):
+        idx_path = seg.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        if not os.path.exists(idx_path):
+            return False
+        offsets = array("Q")
+        with open(idx_path, "rb") as f:
+            offsets.frombytes(f.read())
+        size = os.path.getsize(seg.path)
+        if not offsets:
+            return size == 0
+        # the index is only trusted if its last record ends exactly at EOF
+        with open(seg.path, "rb") as f:
+            f.seek(offsets[-1])
+            header = f.read(RECORD_HEADER.size)
+        if len(header) != RECORD_HEADER.size:
+            return False
+        length, _ = RECORD_HEADER.unpack(header)
+        if offsets[-1] + RECORD_HEADER.size + length != size:
+            return False
+        seg.offsets = offsets
+        seg.size = size
+        return True
+
+    def _scan(self, seg, resume=False):
+        """
+        Rebuild a segment's offsets (or, with resume, extend them past
+        seg.size), truncating any torn or corrupt tail unless read-only.
+        """
+        size = os.path.getsize(seg.path)
+        offsets = seg.offsets if resume else array("Q")
+        pos = seg.size if resume else 0
+        if size > pos:
+            with open(seg.path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    while pos + RECORD_HEADER.size <= size:
+                        length, crc = RECORD_HEADER.unpack_from(buf, pos)
+                        end = pos + RECORD_HEADER.size + length
+                        if length < BODY_HEADER.size or end > size:
+                            break
+                        if zlib.crc32(buf[pos + RECORD_HEADER.size:end]) != crc:
+                            break
+                        offsets.append(pos)
+                        pos = end
+                finally:
+                    buf.close()
+        if pos != size and not self.readonly:
+            print(f"[Ledger] ⚠️ Truncating {size - pos} bytes of torn writes in {os.path.basename(seg.path)}")
+            with open(seg.path, "r+b") as f:
+                f.truncate(pos)
+                f.flush()
+                os.fsync(f.fileno())
+        seg.offsets = offsets
+        seg.size = pos
+
+    def refresh(self):
+        """
+        Pick up blocks another process has appended since this read-only
+        store was opened or last refreshed. Returns the number of new blocks.
+        """
+        if not self.readonly:
+            return 0
+        with self._lock:
+            before = self._count
+            last = self.segments[-1]
+            while True:
+                self._scan(last, resume=True)
+                self._count = last.first_index + last.count
+                # the writer names a new segment after the first block it holds
+                path = self._segment_path(self._count)
+                if not os.path.exists(path):
+                    break
+                last = _Segment(path, self._count)
+                self.segments.append(last)
+                self._firsts.append(last.first_index)
+            if self._count > before:
+                self._last = self._read(self._count - 1)
+            return self._count - before
+
+    def _write_index(self, seg):
+        idx_path = seg.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        tmp = idx_path + ".tmp"
+        with open(tmp, "wb") as f:
+            seg.offsets.tofile(f)
+        os.replace(tmp, idx_path)
+
+    def _segment_path(self, first_index):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{first_index:012d}{SEGMENT_SUFFIX}")
+
+    def _new_segment(self, first_index):
+        path = self._segment_path(first_index)
+        open(path, "ab").close()
+        seg = _Segment(path, first_index)
+        self.segments.append(seg)
+        self._firsts.append(first_index)
+        return seg
+
+    # ---- writes ----
+    def append(self, block):
+        if self.readonly:
+            raise PermissionError("Ledger store is open read-only")
+        if block.index != self._count:
+            raise ValueError(f"Expected block index {self._count}, got {block.index}")
+        body = encode_block(block)
+        record = RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+        with self._lock:
+            seg = self.segments[-1]
+            if seg.size and seg.size + len(record) > self.segment_size:
+                seg = self._roll()
+            seg.offsets.append(seg.size)
+            self._fh.write(record)
+            seg.size += len(record)
+            self._count += 1
+            self._last = block
+            self._remember(block)
+            self._unsynced += 1
+            if (self.fsync_every and self._unsynced >= self.fsync_every) or \
+                    (self.fsync_interval is not None
+                     and time.monotonic() - self._last_sync >= self.fsync_interval):
+                self.sync()
+
+    def _roll(self):
+        self.sync()
+        self._fh.close()
+        sealed = self.segments[-1]
+        self._write_index(sealed)
+        seg = self._new_segment(self._count)
+        self._fh = open(seg.path, "ab", buffering=0)
+        return seg
+
+    def sync(self):
+        """fsync the active segment."""
+        with self._lock:
+            if self._unsynced:
+                os.fsync(self._fh.fileno())
+                self._unsynced = 0
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self.sync()
+                self._fh.close()
+                self._fh = None
+            for seg in self.segments:
+                seg.close_map()
+
+    # ---- archival ----
+    def _archive_path(self, first_index):
+        return os.path.join(self.directory, f"{ARCHIVE_PREFIX}{first_index:012d}{ARCHIVE_SUFFIX}")
+
+    @staticmethod
+    def _remove_segment_files(path):
+        for p in (path, path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX):
+            if os.path.exists(p):
+                os.unlink(p)
+
+    def archivable(self):
+        """(first_index, count) of each sealed segment that is not archived yet, oldest first."""
+        with self._lock:
+            return [(seg.first_index, seg.count) for seg in self.segments[:-1]
+                    if isinstance(seg, _Segment)]
+
+    def archives(self):
+        """Meta of each archived segment (range, anchor), oldest first."""
+        with self._lock:
+            return [seg.meta for seg in self.segments if isinstance(seg, _ArchivedSegment)]
+
+    def archive(self, first_index, anchor, anchor_index, anchor_hash, level=6):
+        """
+        Move the sealed segment starting at `first_index` into a compressed
+        archive file. `anchor` is the range's anchor event and `anchor_index`
+        / `anchor_hash` the block it was recorded in; they are stored in the
+        archive's meta. The original segment files are removed afterwards.
+        """
+        if self.readonly:
+            raise PermissionError("Ledger store is open read-only")
+        with self._lock:
+            pos = bisect_right(self._firsts, first_index) - 1
+            seg = self.segments[pos]
+            if seg.first_index != first_index or not isinstance(seg, _Segment):
+                raise ValueError(f"No unarchived segment starts at {first_index}")
+            if pos == len(self.segments) - 1:
+                raise ValueError("The active segment cannot be archived")
+
+        # a sealed segment never changes, so it is compressed outside the lock
+        with open(seg.path, "rb") as f:
+            data = f.read(seg.size)
+        offsets = seg.offsets
+        frame_firsts, frames = array("Q"), []
+        i = 0
+        while i < len(offsets):
+            j = i + 1
+            while j < len(offsets) and offsets[j] - offsets[i] < ARCHIVE_FRAME_BYTES:
+                j += 1
+            end = offsets[j] if j < len(offsets) else seg.size
+            frame_firsts.append(i)
+            frames.append(zlib.compress(data[offsets[i]:end], level))
+            i = j
+        frame_offsets = array("Q", [0])
+        for frame in frames:
+            frame_offsets.append(frame_offsets[-1] + len(frame))
+
+        meta = json.dumps({
+            "first_index": first_index,
+            "last_index": first_index + seg.count - 1,
+            "count": seg.count,
+            "frames": len(frames),
+            "raw_bytes": seg.size,
+            "anchor": anchor,
+            "anchor_index": anchor_index,
+            "anchor_hash": anchor_hash,
+        }, separators=(",", ":")).encode()
+        path = self._archive_path(first_index)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, len(meta)) + meta)
+            frame_firsts.tofile(f)
+            frame_offsets.tofile(f)
+            for frame in frames:
+                f.write(frame)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+        with self._lock:
+            self.segments[pos] = _ArchivedSegment(path)
+            seg.close_map()
+            self._remove_segment_files(seg.path)
+        return path
+
+    # ---- reads ----
+    def _remember(self, block):
+        self._cache[block.index] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _read(self, index):
+        block = self._cache.get(index)
+        if block is not None:
+            self._cache.move_to_end(index)
+            return block
+        pos = bisect_right(self._firsts, index) - 1
+        seg = self.segments[pos]
+        try:
+            body = seg.body(index)
+        except FileNotFoundError:
+            # the writer archived this segment after we opened it
+            seg = self.segments[pos] = _ArchivedSegment(self._archive_path(seg.first_index))
+            body = seg.body(index)
+        block = decode_block(body)
+        self._remember(block)
+        return block
+
+    def nbytes(self):
+        """Total size of the segment and archive files."""
+        return sum(seg.size for seg in self.segments)
+
+    def archived_nbytes(self):
+        """Size of the archive files."""
+        return sum(seg.size for seg in self.segments if isinstance(seg, _ArchivedSegment))
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, item):
+        with self._lock:
+            if isinstance(item, slice):
+                return [self._read(i) for i in range(*item.indices(self._count))]
+            if item < 0:
+                item += self._count
+            if not 0 <= item < self._count:
+                raise IndexError("ledger index out of range")
+            if item == self._count - 1:
+                return self._last
+            return self._read(item)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
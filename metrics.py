@@ -0,0 +1,206 @@
+# metrics.py
+"""
+In-process instrumentation: per-stage latency histograms, labelled
+counters and scrape-time gauges, rendered in the Prometheus text format.
+
+    with metrics.timed("hash"):
+        ...
+    metrics.inc("cidn_alerts_total", type="benign", result="ok")
+    metrics.gauge("cidn_ledger_height", lambda: len(chain))
+
+Set CIDN_METRICS=0 to disable: timed() then returns a shared no-op context
+manager and inc()/observe() return immediately.
+
+Updates are not locked. They happen almost entirely on the single writer
+thread; a rare lost increment from another thread is an accepted trade for
+keeping the hot path cheap.
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+ENABLED = os.environ.get("CIDN_METRICS", "1") != "0"
+LOG_LEVEL = os.environ.get("CIDN_LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.environ.get("CIDN_LOG_QUEUE_SIZE", "10000"))
+
+# seconds; 10us .. 2.5s
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+HELP = {
+    "cidn_stage_seconds": ("histogram", "Latency of each processing stage"),
+    "cidn_alerts_total": ("counter", "Alerts processed, by type and result"),
+    "cidn_log_dropped_total": ("counter", "Log records dropped because the log queue was full"),
+    "cidn_guard_alerts_total": ("counter", "Alerts stopped at ingestion, by reason"),
+}
+
+_NULL = nullcontext()
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_stages = {}    # stage -> Histogram
+_counters = {}  # (name, ((label, value), ...)) -> value
+_gauges = {}    # name -> (help, fn)
+
+
+class _Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def timed(stage):
+    """Context manager recording the block's wall time under `stage`."""
+    return _Timer(stage) if ENABLED else _NULL
+
+
+def observe(stage, seconds):
+    if not ENABLED:
+        return
+    hist = _stages.get(stage)
+    if hist is None:
+        hist = _stages[stage] = Histogram()
+    hist.observe(seconds)
+
+
+def inc(name, n=1, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    _counters[key] = _counters.get(key, 0) + n
+
+
+def gauge(name, fn, help=""):
+    """Register a gauge whose value is fn() at scrape time (None skips it)."""
+    _gauges[name] = (help, fn)
+
+
+def reset():
+    _stages.clear()
+    _counters.clear()
+
+
+# ---- export ----
+def snapshot():
+    """JSON-serializable copy of every metric, as [name, labels, kind, value]."""
+    samples = []
+    for stage, hist in list(_stages.items()):
+        samples.append(["cidn_stage_seconds", {"stage": stage}, "histogram",
+                        {"counts": list(hist.counts), "sum": hist.sum, "count": hist.count}])
+    for (name, labels), value in list(_counters.items()):
+        samples.append([name, dict(labels), "counter", value])
+    for name, (_, fn) in list(_gauges.items()):
+        try:
+            value = fn()
+        except Exception:
+            value = None
+        if value is not None:
+            samples.append([name, {}, "gauge", value])
+    return samples
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def render(*snapshots):
+    """
+    Prometheus text format for one or more snapshots, each either a sample
+    list or a (sample list, extra labels) pair. Defaults to this process.
+    """
+    if not snapshots:
+        snapshots = (snapshot(),)
+    families = {}
+    for snap in snapshots:
+        samples, extra = snap if isinstance(snap, tuple) else (snap, {})
+        for name, labels, kind, value in samples:
+            families.setdefault(name, (kind, []))[1].append(({**labels, **extra}, value))
+
+    lines = []
+    for name, (kind, series) in sorted(families.items()):
+        help_text = HELP.get(name, (kind, ""))[1] or _gauges.get(name, ("",))[0]
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind != "histogram":
+                lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), value["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+# ---- logging ----
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            inc("cidn_log_dropped_total")
+
+
+_listener = None
+
+
+def setup_logging(level=LOG_LEVEL, stream=None):
+    """
+    Route the "cidn" loggers through a bounded queue to a background thread,
+    so formatting and writing log lines never blocks a request or the writer.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    logger = logging.getLogger("cidn")
+    logger.setLevel(level)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    logger.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
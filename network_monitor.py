@@ -1,12 +1,19 @@
+import asyncio
+import ipaddress
 import psutil
-import requests
-import subprocess
 import time
 import socket
 import re
 
+from cidn_client import CIDNClient, CIDNUnavailable
+from discovery import DiscoveryEngine
+
 SERVER_URL = "http://127.0.0.1:8000"  # CIDN server (laptop)
 TIMEOUT = 300  # auto-stop after 5 minutes (set None for infinite run)
+SPOOL_FILE = "monitor_alerts.spool"  # alerts kept here while the server is unreachable
+
+# alerts are batched: a scan of thousands of devices becomes a few requests
+client = CIDNClient(SERVER_URL, spool_path=SPOOL_FILE)
 
 
 # ---- Network utilities ----
@@ -22,52 +29,54 @@ def get_local_subnet():
 
 
 def discover_devices(limit=20):
-    """Ping sweep to find active devices (limited for demo)."""
+    """Concurrent sweep (ICMP, falling back to TCP connects) to find active devices (limited for demo)."""
     subnet = get_local_subnet()
     print(f"[Monitor] 🔍 Scanning subnet {subnet} ...")
-    devices = []
-
-    for i in range(1, limit + 1):
-        ip = subnet.replace("0/24", str(i))
-        try:
-            output = subprocess.check_output(
-                ["ping", "-n", "1", "-w", "200", ip],
-                stderr=subprocess.DEVNULL
-            )
-            if "TTL=" in output.decode(errors="ignore"):
-                devices.append(ip)
-        except:
-            pass
-    return devices
+    hosts = list(ipaddress.ip_network(subnet).hosts())
+    if limit:
+        hosts = hosts[:limit]
+    found = asyncio.run(DiscoveryEngine(methods=("icmp", "tcp"), timeout=0.2).scan(hosts))
+    return sorted((h["ip"] for h in found), key=ipaddress.IPv4Address)
 
 
 # ---- CIDN interaction ----
 def register_device(ip):
-    payload = {"device_id": ip, "public_key": "auto_discovered"}
     try:
-        resp = requests.post(f"{SERVER_URL}/register", json=payload, timeout=5)
-        return resp.json()
-    except Exception as e:
+        return client.register(ip, "auto_discovered")
+    except CIDNUnavailable as e:
         return {"error": str(e)}
 
 
-def send_alert(ip, alert_type, metrics):
-    alert = {"device_id": ip, "type": alert_type, "metrics": metrics}
+def register_devices(ips):
+    """Register all newly discovered IPs with one request."""
     try:
-        resp = requests.post(f"{SERVER_URL}/alert", json=alert, timeout=5)
-        return resp.json()
-    except Exception as e:
+        return client.register_many([(ip, "auto_discovered") for ip in ips])
+    except CIDNUnavailable as e:
         return {"error": str(e)}
 
 
+def send_alert(ip, alert_type, metrics):
+    """Queue an alert; the client batches, retries and spools it."""
+    client.queue_alert({"device_id": ip, "type": alert_type, "metrics": metrics})
+
+
 def get_trust(ip):
     try:
-        resp = requests.get(f"{SERVER_URL}/trust/{ip}", timeout=5)
-        return resp.json()
-    except:
+        return client.get_trust(ip)
+    except CIDNUnavailable:
         return None
 
 
+def get_trust_levels(ips):
+    """{ip: trust} for the given devices, from one /devices listing."""
+    try:
+        rows = client.list_devices(limit=100000)
+    except CIDNUnavailable:
+        return {}
+    wanted = set(ips)
+    return {row["device_id"]: row["trust"] for row in rows if row["device_id"] in wanted}
+
+
 # ---- Monitor loop ----
 def monitor_loop():
     seen = set()
@@ -80,12 +89,13 @@ def monitor_loop():
             break
 
         devices = discover_devices(limit=10)
-        for ip in devices:
-            if ip not in seen:
-                reg = register_device(ip)
-                print(f"[Monitor] 📝 Registered {ip}: {reg}")
-                seen.add(ip)
+        new_ips = [ip for ip in devices if ip not in seen]
+        if new_ips:
+            reg = register_devices(new_ips)
+            print(f"[Monitor] 📝 Registered {len(new_ips)} devices: {reg.get('registered', reg)}")
+            seen.update(new_ips)
 
+        for ip in devices:
             # Fake "traffic stats"
             net_io = psutil.net_io_counters()
             sent, recv, drop = net_io.packets_sent, net_io.packets_recv, net_io.errout
@@ -97,19 +107,18 @@ def monitor_loop():
 
             # Simple trust check
             drop_rate = (drop / (sent + 1)) * 100
-            if drop_rate > 5:
-                resp = send_alert(ip, "packet_drop", metrics)
-            else:
-                resp = send_alert(ip, "benign", metrics)
-
-            print(f"[Monitor] Alert sent for {ip}: {resp}")
+            send_alert(ip, "packet_drop" if drop_rate > 5 else "benign", metrics)
 
-            trust_info = get_trust(ip)
-            if trust_info:
-                print(f"[Monitor] 🔐 {ip} trust: {trust_info}")
+        client.flush()
+        print(f"[Monitor] Alerts sent for {len(devices)} devices: {client.stats()}")
+        for ip, trust in get_trust_levels(devices).items():
+            print(f"[Monitor] 🔐 {ip} trust: {trust}")
 
         time.sleep(15)  # wait before next scan
 
 
 if __name__ == "__main__":
-    monitor_loop()
+    try:
+        monitor_loop()
+    finally:
+        client.close()
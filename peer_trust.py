@@ -0,0 +1,227 @@
+# peer_trust.py
+"""
+EigenTrust over peer feedback.
+
+Devices report how their interactions with other devices went: a count of
+positive and negative observations per peer. The counts are kept per
+(rater, ratee) edge in sparse arrays indexed by trust-table slot; the local
+trust of an edge is max(positive - negative, 0), normalized over the
+rater's edges.
+
+The global trust vector t solves
+
+    t = (1 - alpha) * C^T t + alpha * p
+
+by power iteration, where C holds the normalized local trust and p is the
+pre-trust: the CIDN trust scores of non-revoked devices, normalized. A
+rater with no positive edges (or revoked) spreads its trust along p. So
+opinions count in proportion to the rater's own global trust, and a clique
+of bad devices rating each other up gains little. Each computation starts
+from the previous vector, so after a few edge changes it converges in a
+handful of iterations.
+
+`scores()` maps t to [0, 1], with a device of average global trust at
+`initial_trust`, and `blend()` mixes that with the device's own score.
+SciPy's sparse matrices are used when installed, NumPy otherwise.
+"""
+import threading
+import time
+
+import numpy as np
+
+try:
+    import scipy.sparse as sparse
+except ImportError:  # falls back to np.bincount, a few times slower
+    sparse = None
+
+SLOT_BITS = 32
+
+
+class PeerTrust:
+    def __init__(self, table, alpha=0.15, weight=0.3, initial_trust=0.5, tol=1e-6, max_iter=100,
+                 max_age=30.0):
+        self.table = table              # trust_table.TrustTable; its slots index the vectors
+        self.alpha = alpha              # weight of the pre-trust in each step
+        self.weight = weight            # weight of peer trust in blend()
+        self.initial_trust = initial_trust
+        self.tol = tol                  # L1 change at which iteration stops
+        self.max_iter = max_iter
+        self.max_age = max_age          # scores() recomputes when older than this
+        # merged edges: key = rater << SLOT_BITS | ratee, sorted, unique
+        self.keys = np.empty(0, dtype=np.int64)
+        self.positive = np.empty(0, dtype=np.float64)
+        self.negative = np.empty(0, dtype=np.float64)
+        self._pending = []   # (keys, positive, negative) added since the last merge
+        self._lock = threading.Lock()          # edges and pending
+        self._compute_lock = threading.Lock()  # one computation at a time
+        self.version = 0     # bumped by every add
+        self.vector = None   # last global trust vector, sums to 1
+        self.computed = {"version": -1, "at": 0.0, "iterations": 0, "seconds": 0.0, "devices": 0}
+        self._matrix = None  # (version, n, C^T or its COO parts)
+
+    # ---- feedback ----
+    def add(self, raters, ratees, positive, negative):
+        """Add observation counts for (rater, ratee) slot pairs; counts add up per edge."""
+        raters = np.asarray(raters, dtype=np.int64)
+        ratees = np.asarray(ratees, dtype=np.int64)
+        keep = raters != ratees  # self-ratings carry no information
+        if not keep.all():
+            raters, ratees = raters[keep], ratees[keep]
+            positive, negative = np.asarray(positive)[keep], np.asarray(negative)[keep]
+        if not len(raters):
+            return
+        with self._lock:
+            self._pending.append(((raters << SLOT_BITS) | ratees,
+                                  np.asarray(positive, dtype=np.float64),
+                                  np.asarray(negative, dtype=np.float64)))
+            self.version += 1
+
+    def _merge(self):
+        """
+        Fold pending feedback into the edge arrays. Call with _lock held.
+        Only the pending keys are sorted; they are matched against, or
+        inserted into, the sorted edge keys. New arrays replace the old ones,
+        which edges() may have handed out.
+        """
+        if not self._pending:
+            return
+        keys = np.concatenate([k for k, _, _ in self._pending])
+        positive = np.concatenate([p for _, p, _ in self._pending])
+        negative = np.concatenate([n for _, _, n in self._pending])
+        self._pending = []
+        keys, inverse = np.unique(keys, return_inverse=True)
+        positive = np.bincount(inverse, weights=positive, minlength=len(keys))
+        negative = np.bincount(inverse, weights=negative, minlength=len(keys))
+
+        at = np.searchsorted(self.keys, keys)
+        found = at < len(self.keys)
+        found[found] = self.keys[at[found]] == keys[found]
+        self.positive = self.positive.copy()
+        self.negative = self.negative.copy()
+        np.add.at(self.positive, at[found], positive[found])
+        np.add.at(self.negative, at[found], negative[found])
+        new = ~found
+        if new.any():
+            self.keys = np.insert(self.keys, at[new], keys[new])
+            self.positive = np.insert(self.positive, at[new], positive[new])
+            self.negative = np.insert(self.negative, at[new], negative[new])
+
+    def edges(self):
+        """(version, keys, positive, negative) as of now; the arrays are not modified later."""
+        with self._lock:
+            self._merge()
+            return self.version, self.keys, self.positive, self.negative
+
+    def __len__(self):
+        return len(self.edges()[1])
+
+    # ---- snapshots ----
+    def export(self):
+        _, keys, positive, negative = self.edges()
+        return {"peer_keys": keys, "peer_positive": positive, "peer_negative": negative}
+
+    def load(self, columns):
+        """Replace the edges with exported ones (missing from snapshots taken before peer feedback)."""
+        with self._lock:
+            if "peer_keys" in columns:
+                self.keys = np.asarray(columns["peer_keys"], dtype=np.int64)
+                self.positive = np.asarray(columns["peer_positive"], dtype=np.float64)
+                self.negative = np.asarray(columns["peer_negative"], dtype=np.float64)
+            else:
+                self.keys = np.empty(0, dtype=np.int64)
+                self.positive = np.empty(0, dtype=np.float64)
+                self.negative = np.empty(0, dtype=np.float64)
+            self._pending = []
+            self.version += 1
+            self.vector = None
+
+    # ---- computation ----
+    def _transition(self, version, n, keys, positive, negative):
+        """C^T for the current edges, rebuilt only when they changed."""
+        if self._matrix is not None and self._matrix[:2] == (version, n):
+            return self._matrix[2]
+        raters = keys >> SLOT_BITS
+        ratees = keys & ((1 << SLOT_BITS) - 1)
+        local = np.maximum(positive - negative, 0.0)
+        keep = (local > 0) & (raters < n) & (ratees < n)
+        raters, ratees, local = raters[keep], ratees[keep], local[keep]
+        row_sums = np.bincount(raters, weights=local, minlength=n)
+        weights = local / row_sums[raters]
+        if sparse is not None:
+            # keys are sorted by rater, so C is already in CSR order; C.T is a free CSC view
+            indptr = np.concatenate(([0], np.cumsum(np.bincount(raters, minlength=n))))
+            matrix = sparse.csr_matrix((weights, ratees, indptr), shape=(n, n)).T
+        else:
+            matrix = (raters, ratees, weights)
+        self._matrix = (version, n, (matrix, row_sums > 0))
+        return self._matrix[2]
+
+    def compute(self):
+        """Run the power iteration and return the global trust vector (one entry per slot)."""
+        with self._compute_lock:
+            start = time.perf_counter()
+            version, keys, positive, negative = self.edges()
+            table = self.table
+            n = len(table.ids)
+            if n == 0:
+                self.vector = np.empty(0)
+                return self.vector
+            active = ~table.revoked_flags[:n]
+            pre = np.where(active, table.trust[:n], 0.0)
+            pre = pre / pre.sum() if pre.sum() > 0 else np.full(n, 1.0 / n)
+
+            matrix, rating = self._transition(version, n, keys, positive, negative)
+            rating = rating & active  # revoked devices' opinions are ignored
+
+            t = pre.copy()
+            if self.vector is not None and len(self.vector):
+                # warm start; new devices begin at their pre-trust
+                m = min(len(self.vector), n)
+                t[:m] = self.vector[:m]
+                t /= t.sum()
+
+            iterations = 0
+            for iterations in range(1, self.max_iter + 1):
+                spread = np.where(rating, t, 0.0)
+                if sparse is not None:
+                    step = matrix @ spread
+                else:
+                    raters, ratees, weights = matrix
+                    step = np.bincount(ratees, weights=weights * spread[raters], minlength=n)
+                dangling = t.sum() - spread.sum()
+                new = (1 - self.alpha) * (step + dangling * pre) + self.alpha * pre
+                delta = np.abs(new - t).sum()
+                t = new
+                if delta < self.tol:
+                    break
+
+            self.vector = t
+            self.computed = {"version": version, "at": time.time(), "iterations": iterations,
+                             "seconds": time.perf_counter() - start, "devices": n, "edges": len(keys)}
+            return t
+
+    def scores(self):
+        """
+        Peer trust per slot in [0, 1]: global trust relative to the average
+        active device, which scores `initial_trust`. Recomputed when the
+        last computation is older than `max_age` seconds (pre-trust moves with
+        every alert, so not only when edges change).
+        """
+        if self.vector is None or time.time() - self.computed["at"] > self.max_age:
+            self.compute()
+        t = self.vector
+        table = self.table
+        n = len(table.ids)
+        m = min(len(t), n)
+        active = ~table.revoked_flags[:n]
+        count = int(active[:m].sum())
+        scores = table.trust[:n].copy()  # devices added since the computation: their own score
+        scores[:m] = np.minimum(1.0, t[:m] * count * self.initial_trust)
+        scores[~active] = 0.0
+        return scores
+
+    def blend(self, own, peer):
+        return (1 - self.weight) * own + self.weight * peer
+
+    def stats(self):
+        return {**self.computed, "feedback_version": self.version, "alpha": self.alpha, "weight": self.weight}
@@ -0,0 +1,312 @@
+# rules.py
+"""
+Sliding-window behavior rules, evaluated on every alert by
+CIDN.receive_alerts (when evaluate_rules is set) and by
+CIDN.evaluate_and_update.
+
+Every alert is folded into per-device windows (10s, 1m and 10m by default)
+that keep running totals of a few metrics, and a fixed list of compiled
+rules is checked against them. Work per alert is O(rules), however long
+the device's history is.
+
+Rules are declarative:
+
+    {"name": "scan_burst",
+     "when": [{"metric": "scans", "window": "1m", "op": ">=", "value": 10}],
+     "delta": -0.4,
+     "group": "scan",       # optional: only the first matching rule of a group applies
+     "cooldown": 60}        # optional: seconds before the rule can fire again
+
+A condition is either {"metric", "window", "op", "value"} or
+{"alert_type": [...]}. "window" is a window label or "alert" for the
+current alert alone. Metrics are the names in METRICS plus the derived
+"forwarding_rate" ((sent - failed) / sent, false while nothing was sent).
+
+A device idle for longer than the longest window plus the longest cooldown
+has empty windows and no rule cooling down, the same as a device never
+seen, so its state is dropped then (and on forget(), e.g. at revocation).
+Memory is bounded by the devices active within that horizon.
+"""
+import math
+import operator
+import re
+import time
+from collections import OrderedDict
+
+METRICS = ("alerts", "malicious", "scans", "packets_sent", "packets_failed", "keyword_hits")
+_M = {name: i for i, name in enumerate(METRICS)}
+
+WINDOWS = {"10s": 10, "1m": 60, "10m": 600}
+DEFAULT_KEYWORDS = ("malicious", "malware")
+MALICIOUS_TYPES = frozenset({"malicious", "scan", "malicious_scan", "ddos", "packet_drop"})
+
+METRIC_FIELDS = ("scan_count", "packets_sent", "packets_failed")  # counters read from an alert's "metrics"
+
+OPS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+       "==": operator.eq, "!=": operator.ne}
+
+
+# ---- windows ----
+class SlidingWindow:
+    """
+    Running totals over the last `span` seconds, kept in a ring of `buckets`
+    time buckets (so the window edge is accurate to span / buckets).
+    """
+
+    __slots__ = ("width", "ring", "totals", "head")
+
+    def __init__(self, span, buckets=10):
+        self.width = span / buckets
+        self.ring = [[0.0] * len(METRICS) for _ in range(buckets)]
+        self.totals = [0.0] * len(METRICS)
+        self.head = None  # bucket number of the newest bucket
+
+    def add(self, now, values):
+        epoch = int(now // self.width)
+        ring, totals = self.ring, self.totals
+        if self.head is None or epoch - self.head >= len(ring):
+            for bucket in ring:
+                bucket[:] = [0.0] * len(METRICS)
+            totals[:] = [0.0] * len(METRICS)
+            self.head = epoch
+        while self.head < epoch:  # expire buckets that slid out of the window
+            self.head += 1
+            bucket = ring[self.head % len(ring)]
+            for i, v in enumerate(bucket):
+                if v:
+                    totals[i] -= v
+                    bucket[i] = 0.0
+        if epoch < self.head:  # late alert: fold it into the newest bucket
+            epoch = self.head
+        bucket = ring[epoch % len(ring)]
+        for i, v in enumerate(values):
+            if v:
+                bucket[i] += v
+                totals[i] += v
+
+
+class DeviceState:
+    __slots__ = ("windows", "last_fired", "last_seen")
+
+    def __init__(self, spans, n_rules):
+        self.windows = [SlidingWindow(span) for span in spans]
+        self.last_fired = [float("-inf")] * n_rules
+        self.last_seen = float("-inf")
+
+
+def valid_metrics(metrics):
+    """
+    True if an alert's "metrics" can be folded into the windows: absent, or
+    a dict whose METRIC_FIELDS, where present, are finite numbers >= 0.
+    """
+    if metrics is None:
+        return True
+    if not isinstance(metrics, dict):
+        return False
+    for field in METRIC_FIELDS:
+        if field in metrics:
+            v = metrics[field]
+            if type(v) not in (int, float) or not math.isfinite(v) or v < 0:
+                return False
+    return True
+
+
+# ---- keyword matching ----
+def compile_keywords(keywords):
+    """One case-insensitive regex matching any of the keywords."""
+    return re.compile("|".join(re.escape(k) for k in keywords), re.IGNORECASE)
+
+
+def count_keywords(pattern, details):
+    """Keyword hits in the string values (and keys) of an alert's details."""
+    if isinstance(details, str):
+        return len(pattern.findall(details))
+    hits = 0
+    stack = [details]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            hits += len(pattern.findall(item))
+        elif isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return hits
+
+
+# ---- rule compilation ----
+class Rule:
+    __slots__ = ("index", "name", "group", "delta", "cooldown", "check")
+
+    def __init__(self, index, name, group, delta, cooldown, check):
+        self.index = index
+        self.name = name
+        self.group = group
+        self.delta = delta
+        self.cooldown = cooldown
+        self.check = check
+
+
+def _metric_reader(metric):
+    """fn(values) -> metric value or None, for a window's totals or an alert vector."""
+    if metric == "forwarding_rate":
+        sent_i, failed_i = _M["packets_sent"], _M["packets_failed"]
+
+        def read(values):
+            sent = values[sent_i]
+            return (sent - values[failed_i]) / sent if sent > 0 else None
+        return read
+    if metric not in _M:
+        raise ValueError(f"Unknown metric {metric!r}")
+    i = _M[metric]
+    return lambda values: values[i]
+
+
+def _compile_condition(cond, window_slots):
+    """fn(state, alert_values, alert_type) -> (ok, label)."""
+    if "alert_type" in cond:
+        types = frozenset(cond["alert_type"])
+        return lambda state, values, alert_type: (alert_type in types, f"type={alert_type}")
+
+    metric, window = cond["metric"], cond.get("window", "alert")
+    op, threshold = OPS[cond.get("op", ">=")], cond["value"]
+    read = _metric_reader(metric)
+    if window == "alert":
+        label = metric
+        source = lambda state, values: values  # noqa: E731
+    else:
+        if window not in window_slots:
+            raise ValueError(f"Unknown window {window!r}")
+        slot = window_slots[window]
+        label = f"{metric}[{window}]"
+        source = lambda state, values: state.windows[slot].totals  # noqa: E731
+
+    def check(state, values, alert_type):
+        v = read(source(state, values))
+        if v is None or not op(v, threshold):
+            return False, None
+        return True, f"{label}={round(v, 2):g}"
+    return check
+
+
+def compile_rule(index, spec, window_slots):
+    conditions = [_compile_condition(c, window_slots) for c in spec["when"]]
+
+    def check(state, values, alert_type):
+        labels = []
+        for cond in conditions:
+            ok, label = cond(state, values, alert_type)
+            if not ok:
+                return None
+            labels.append(label)
+        return ", ".join(labels)
+
+    return Rule(index, spec["name"], spec.get("group"), spec["delta"], spec.get("cooldown", 0), check)
+
+
+def default_rules(scan_threshold=10, packet_drop_threshold=0.5, high_penalty=0.4,
+                  medium_penalty=0.2, recovery_rate=0.05):
+    """The evaluate_and_update rules, with window-based scan and forwarding checks."""
+    return [
+        {"name": "malicious_keyword", "group": "content", "delta": -high_penalty,
+         "when": [{"metric": "keyword_hits", "window": "alert", "op": ">=", "value": 1}]},
+        {"name": "benign_event", "group": "content", "delta": recovery_rate,
+         "when": [{"alert_type": ["info", "benign", "heartbeat"]}]},
+        {"name": "scan_count", "delta": -high_penalty, "cooldown": 60,
+         "when": [{"metric": "scans", "window": "1m", "op": ">=", "value": scan_threshold}]},
+        {"name": "forwarding_rate", "group": "forwarding", "delta": -high_penalty, "cooldown": 10,
+         "when": [{"metric": "packets_sent", "window": "alert", "op": ">", "value": 0},
+                  {"metric": "forwarding_rate", "window": "10s", "op": "<", "value": packet_drop_threshold}]},
+        {"name": "forwarding_rate", "group": "forwarding", "delta": -medium_penalty, "cooldown": 10,
+         "when": [{"metric": "packets_sent", "window": "alert", "op": ">", "value": 0},
+                  {"metric": "forwarding_rate", "window": "10s", "op": "<", "value": 0.8}]},
+        {"name": "forwarding_rate", "group": "forwarding", "delta": recovery_rate,
+         "when": [{"metric": "packets_sent", "window": "alert", "op": ">", "value": 0},
+                  {"metric": "forwarding_rate", "window": "10s", "op": ">=", "value": 0.8}]},
+    ]
+
+
+# ---- engine ----
+class RuleEngine:
+    """Per-device sliding windows plus compiled rules, evaluated per alert."""
+
+    def __init__(self, rules=None, keywords=DEFAULT_KEYWORDS, windows=WINDOWS):
+        self.window_labels = list(windows)
+        self.spans = [windows[label] for label in self.window_labels]
+        slots = {label: i for i, label in enumerate(self.window_labels)}
+        specs = default_rules() if rules is None else rules
+        self.rules = [compile_rule(i, spec, slots) for i, spec in enumerate(specs)]
+        self.keywords = compile_keywords(keywords)
+        # seconds after which an idle device's state is the same as a fresh one
+        self.horizon = max(self.spans, default=0) + max((r.cooldown for r in self.rules), default=0)
+        self.devices = OrderedDict()  # device_id -> DeviceState, least recently seen first
+
+    def alert_values(self, alert):
+        """The alert's metric vector; its metrics must pass valid_metrics."""
+        metrics = alert.get("metrics") or {}
+        values = [0.0] * len(METRICS)
+        values[_M["alerts"]] = 1
+        values[_M["malicious"]] = 1 if alert.get("type") in MALICIOUS_TYPES else 0
+        values[_M["scans"]] = int(metrics.get("scan_count", 0))
+        values[_M["packets_sent"]] = int(metrics.get("packets_sent", 0))
+        values[_M["packets_failed"]] = int(metrics.get("packets_failed", 0))
+        values[_M["keyword_hits"]] = count_keywords(self.keywords, alert.get("details") or {})
+        return values
+
+    def observe(self, device_id, alert, now=None, count=1):
+        """
+        Fold an alert (standing for `count` identical ones, see ingest_guard)
+        into the device's windows and return the rules that fire as
+        [(name, delta, reason)].
+        """
+        now = time.time() if now is None else now
+        self.expire(now)
+        state = self.devices.get(device_id)
+        if state is None:
+            state = self.devices[device_id] = DeviceState(self.spans, len(self.rules))
+        else:
+            self.devices.move_to_end(device_id)
+        state.last_seen = max(state.last_seen, now)
+        values = self.alert_values(alert)
+        if count != 1:
+            values = [v * count for v in values]
+        for window in state.windows:
+            window.add(now, values)
+
+        alert_type = alert.get("type")
+        alert_type = alert_type.lower() if isinstance(alert_type, str) else ""
+        fired = []
+        claimed = set()
+        for rule in self.rules:
+            if rule.group is not None and rule.group in claimed:
+                continue
+            reason = rule.check(state, values, alert_type)
+            if reason is None:
+                continue
+            if rule.group is not None:
+                claimed.add(rule.group)  # a cooling-down match still shadows the rest of its group
+            if now - state.last_fired[rule.index] < rule.cooldown:
+                continue
+            state.last_fired[rule.index] = now
+            fired.append((rule.name, rule.delta, reason))
+        return fired
+
+    def window_totals(self, device_id):
+        """{window: {metric: total}} for a device, for inspection."""
+        state = self.devices.get(device_id)
+        if state is None:
+            return {}
+        return {label: dict(zip(METRICS, w.totals)) for label, w in zip(self.window_labels, state.windows)}
+
+    def expire(self, now):
+        """Drop the state of devices idle for longer than `horizon` seconds."""
+        devices, cutoff = self.devices, now - self.horizon
+        while devices:
+            state = next(iter(devices.values()))
+            if state.last_seen >= cutoff:
+                break
+            devices.popitem(last=False)
+
+    def forget(self, device_id):
+        self.devices.pop(device_id, None)
@@ -0,0 +1,440 @@
+# sequencer.py
+"""
+Shared-state sequencer for running the CIDN server with several workers.
+
+    python sequencer.py
+    CIDN_SEQUENCER_SOCKET=cidn-sequencer.sock uvicorn cidn_server:app --workers 8
+
+The sequencer process owns the CA, the trust table and the ledger: it is the
+only process that assigns block indices. Workers parse and validate HTTP
+requests, forward writes over a Unix socket, and serve reads from a
+read-only replica that follows the sequencer's ledger segments.
+
+Wire format: every message is a 4-byte big-endian length followed by a JSON
+object. Requests carry an "id" and an "op"; replies echo the id with either
+{"ok": true, "result": ...} or {"ok": false, "error": ...}.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import struct
+import time
+
+from blockchain import Blockchain
+from block_builder import BlockBuilder, iter_events
+from certificate_authority import CertificateAuthority
+from cidn import CIDN
+from ingest import IngestPipeline, QueueFull
+from ingest_guard import IngestGuard
+from ledger_store import SegmentedLedgerStore
+from snapshots import SnapshotStore
+import metrics
+
+logger = logging.getLogger("cidn.sequencer")
+
+CA_FILE = os.environ.get("CIDN_CA_FILE", "certs.json")
+LEDGER_DIR = os.environ.get("CIDN_LEDGER_DIR", "ledger_data")
+LEDGER_FSYNC_EVERY = int(os.environ.get("CIDN_LEDGER_FSYNC_EVERY", "256"))
+LEDGER_FSYNC_INTERVAL = float(os.environ.get("CIDN_LEDGER_FSYNC_INTERVAL", "1.0"))
+BATCH_MAX_EVENTS = int(os.environ.get("CIDN_BATCH_MAX_EVENTS", "500"))
+BATCH_MAX_LATENCY = float(os.environ.get("CIDN_BATCH_MAX_LATENCY", "0.05"))
+QUEUE_DEPTH = int(os.environ.get("CIDN_QUEUE_DEPTH", "100000"))    # alerts waiting for the writer
+WRITER_BATCH = int(os.environ.get("CIDN_WRITER_BATCH", "5000"))    # alerts per receive_alerts call
+SEQUENCER_SOCKET = os.environ.get("CIDN_SEQUENCER_SOCKET", "cidn-sequencer.sock")
+REQUIRE_SIGNATURES = os.environ.get("CIDN_REQUIRE_SIGNATURES", "0") == "1"
+# sliding-window rules on every ingested alert; their deltas add to the fixed alert deltas (opt-in)
+EVALUATE_RULES = os.environ.get("CIDN_RULES", "0") == "1"
+VERIFY_WORKERS = int(os.environ.get("CIDN_VERIFY_WORKERS", "0")) or None  # default: one per CPU
+SNAPSHOT_DIR = os.environ.get("CIDN_SNAPSHOT_DIR", os.path.join(LEDGER_DIR, "snapshots"))
+SNAPSHOT_INTERVAL = float(os.environ.get("CIDN_SNAPSHOT_INTERVAL", "60"))    # seconds between snapshots
+SNAPSHOT_MIN_BLOCKS = int(os.environ.get("CIDN_SNAPSHOT_MIN_BLOCKS", "1000"))  # ...once this many blocks are new
+SNAPSHOT_KEEP = int(os.environ.get("CIDN_SNAPSHOT_KEEP", "3"))
+ARCHIVE_AFTER = float(os.environ.get("CIDN_ARCHIVE_AFTER", str(7 * 24 * 3600)))  # seconds blocks stay hot (0 = never)
+ARCHIVE_INTERVAL = float(os.environ.get("CIDN_ARCHIVE_INTERVAL", "600"))          # seconds between archival passes
+DEVICE_RATE = float(os.environ.get("CIDN_DEVICE_RATE", "20"))          # alerts/s per device (0 = unlimited)
+DEVICE_BURST = int(os.environ.get("CIDN_DEVICE_BURST", "50"))
+GUARD_MAX_DEVICES = int(os.environ.get("CIDN_GUARD_MAX_DEVICES", "100000"))  # per-device buckets kept
+COALESCE_WINDOW = float(os.environ.get("CIDN_COALESCE_WINDOW", "1.0"))  # seconds duplicates are merged (0 = off)
+ADMISSION_RATE = float(os.environ.get("CIDN_ADMISSION_RATE", "50000"))  # alerts/s fleet-wide (0 = unlimited)
+ADMISSION_BURST = int(os.environ.get("CIDN_ADMISSION_BURST", "100000"))
+
+FRAME = struct.Struct("!I")
+
+
+# ---- state ----
+def open_core():
+    """The CA, ledger, block builder and CIDN that own the system state."""
+    ca = CertificateAuthority(CA_FILE)
+    blockchain = Blockchain(
+        store=SegmentedLedgerStore(LEDGER_DIR, fsync_every=LEDGER_FSYNC_EVERY,
+                                   fsync_interval=LEDGER_FSYNC_INTERVAL),
+        import_from="ledger.json",  # only used the first time, while the store is empty
+        checkpoint_file=os.path.join(LEDGER_DIR, "checkpoint.json"),
+    )
+    builder = BlockBuilder(blockchain, max_events=BATCH_MAX_EVENTS, max_latency=BATCH_MAX_LATENCY)
+    cidn = CIDN(ca, blockchain, builder=builder, verify_workers=VERIFY_WORKERS)
+    cidn.require_signatures = REQUIRE_SIGNATURES
+    cidn.evaluate_rules = EVALUATE_RULES
+    cidn.restore(open_snapshots())
+    return ca, blockchain, builder, cidn
+
+
+def open_guard():
+    """The ingestion guard configured by the environment, or None when all its checks are off."""
+    if not (DEVICE_RATE or COALESCE_WINDOW or ADMISSION_RATE):
+        return None
+    return IngestGuard(device_rate=DEVICE_RATE, device_burst=DEVICE_BURST, max_devices=GUARD_MAX_DEVICES,
+                       window=COALESCE_WINDOW, admission_rate=ADMISSION_RATE, admission_burst=ADMISSION_BURST,
+                       require_signatures=REQUIRE_SIGNATURES)
+
+
+def open_snapshots():
+    return SnapshotStore(SNAPSHOT_DIR, keep=SNAPSHOT_KEEP)
+
+
+def open_replica(wait=30.0):
+    """
+    A read-only view of the sequencer's ledger and a CIDN whose trust table is
+    rebuilt from it. Call blockchain.refresh() to follow new blocks.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            store = SegmentedLedgerStore(LEDGER_DIR, readonly=True)
+            break
+        except FileNotFoundError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)  # the sequencer has not created the ledger yet
+
+    blockchain = Blockchain(store=store)
+    cidn = CIDN(None, blockchain)
+
+    def apply(block):
+        for event in iter_events(block.data):
+            cidn.apply_ledger_event(event)
+
+    cidn.restore(open_snapshots(), check=False)  # the sequencer already checked this ledger
+    blockchain.subscribe(apply)
+    return blockchain, cidn
+
+
+async def snapshot_loop(pipeline, cidn, snapshots, interval=SNAPSHOT_INTERVAL, min_blocks=SNAPSHOT_MIN_BLOCKS):
+    """
+    Periodically snapshot the trust table. The copy is taken on the writer
+    (in order with state changes) and written to disk off it.
+    """
+    last = max(snapshots.heights(), default=0)
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        if len(cidn.blockchain.chain) - last < min_blocks:
+            continue
+        try:
+            height, head_hash, ids, columns = await pipeline.call(cidn.snapshot_state)
+            await loop.run_in_executor(None, snapshots.save, height, head_hash, ids, columns)
+            last = height
+            logger.info(f"[CIDN] 💾 Snapshot of {len(ids)} devices at height {height}")
+        except QueueFull:
+            continue
+        except Exception:
+            logger.exception("[CIDN] ❌ Snapshot failed")
+
+
+def final_snapshot(cidn, snapshots):
+    """Snapshot on clean shutdown, after the pipeline has drained."""
+    height, head_hash, ids, columns = cidn.snapshot_state()
+    if height not in snapshots.heights():
+        snapshots.save(height, head_hash, ids, columns)
+
+
+async def archive_loop(blockchain, after=ARCHIVE_AFTER, interval=ARCHIVE_INTERVAL):
+    """Periodically move sealed segments older than `after` seconds into the archive tier."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, blockchain.archive, time.time() - after)
+        except Exception:
+            logger.exception("[Ledger] ❌ Archival failed")
+
+
+def start_background(pipeline, cidn, snapshots):
+    """The snapshot and (when enabled) archival tasks of the process that owns the ledger."""
+    tasks = [asyncio.create_task(snapshot_loop(pipeline, cidn, snapshots))]
+    if ARCHIVE_AFTER > 0:
+        tasks.append(asyncio.create_task(archive_loop(cidn.blockchain)))
+    return tasks
+
+
+def instrument(blockchain, cidn, ca=None, pipeline=None):
+    """Register the state gauges reported on /metrics."""
+    metrics.gauge("cidn_ledger_height", lambda: len(blockchain.chain), "Blocks on the ledger")
+    metrics.gauge("cidn_ledger_bytes", lambda: getattr(blockchain.chain, "nbytes", lambda: None)(),
+                  "Size of the ledger segment and archive files")
+    metrics.gauge("cidn_ledger_archived_bytes", lambda: getattr(blockchain.chain, "archived_nbytes", lambda: None)(),
+                  "Size of the ledger archive files")
+    metrics.gauge("cidn_devices", lambda: len(cidn.trust), "Devices in the trust table")
+    if ca is not None:
+        metrics.gauge("cidn_ca_journal_bytes", ca.journal_bytes, "Size of the CA journal")
+        metrics.gauge("cidn_ca_journal_entries", ca.journal_entries, "CA changes since the last snapshot")
+    if pipeline is not None:
+        metrics.gauge("cidn_ingest_queue_depth", lambda: pipeline.depth, "Alerts and calls waiting for the writer")
+
+
+# ---- wire protocol ----
+def encode_frame(message):
+    data = json.dumps(message, separators=(",", ":")).encode()
+    return FRAME.pack(len(data)) + data
+
+
+async def read_frame(reader):
+    (length,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return json.loads(await reader.readexactly(length))
+
+
+# ---- sequencer ----
+class Sequencer:
+    """Serves write requests from workers through one IngestPipeline."""
+
+    def __init__(self, path, cidn, max_depth=QUEUE_DEPTH, max_batch=WRITER_BATCH, guard=None):
+        self.path = path
+        self.pipeline = IngestPipeline(cidn, max_depth=max_depth, max_batch=max_batch, guard=guard)
+        self._server = None
+
+    async def start(self):
+        await self.pipeline.start()
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # stale socket from a previous run
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        print(f"[Sequencer] ✅ Listening on {self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.pipeline.stop()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                request = await read_frame(reader)
+                # Tasks start in arrival order and enqueue before their first
+                # await, so one worker's requests keep their order.
+                task = asyncio.create_task(self._dispatch(request, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def _dispatch(self, request, writer, lock):
+        reply = {"id": request.get("id")}
+        try:
+            reply["result"] = await self._run(request)
+            reply["ok"] = True
+        except QueueFull:
+            reply.update(ok=False, error="queue_full")
+        except Exception as e:
+            logger.exception("[Sequencer] ❌ %s failed", request.get("op"))
+            reply.update(ok=False, error=str(e))
+        async with lock:
+            writer.write(encode_frame(reply))
+            await writer.drain()
+
+    async def _run(self, request):
+        op = request.get("op")
+        if op == "alerts":
+            return await self.pipeline.alerts(request["alerts"], wait=request.get("wait", False))
+        if op == "register":
+            return await self.pipeline.register(request["device_id"], request["public_key"])
+        if op == "register_many":
+            return await self.pipeline.register_many([tuple(p) for p in request["pairs"]])
+        if op == "record_event":
+            return await self.pipeline.record_event(request["event"])
+        if op == "metrics":
+            return metrics.snapshot()
+        if op == "adjust_fleet":
+            return await self.pipeline.adjust_fleet(request["delta"], request.get("device_ids"),
+                                                    request.get("reason", ""))
+        if op == "feedback":
+            return await self.pipeline.feedback(request["reports"])
+        raise ValueError(f"Unknown op {op!r}")
+
+
+# ---- worker side ----
+class SequencerClient:
+    """
+    Worker-side stand-in for IngestPipeline: same write methods, but every
+    call is forwarded to the sequencer. Requests are pipelined over one
+    connection and matched to replies by id. If the connection drops, the
+    requests waiting on it fail with ConnectionError, and the next request
+    makes one attempt to reconnect. `on_commit` runs after each
+    write that waited for the chain, so the worker's replica can catch up
+    and the caller reads its own writes.
+    """
+
+    def __init__(self, path, on_commit=None, connect_timeout=30.0):
+        self.path = path
+        self.on_commit = on_commit
+        self.connect_timeout = connect_timeout
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._pending = {}
+        self._next_id = 0
+        self._lock = asyncio.Lock()
+        self._closed = False
+
+    async def start(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+        self._reader_task = asyncio.create_task(self._read_replies(self._reader))
+
+    async def stop(self):
+        self._closed = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+    async def _reconnect(self):
+        """One attempt to reopen a dropped connection, e.g. after a sequencer restart."""
+        if self._closed:
+            raise ConnectionError("Sequencer client stopped")
+        self._writer.close()
+        try:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        except OSError as e:
+            raise ConnectionError(f"Sequencer unavailable: {e}") from e
+        self._reader_task = asyncio.create_task(self._read_replies(self._reader))
+        logger.warning("[Sequencer] 🔌 Reconnected to %s", self.path)
+
+    async def _read_replies(self, reader):
+        error = "connection closed"
+        try:
+            while True:
+                reply = await read_frame(reader)
+                future = self._pending.pop(reply.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:  # any reader failure must still release the waiters below
+            error = repr(e)
+            if not isinstance(e, ConnectionError):
+                logger.exception("[Sequencer] ❌ Reading replies failed")
+        finally:
+            # requests sent on this connection will never be answered
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Sequencer connection lost: {error}"))
+
+    async def _request(self, op, **fields):
+        async with self._lock:
+            if self._reader_task.done():
+                await self._reconnect()
+            self._next_id += 1
+            request_id = self._next_id
+            future = asyncio.get_running_loop().create_future()
+            self._pending[request_id] = future
+            try:
+                self._writer.write(encode_frame({"id": request_id, "op": op, **fields}))
+                await self._writer.drain()
+            except (ConnectionError, RuntimeError) as e:  # RuntimeError: transport already closed
+                self._pending.pop(request_id, None)
+                raise ConnectionError(f"Sequencer connection lost: {e!r}") from e
+        reply = await future
+        if not reply["ok"]:
+            if reply["error"] == "queue_full":
+                raise QueueFull("sequencer queue full")
+            raise RuntimeError(reply["error"])
+        return reply["result"]
+
+    def _committed(self):
+        if self.on_commit is not None:
+            self.on_commit()
+
+    async def alerts(self, alerts, wait=False):
+        result = await self._request("alerts", alerts=alerts, wait=wait)
+        if wait:
+            self._committed()
+        return result
+
+    async def register(self, device_id, public_key):
+        cert = await self._request("register", device_id=device_id, public_key=public_key)
+        self._committed()
+        return cert
+
+    async def register_many(self, pairs):
+        certs = await self._request("register_many", pairs=pairs)
+        self._committed()
+        return certs
+
+    async def record_event(self, event):
+        await self._request("record_event", event=event)
+        self._committed()
+
+    async def adjust_fleet(self, delta, device_ids=None, reason=""):
+        changed = await self._request("adjust_fleet", delta=delta, device_ids=device_ids, reason=reason)
+        self._committed()
+        return changed
+
+    async def feedback(self, reports):
+        return await self._request("feedback", reports=reports)
+
+    async def metrics(self):
+        """The sequencer's metrics.snapshot()."""
+        return await self._request("metrics")
+
+
+# ---- entry point ----
+async def serve(path):
+    metrics.setup_logging()
+    ca, blockchain, builder, cidn = open_core()
+    sequencer = Sequencer(path, cidn, guard=open_guard())
+    instrument(blockchain, cidn, ca, sequencer.pipeline)
+    await sequencer.start()
+    snapshots = open_snapshots()
+    background = start_background(sequencer.pipeline, cidn, snapshots)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    for task in background:
+        task.cancel()
+    await sequencer.stop()
+    final_snapshot(cidn, snapshots)
+    builder.close()
+    blockchain.close()
+    ca.close()
+    print("[Sequencer] ⏹️ Stopped")
+    metrics.stop_logging()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CIDN ledger sequencer")
+    parser.add_argument("--socket", default=SEQUENCER_SOCKET, help="Unix socket path for workers")
+    args = parser.parse_args()
+    asyncio.run(serve(args.socket))
@@ -0,0 +1,403 @@
+# simulator.py
+"""
+Offline replay and parameter sweeps for tuning the trust policy.
+
+    python simulator.py --input alerts.ndjson --labels malicious.json --grid grid.json
+    python simulator.py --input ledger.ndjson --param alert_penalty=0.2,0.3 --param revoke_threshold=0.1,0.2
+    python simulator.py --synthetic 1000000 --devices 10000 --grid grid.json --workers 8
+
+Replays an alert stream straight through CIDN, once per parameter
+configuration, with no HTTP: devices are registered with an in-memory CA,
+ledger entries go to a NullLedger that keeps nothing, and logging and
+metrics are off. Configurations run in parallel on a process pool, and
+each worker receives the stream once.
+
+Input (--input) is NDJSON or a JSON array of either alerts as sent to
+/alert or /alerts/batch, or blocks from /ledger/export, whose *_alert and
+alert_received events become alerts (coalesced ones keep their "count").
+Every device is registered once, up front, so re-registrations in a ledger
+do not reset trust. A numeric "timestamp" on an alert is its stream time;
+otherwise alerts are spaced at --rate per second. --synthetic generates a
+labelled stream instead.
+
+--labels names the devices that really are malicious (a JSON list of ids,
+or {id: true/false}); without it the false-revocation figures are null.
+--grid is a JSON object {parameter: [values]}, and its cartesian product
+is swept. Any CIDN parameter can be used: alert_reward, alert_penalty,
+revoke_threshold, initial_trust, and with --rules the rule-engine ones
+(scan_threshold, packet_drop_threshold, high_penalty, medium_penalty,
+recovery_rate).
+
+Alerts go through CIDN.receive_alerts in batches, as the ingest pipeline
+sends them. With --rules the rule engine runs on every alert as it does
+on the server (CIDN.evaluate_rules); alerts are then sent one at a time,
+so that each is folded into the rule windows at its own stream time.
+
+Reported per configuration: revocations, true and false revocations,
+detection and false-revocation rates, time-to-revoke (stream seconds from a
+malicious device's first malicious-type alert) and alerts-to-revoke.
+Devices revoked without ever sending a malicious-type alert (only possible
+with --rules, e.g. on keywords in an alert's details) have no onset: they
+are counted as revoked_without_onset and left out of time-to-revoke.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from block_builder import iter_events
+from certificate_authority import CertificateAuthority
+from cidn import ALERT_TYPES, CIDN
+import metrics
+from rules import MALICIOUS_TYPES
+
+DEFAULT_RATE = 1000.0  # alerts/s of stream time, for alerts without a timestamp
+DEFAULT_BATCH = 5000   # alerts per receive_alerts call, as the ingest pipeline's writer batch
+ALERT_SUFFIX = "_alert"
+SYNTHETIC_METRICS = {
+    "benign": {"packets_sent": 120, "packets_failed": 1},
+    "scan": {"scan_count": 40},
+    "ddos": {},
+    "packet_drop": {"packets_sent": 100, "packets_failed": 80},
+}
+
+
+class NullLedger:
+    """
+    Stands in for the Blockchain and the BlockBuilder: takes entries and
+    keeps only their number.
+    """
+
+    chain = ()
+
+    def __init__(self):
+        self.entries = 0
+
+    def append(self, event):
+        self.entries += 1
+
+    def extend(self, events):
+        self.entries += len(events)
+        return []
+
+    def add_block(self, data):
+        self.entries += 1
+
+    def flush(self):
+        pass
+
+    def subscribe(self, listener):
+        pass
+
+    def head(self):
+        return 0, None
+
+
+# ---- streams ----
+class Stream:
+    """
+    An alert stream prepared once (stream times, per-device alert numbers,
+    onset of malicious alerts) and shared by every configuration.
+    """
+
+    def __init__(self, alerts, devices=(), labels=None, rate=DEFAULT_RATE):
+        self.alerts = alerts
+        ids = dict.fromkeys(devices)
+        ids.update((a["device_id"], None) for a in alerts if isinstance(a.get("device_id"), str))
+        self.devices = list(ids)
+        self.labels = None if labels is None else set(labels)  # ids of the truly malicious devices
+        self.times = []
+        self.ordinal = []  # 1-based number of the alert among its device's alerts
+        self.onset = {}    # device_id -> stream time of its first malicious-type alert
+        seen = {}
+        for pos, alert in enumerate(alerts):
+            ts = alert.get("timestamp")
+            ts = float(ts) if isinstance(ts, (int, float)) else pos / rate
+            device_id = alert.get("device_id")
+            self.times.append(ts)
+            n = seen[device_id] = seen.get(device_id, 0) + 1 if isinstance(device_id, str) else 0
+            self.ordinal.append(n)
+            if alert.get("type") in MALICIOUS_TYPES and device_id not in self.onset:
+                self.onset[device_id] = ts
+        counts = [alert.get("count", 1) for alert in alerts]
+        self.counts = counts if any(c != 1 for c in counts) else None
+
+    def __len__(self):
+        return len(self.alerts)
+
+
+def _block_time(block):
+    ts = block.get("timestamp")
+    if isinstance(ts, str):
+        try:
+            return datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            return None
+    return ts
+
+
+def read_records(path):
+    """JSON objects from an NDJSON file or a JSON array."""
+    with open(path, "r") as f:
+        head = f.read(1)
+        while head.isspace():
+            head = f.read(1)
+        f.seek(0)
+        if head == "[":
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_stream(path, labels=None, rate=DEFAULT_RATE):
+    """A Stream from recorded alerts or a ledger export (see the module docstring)."""
+    alerts, devices = [], []
+    for record in read_records(path):
+        if "data" not in record or "index" not in record:
+            alerts.append(record)
+            continue
+        ts = _block_time(record)
+        for event in iter_events(record["data"]):
+            kind = event.get("event") or ""
+            if kind == "register":
+                devices.append(event.get("device_id"))
+            elif kind == "register_batch":
+                devices.extend(event.get("devices") or ())
+            elif event.get("device_id") and (kind == "alert_received" or kind.endswith(ALERT_SUFFIX)):
+                if kind == "alert_received":  # logged whole, metrics included, by older servers
+                    alert = {"device_id": event["device_id"], "type": event.get("type"),
+                             "metrics": event.get("metrics") or {}}
+                else:
+                    alert = {"device_id": event["device_id"], "type": kind[:-len(ALERT_SUFFIX)]}
+                if ts is not None:
+                    alert["timestamp"] = ts
+                if event.get("count", 1) != 1:
+                    alert["count"] = event["count"]
+                alerts.append(alert)
+    return Stream(alerts, [d for d in devices if isinstance(d, str)], labels, rate)
+
+
+def load_labels(path):
+    with open(path, "r") as f:
+        labels = json.load(f)
+    if isinstance(labels, dict):
+        return [device_id for device_id, malicious in labels.items() if malicious]
+    return labels
+
+
+def synthetic_stream(alerts=1000000, devices=10000, malicious=0.05, noise=0.02, attack=0.3,
+                     rate=DEFAULT_RATE, seed=1):
+    """
+    A labelled stream: benign devices send benign alerts with a `noise`
+    share of false-positive malicious ones; malicious devices start
+    attacking at a random point, after which `attack` of their alerts are
+    malicious.
+    """
+    rng = np.random.default_rng(seed)
+    ids = [f"sim-{i:06d}" for i in range(devices)]
+    bad = rng.random(devices) < malicious
+    start = np.where(bad, rng.random(devices) * alerts / rate, np.inf)
+    who = rng.integers(0, devices, alerts)
+    times = np.sort(rng.random(alerts)) * alerts / rate
+    p_malicious = np.where(times >= start[who], attack, noise)
+    is_malicious = rng.random(alerts) < p_malicious
+    kinds = rng.choice(["scan", "ddos", "packet_drop"], alerts)
+    out = []
+    for d, ts, m, kind in zip(who.tolist(), times.tolist(), is_malicious.tolist(), kinds.tolist()):
+        kind = kind if m else "benign"
+        out.append({"device_id": ids[d], "type": kind, "timestamp": ts, "metrics": SYNTHETIC_METRICS[kind]})
+    return Stream(out, ids, [ids[i] for i in np.flatnonzero(bad)], rate)
+
+
+# ---- simulation ----
+@contextlib.contextmanager
+def quiet():
+    """No logging and no metrics while simulating."""
+    enabled = metrics.ENABLED
+    metrics.ENABLED = False
+    logging.disable(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+        metrics.ENABLED = enabled
+
+
+def make_cidn(params):
+    ledger = NullLedger()
+    cidn = CIDN(CertificateAuthority(None), ledger, builder=ledger)
+    for name, value in params.items():
+        if not hasattr(cidn, name) or callable(getattr(cidn, name)):
+            raise ValueError(f"Unknown CIDN parameter {name!r}")
+        setattr(cidn, name, value)
+    cidn.peers.initial_trust = cidn.initial_trust
+    return cidn
+
+
+def _summary(values):
+    if not values:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    return {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)), "max": float(values.max())}
+
+
+def simulate(stream, params, rules=False, batch=DEFAULT_BATCH):
+    """Replay `stream` through a CIDN configured with `params`; returns the figures for it."""
+    start = time.perf_counter()
+    with quiet():
+        cidn = make_cidn(params)
+        cidn.ca.register_devices([(device_id, "simulated") for device_id in stream.devices])
+        cidn.add_devices(stream.devices)
+        revoked_at = {}  # device_id -> position of the alert that got it revoked
+        alerts, revoked = stream.alerts, cidn.revoked
+
+        cidn.evaluate_rules = rules
+        counts = stream.counts
+        step = 1 if rules else batch  # rule windows need each alert's own stream time
+        for first in range(0, len(alerts), step):
+            chunk = alerts[first:first + step]
+            statuses = cidn.receive_alerts(chunk, counts[first:first + step] if counts else None,
+                                           now=stream.times[first])
+            for offset, status in enumerate(statuses):
+                # a device's first rejected alert of a known type after it was revoked is the one that did it
+                if status == "ok":
+                    continue
+                alert = chunk[offset]
+                device_id = alert.get("device_id")
+                if alert.get("type") in ALERT_TYPES and device_id not in revoked_at and device_id in revoked:
+                    revoked_at[device_id] = first + offset
+
+    labels = stream.labels
+    true_revoked = [d for d in revoked_at if labels is None or d in labels]
+    false_revoked = len(revoked_at) - len(true_revoked) if labels is not None else None
+    benign_devices = len(stream.devices) - len(labels) if labels is not None else None
+    # with --rules a device can be revoked (e.g. on keywords) without any malicious-type alert
+    timed = [d for d in true_revoked if d in stream.onset]
+    return {
+        "params": params,
+        "alerts": len(stream),
+        "devices": len(stream.devices),
+        "revoked": len(revoked_at),
+        "true_revocations": len(true_revoked) if labels is not None else None,
+        "false_revocations": false_revoked,
+        "detection_rate": len(true_revoked) / len(labels) if labels else None,
+        "false_revocation_rate": false_revoked / benign_devices if benign_devices else None,
+        "revoked_without_onset": sum(d not in stream.onset for d in revoked_at),
+        "time_to_revoke": _summary([stream.times[revoked_at[d]] - stream.onset[d] for d in timed]),
+        "alerts_to_revoke": _summary([stream.ordinal[revoked_at[d]] for d in true_revoked]),
+        "ledger_entries": cidn.builder.entries,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+# ---- sweeps ----
+def expand_grid(grid):
+    """Every combination of a {parameter: [values]} grid, as a list of {parameter: value}."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+
+
+_stream = None  # the stream in each pool worker, set once by _init_worker
+
+
+def _init_worker(stream):
+    global _stream
+    _stream = stream
+
+
+def _run(args):
+    params, rules, batch = args
+    return simulate(_stream, params, rules, batch)
+
+
+def sweep(stream, configs, workers=None, rules=False, batch=DEFAULT_BATCH):
+    """simulate() for every configuration, across a process pool; results in config order."""
+    workers = min(workers or os.cpu_count() or 1, len(configs))
+    if workers <= 1:
+        return [simulate(stream, params, rules, batch) for params in configs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(stream,)) as pool:
+        return list(pool.map(_run, [(params, rules, batch) for params in configs]))
+
+
+# ---- entry point ----
+def parse_param(spec):
+    name, _, values = spec.partition("=")
+    if not values:
+        raise argparse.ArgumentTypeError(f"Expected name=v1,v2,... not {spec!r}")
+    return name.strip(), [json.loads(v) for v in values.split(",")]
+
+
+def format_row(result):
+    fmt = lambda v: "-" if v is None else f"{v:.3f}" if isinstance(v, float) else str(v)  # noqa: E731
+    ttr = result["time_to_revoke"]
+    return "  ".join([
+        ",".join(f"{k}={v}" for k, v in result["params"].items()) or "(defaults)",
+        f"revoked={result['revoked']}",
+        f"detect={fmt(result['detection_rate'])}",
+        f"false={fmt(result['false_revocation_rate'])}",
+        f"ttr_p50={fmt(ttr and ttr['p50'])}s",
+        f"{result['seconds']:.1f}s",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline CIDN trust-policy simulator")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="recorded alerts or a ledger export (NDJSON or JSON array)")
+    source.add_argument("--synthetic", type=int, metavar="ALERTS", help="generate a labelled stream")
+    parser.add_argument("--labels", help="JSON list of malicious device ids, or {id: bool}")
+    parser.add_argument("--devices", type=int, default=10000, help="synthetic devices")
+    parser.add_argument("--malicious", type=float, default=0.05, help="synthetic share of malicious devices")
+    parser.add_argument("--noise", type=float, default=0.02, help="synthetic false-positive alert share")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="alerts/s for alerts without timestamps")
+    parser.add_argument("--grid", help="JSON file (or inline JSON) with {parameter: [values]}")
+    parser.add_argument("--param", type=parse_param, action="append", default=[], metavar="NAME=V1,V2")
+    parser.add_argument("--rules", action="store_true", help="also run the rule engine on every alert")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH)
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--output", help="write the JSON results here")
+    args = parser.parse_args()
+
+    grid = {}
+    if args.grid:
+        grid.update(json.loads(args.grid) if args.grid.lstrip().startswith("{") else json.load(open(args.grid)))
+    grid.update(args.param)
+    configs = expand_grid(grid)
+
+    start = time.perf_counter()
+    if args.synthetic:
+        stream = synthetic_stream(args.synthetic, args.devices, args.malicious, args.noise,
+                                  rate=args.rate, seed=args.seed)
+    else:
+        stream = load_stream(args.input, load_labels(args.labels) if args.labels else None, args.rate)
+    print(f"[Simulator] 📥 {len(stream)} alerts from {len(stream.devices)} devices "
+          f"in {time.perf_counter() - start:.1f}s; {len(configs)} configurations", file=sys.stderr)
+
+    start = time.perf_counter()
+    results = sweep(stream, configs, args.workers, args.rules, args.batch)
+    for result in results:
+        print(format_row(result), file=sys.stderr)
+    print(f"[Simulator] ✅ Done in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# snapshots.py
+import json
+import os
+import time
+
+import numpy as np
+
+from trust_table import COLUMNS
+
+SNAPSHOT_PREFIX = "trust-"
+SNAPSHOT_SUFFIX = ".npz"
+
+
+class SnapshotStore:
+    """
+    Point-in-time copies of the trust table, each tagged with the ledger
+    height it reflects and the hash of the block at that height, so it can
+    only be restored onto the ledger it was taken from. Files are written
+    atomically as `trust-{height}.npz`; the newest `keep` are kept.
+    """
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, height):
+        return os.path.join(self.directory, f"{SNAPSHOT_PREFIX}{height:012d}{SNAPSHOT_SUFFIX}")
+
+    def heights(self):
+        """Heights of the stored snapshots, newest first."""
+        heights = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+                heights.append(int(name[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)]))
+        return sorted(heights, reverse=True)
+
+    def save(self, height, head_hash, ids, columns):
+        meta = {"height": height, "head_hash": head_hash, "devices": len(ids), "created": time.time()}
+        path = self._path(height)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f,
+                     meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+                     ids=np.frombuffer("\0".join(ids).encode(), dtype=np.uint8),
+                     **columns)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        for old in self.heights()[self.keep:]:
+            os.unlink(self._path(old))
+        return path
+
+    def load(self, height):
+        """
+        (meta, ids, columns) of the snapshot at `height`. Besides the trust
+        table's COLUMNS, `columns` has any other arrays saved with it.
+        """
+        with np.load(self._path(height)) as f:
+            meta = json.loads(f["meta"].tobytes())
+            raw = f["ids"].tobytes().decode()
+            ids = raw.split("\0") if raw else []
+            columns = {name: f[name] for name in COLUMNS}
+            columns.update((name, f[name]) for name in f.files if name not in columns and name not in ("meta", "ids"))
+        return meta, ids, columns
@@ -1,13 +1,19 @@
 import requests
 import time
+import os
+import sys
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from cidn_client import CIDNClient
 
 SERVER_URL = "http://127.0.0.1:8000"
+client = CIDNClient(SERVER_URL)
 
 # Helper functions
 def register_device(device_id):
-    payload = {"device_id": device_id, "public_key": "fake_key"}
-    resp = requests.post(f"{SERVER_URL}/register", json=payload)
-    print(f"[Register] {device_id} ->", resp.json())
+    print(f"[Register] {device_id} ->", client.register(device_id, "fake_key"))
 
 def send_alert(device_id, alert_type, metrics=None):
     payload = {
@@ -15,13 +21,13 @@ def send_alert(device_id, alert_type, metrics=None):
         "type": alert_type,
         "metrics": metrics or {}
     }
-    resp = requests.post(f"{SERVER_URL}/alert", json=payload)
-    print(f"[Alert] {device_id} ({alert_type}) ->", resp.json())
-    return resp.json()
+    # wait=true: answer with the alert's status once it is on the ledger
+    resp = client.send_alert(payload, wait=True)
+    print(f"[Alert] {device_id} ({alert_type}) ->", resp)
+    return resp
 
 def get_trust(device_id):
-    resp = requests.get(f"{SERVER_URL}/trust/{device_id}")
-    return resp.json()
+    return client.get_trust(device_id)
 
 
 def run_simulation():
@@ -57,13 +63,266 @@ def run_simulation():
         print(trust)
 
         # log into blockchain for dashboard
-        requests.post(f"{SERVER_URL}/log_test", json={
-            "test": f"Trust of {d}",
-            "status": f"{trust}"
-        })
+        client.log_test(f"Trust of {d}", f"{trust}")
 
     print("\n[Test] Results logged into blockchain. Open /dashboard to view.")
 
 
+def run_multiworker_check(workers=4, devices=20, alerts_per_device=50, port=8100):
+    """
+    Start a sequencer plus `workers` uvicorn workers on a fresh ledger, fire
+    alerts at them concurrently, and check that the result is one valid chain
+    holding every event exactly once.
+    """
+    from blockchain import Blockchain
+    from block_builder import iter_events
+    from ledger_store import SegmentedLedgerStore
+
+    print(f"\n=== CIDN Multi-worker Check: {workers} workers ===")
+    repo = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="cidn-mw-")
+    env = dict(os.environ,
+               PYTHONPATH=repo,
+               CIDN_LEDGER_DIR=os.path.join(workdir, "ledger"),
+               CIDN_CA_FILE=os.path.join(workdir, "certs.json"),
+               CIDN_SEQUENCER_SOCKET=os.path.join(workdir, "sequencer.sock"),
+               # every alert must reach the ledger for the counts below
+               CIDN_DEVICE_RATE="0", CIDN_COALESCE_WINDOW="0", CIDN_ADMISSION_RATE="0")
+    url = f"http://127.0.0.1:{port}"
+
+    sequencer = subprocess.Popen([sys.executable, os.path.join(repo, "sequencer.py")], cwd=workdir, env=env)
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "cidn_server:app", "--port", str(port),
+                               "--workers", str(workers), "--log-level", "warning"], cwd=workdir, env=env)
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"{url}/devices", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+
+        names = [f"MW_{i}" for i in range(devices)]
+        mw_client = CIDNClient(url, pool_size=32)
+        mw_client.register_many([(d, "fake_public_key") for d in names])
+
+        def send(i):
+            alert = {"device_id": names[i % devices], "type": "benign"}
+            return mw_client.send_alert(alert, wait=True)["status"]
+
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            statuses = list(pool.map(send, range(devices * alerts_per_device)))
+        print(f"[Multi-worker] {statuses.count('ok')}/{len(statuses)} alerts accepted")
+        scraped = mw_client.request("GET", "/metrics").text
+        mw_client.close()
+        print("\n".join(line for line in scraped.splitlines() if line.startswith("cidn_alerts_total")))
+    finally:
+        server.terminate()
+        server.wait()
+        sequencer.terminate()
+        sequencer.wait()
+
+    chain = Blockchain(store=SegmentedLedgerStore(env["CIDN_LEDGER_DIR"], readonly=True))
+    first_bad = chain.find_first_invalid()
+    indices_ok = all(block.index == i for i, block in enumerate(chain.chain))
+    alert_events = sum(1 for block in chain.chain for e in iter_events(block.data)
+                       if e.get("event") == "benign_alert")
+    expected = devices * alerts_per_device
+    print(f"[Multi-worker] chain height {len(chain.chain)}, first invalid block: {first_bad}, "
+          f"alert events {alert_events}/{expected}")
+    ok = first_bad is None and indices_ok and alert_events == expected and statuses.count("ok") == expected
+    print("[Multi-worker] ✅ single valid chain" if ok else "[Multi-worker] ❌ chain check failed")
+    chain.close()
+    return ok
+
+
+def run_ledger_index_check():
+    """
+    Per-device ledger queries and trust history must include whole-fleet
+    adjustments ("devices": null) sharing a block with the device's events.
+    """
+    from blockchain import Blockchain
+    from block_builder import BlockBuilder
+    from certificate_authority import CertificateAuthority
+    from cidn import CIDN
+    from ledger_index import LedgerIndex
+
+    print("\n=== CIDN Ledger Index Check ===")
+    chain = Blockchain()
+    index = LedgerIndex(chain)
+    builder = BlockBuilder(chain, max_events=100, max_latency=60)
+    cidn = CIDN(CertificateAuthority(None), chain, builder=builder)
+    cidn.ca.register_device("Fleet_1", "check")
+    cidn.add_device("Fleet_1")
+    cidn.receive_alert({"device_id": "Fleet_1", "type": "benign"})
+    cidn.adjust_fleet(-0.1, reason="check")
+    builder.flush()  # one block: register + benign_alert + fleet_adjust
+    builder.close()
+
+    events, _ = index.query(device_id="Fleet_1")
+    kinds = [e["data"]["event"] for e in events]
+    history = [round(p["trust"], 2) for p in index.trust_history("Fleet_1")]
+    print(f"[Ledger Index] blocks {len(chain.chain)}, events {kinds}, trust history {history}")
+    ok = len(chain.chain) == 2 and kinds == ["register", "benign_alert", "fleet_adjust"] \
+        and history == [0.5, 0.55, 0.45] and history[-1] == round(cidn.trust["Fleet_1"], 2)
+    print("[Ledger Index] ✅ fleet adjustments indexed" if ok else "[Ledger Index] ❌ check failed")
+    return ok
+
+
+def run_simulator_rules_check():
+    """
+    simulator.py --rules: a device revoked by a rule without ever sending a
+    malicious-type alert must not break the sweep, with or without labels.
+    """
+    import simulator
+
+    print("\n=== CIDN Simulator --rules Check ===")
+    alerts = [{"device_id": "Keyword_1", "type": "benign", "details": {"note": "malware beacon"}}] * 3 \
+        + [{"device_id": "Scanner_1", "type": "scan", "metrics": {"scan_count": 40}}] * 3 \
+        + [{"device_id": "Honest_1", "type": "benign", "metrics": {"packets_sent": 100, "packets_failed": 1}}] * 3
+    ok = True
+    for labels in (["Keyword_1", "Scanner_1"], None):
+        stream = simulator.Stream(alerts, labels=labels)
+        results = simulator.sweep(stream, [{}, {"alert_penalty": 0.4}], workers=2, rules=True)
+        for r in results:
+            print(f"[Simulator] labels={labels is not None} {simulator.format_row(r)} "
+                  f"without_onset={r['revoked_without_onset']}")
+            ok &= r["revoked"] == 2 and r["revoked_without_onset"] == 1 and r["time_to_revoke"] is not None
+            ok &= labels is None or (r["detection_rate"] == 1.0 and r["false_revocations"] == 0)
+    print("[Simulator] ✅ rule-only revocations handled" if ok else "[Simulator] ❌ check failed")
+    return ok
+
+
+def run_rules_ingest_check():
+    """
+    With evaluate_rules, CIDN.receive_alerts runs the rule engine on every
+    accepted alert; the result replays without mismatches, and idle
+    devices' rule state is dropped.
+    """
+    from blockchain import Blockchain
+    from certificate_authority import CertificateAuthority
+    from cidn import CIDN
+
+    print("\n=== CIDN Rules on Ingest Check ===")
+    chain = Blockchain()
+    cidn = CIDN(CertificateAuthority(None), chain)
+    cidn.evaluate_rules = True
+    devices = ["Keyword_1", "Dropper_1", "Honest_1"]
+    cidn.ca.register_devices([(d, "check") for d in devices])
+    cidn.add_devices(devices)
+    statuses = cidn.receive_alerts(
+        [{"device_id": "Keyword_1", "type": "benign", "details": {"note": "malware beacon"}}] * 2
+        + [{"device_id": "Dropper_1", "type": "benign", "metrics": {"packets_sent": 100, "packets_failed": 90}}] * 2
+        + [{"device_id": "Honest_1", "type": "benign", "metrics": {"packets_sent": 100, "packets_failed": 1}}] * 2)
+    trust = {d: round(cidn.trust[d], 2) for d in devices}
+    replica = CIDN(None, chain)
+    report = replica.restore(None)
+    engine = cidn.rule_engine()
+    engine.expire(time.time() + engine.horizon + 1)
+    print(f"[Rules] statuses {statuses}, trust {trust}, revoked {sorted(cidn.revoked)}, "
+          f"replay mismatches {report['mismatches']}, devices tracked after idle {len(engine.devices)}")
+    ok = statuses[1] == "rejected" and sorted(cidn.revoked) == ["Keyword_1"] \
+        and trust["Dropper_1"] < 0.5 < trust["Honest_1"] and report["mismatches"] == 0 \
+        and {d: round(replica.trust[d], 2) for d in devices} == trust and not engine.devices
+    print("[Rules] ✅ rules evaluated on ingest" if ok else "[Rules] ❌ check failed")
+    return ok
+
+
+def run_malformed_metrics_check():
+    """
+    Alerts with malformed metrics are marked invalid before any state
+    changes; the rest of their batch is applied and logged as usual.
+    """
+    from blockchain import Blockchain
+    from certificate_authority import CertificateAuthority
+    from cidn import CIDN
+
+    print("\n=== CIDN Malformed Metrics Check ===")
+    chain = Blockchain()
+    cidn = CIDN(CertificateAuthority(None), chain)
+    cidn.evaluate_rules = True
+    cidn.ca.register_device("Sensor_1", "check")
+    cidn.add_device("Sensor_1")
+    bad = [{"scan_count": "lots"}, [1, 2], {"scan_count": None}, {"packets_sent": float("nan")},
+           {"packets_failed": -1}, "metrics"]
+    alerts = [{"device_id": "Sensor_1", "type": "benign", "metrics": {"packets_sent": 100, "packets_failed": 1}}] \
+        + [{"device_id": "Sensor_1", "type": "scan", "metrics": m} for m in bad] \
+        + [{"device_id": ["not", "an", "id"], "type": "benign"}]
+    try:
+        statuses = cidn.receive_alerts(alerts)
+        cidn.evaluate_and_update("Sensor_1", alerts[1])
+        cidn.receive_alert(alerts[2])
+    except Exception as e:
+        print(f"[Malformed] ❌ {type(e).__name__}: {e}")
+        return False
+    replica = CIDN(None, chain)
+    report = replica.restore(None)
+    counted = int(cidn.trust.alerts[cidn.trust.slots["Sensor_1"]])
+    print(f"[Malformed] statuses {statuses}, trust {cidn.trust['Sensor_1']:.2f}, alerts counted {counted}, "
+          f"replay mismatches {report['mismatches']}, replayed trust {replica.trust['Sensor_1']:.2f}")
+    ok = statuses == ["ok"] + ["rejected"] * (len(alerts) - 1) and cidn.trust["Sensor_1"] > 0.5 \
+        and report["mismatches"] == 0 and replica.trust["Sensor_1"] == cidn.trust["Sensor_1"] \
+        and counted == 1
+    print("[Malformed] ✅ malformed metrics rejected" if ok else "[Malformed] ❌ check failed")
+    return ok
+
+
+def run_discovery_check():
+    """
+    A TCP discovery job against a local listener finds and registers
+    127.0.0.1 and reports its progress; bad scan options are refused.
+    """
+    import asyncio
+    from discovery import DiscoveryJobs
+
+    print("\n=== CIDN Discovery Check ===")
+    registered = []
+
+    async def register(pairs):
+        registered.extend(pairs)
+
+    async def scan():
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        jobs = DiscoveryJobs(register=register, known=lambda device_id: False, register_interval=0.1)
+        try:
+            job = jobs.start("127.0.0.1/32", methods=["tcp"], ports=[port], timeout=1.0)
+            await job.task
+            return job.to_dict(), jobs.results(job.id)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    status, hosts = asyncio.run(scan())
+    print(f"[Discovery] status {status['status']}, probed {status['probed']}/{status['total']}, "
+          f"found {status['found']}, registered {registered}, hosts {hosts}")
+    ok = status["status"] == "done" and status["total"] == status["probed"] == 1 \
+        and status["found"] == status["registered"] == 1 and [h["ip"] for h in hosts] == ["127.0.0.1"] \
+        and registered == [("127.0.0.1", "auto_discovered")]
+
+    refused = []
+    for options in ({"rate": 0}, {"ports": "80"}, {"ports": [70000]}, {"ports": []},
+                    {"timeout": 0}, {"concurrency": 0}, {"methods": "tcp"}):
+        try:
+            DiscoveryJobs().start("127.0.0.1/32", **options)
+        except ValueError:
+            refused.append(options)
+    print(f"[Discovery] refused {len(refused)}/7 bad option sets")
+    ok = ok and len(refused) == 7
+    print("[Discovery] ✅ local scan found and registered" if ok else "[Discovery] ❌ check failed")
+    return ok
+
+
+CHECKS = {
+    "multiworker": run_multiworker_check,
+    "ledger-index": run_ledger_index_check,
+    "simulator-rules": run_simulator_rules_check,
+    "rules-ingest": run_rules_ingest_check,
+    "malformed-metrics": run_malformed_metrics_check,
+    "discovery": run_discovery_check,
+}
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in CHECKS:
+        sys.exit(0 if CHECKS[sys.argv[1]]() else 1)
     run_simulation()
@@ -0,0 +1,205 @@
+# trust_table.py
+import time
+from collections.abc import Mapping, MutableSet
+
+import numpy as np
+
+COLUMNS = {
+    "trust": np.float64,
+    "updated": np.float64,
+    "revoked_flags": bool,
+    "alerts": np.int32,
+    "malicious": np.int32,
+}
+
+
+class TrustTable(Mapping):
+    """
+    Column-oriented trust store. Each device gets a slot index; per-device
+    state lives in NumPy arrays indexed by slot:
+
+      trust     float64   current trust score [0..1]
+      updated   float64   time of the last trust change
+      revoked_flags  bool revocation flag (also exposed as the set-like `revoked`)
+      alerts    int32     alerts received
+      malicious int32     of which malicious
+
+    It behaves like the old {device_id: trust} dict (get, [], in, len,
+    iteration, assignment), so existing code keeps working, and adds
+    vectorized operations over device groups and fleet statistics.
+    """
+
+    def __init__(self, capacity=1024):
+        self.slots = {}    # device_id -> slot
+        self.ids = []      # slot -> device_id
+        self._alloc(capacity)
+        self.revoked = RevokedView(self)
+
+    def _alloc(self, capacity):
+        old = getattr(self, "trust", None)
+        columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in COLUMNS.items()}
+        if old is not None:
+            n = len(self.ids)
+            for name, column in columns.items():
+                column[:n] = getattr(self, name)[:n]
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+    def slot(self, device_id):
+        """Slot of a device, allocating one if it is new."""
+        slot = self.slots.get(device_id)
+        if slot is None:
+            slot = len(self.ids)
+            if slot == len(self.trust):
+                self._alloc(2 * len(self.trust))
+            self.slots[device_id] = slot
+            self.ids.append(device_id)
+        return slot
+
+    def slots_of(self, device_ids):
+        """Slot array for known devices among `device_ids` (unknown ones are skipped)."""
+        slots = self.slots
+        return np.fromiter((slots[d] for d in device_ids if d in slots), dtype=np.int64)
+
+    # ---- dict interface ----
+    def __getitem__(self, device_id):
+        return float(self.trust[self.slots[device_id]])
+
+    def __setitem__(self, device_id, value):
+        slot = self.slot(device_id)
+        self.trust[slot] = value
+        self.updated[slot] = time.time()
+
+    def __contains__(self, device_id):
+        return device_id in self.slots
+
+    def __iter__(self):
+        return iter(self.ids[:])  # snapshot; the writer may add devices meanwhile
+
+    def __len__(self):
+        return len(self.ids)
+
+    # ---- per-device counters ----
+    def count_alerts(self, device_id, total, malicious=0):
+        slot = self.slots[device_id]
+        self.alerts[slot] += total
+        self.malicious[slot] += malicious
+
+    # ---- vectorized operations ----
+    def apply_delta(self, delta, device_ids=None, include_revoked=False):
+        """
+        Add `delta` to the trust of a group of devices (all devices when
+        device_ids is None), clamped to [0, 1]. Revoked devices are left alone
+        unless include_revoked. Returns the number of devices changed.
+        """
+        n = len(self.ids)
+        slots = np.arange(n) if device_ids is None else self.slots_of(device_ids)
+        if not include_revoked:
+            slots = slots[~self.revoked_flags[slots]]
+        self.trust[slots] = np.clip(self.trust[slots] + delta, 0.0, 1.0)
+        self.updated[slots] = time.time()
+        return len(slots)
+
+    def below(self, threshold, include_revoked=False):
+        """Ids of devices whose trust is <= threshold."""
+        n = len(self.ids)
+        mask = self.trust[:n] <= threshold
+        if not include_revoked:
+            mask &= ~self.revoked_flags[:n]
+        return [self.ids[i] for i in np.flatnonzero(mask)]
+
+    def percentiles(self, qs=(1, 5, 25, 50, 75, 95, 99), include_revoked=False):
+        values = self._active_trust(include_revoked)
+        if not len(values):
+            return {}
+        return {f"p{q:g}": float(v) for q, v in zip(qs, np.percentile(values, qs))}
+
+    def histogram(self, bins=10, include_revoked=False):
+        counts, edges = np.histogram(self._active_trust(include_revoked), bins=bins, range=(0.0, 1.0))
+        return {"edges": edges.tolist(), "counts": counts.tolist()}
+
+    def lowest(self, k=10, include_revoked=False):
+        """The k lowest-trust devices, lowest first, as [{"device_id", "trust"}]."""
+        n = len(self.ids)
+        slots = np.arange(n)
+        if not include_revoked:
+            slots = slots[~self.revoked_flags[:n]]
+        if not len(slots):
+            return []
+        k = min(k, len(slots))
+        part = slots[np.argpartition(self.trust[slots], k - 1)[:k]]
+        part = part[np.argsort(self.trust[part], kind="stable")]
+        return [{"device_id": self.ids[i], "trust": float(self.trust[i])} for i in part]
+
+    def stats(self):
+        n = len(self.ids)
+        revoked = int(self.revoked_flags[:n].sum())
+        active = self._active_trust(False)
+        return {
+            "devices": n,
+            "revoked": revoked,
+            "mean_trust": float(active.mean()) if len(active) else None,
+            "alerts": int(self.alerts[:n].sum()),
+            "malicious_alerts": int(self.malicious[:n].sum()),
+        }
+
+    def _active_trust(self, include_revoked):
+        n = len(self.ids)
+        if include_revoked:
+            return self.trust[:n]
+        return self.trust[:n][~self.revoked_flags[:n]]
+
+    # ---- snapshots ----
+    def export(self):
+        """Copy of the table as (ids, {column: array}), safe to write out from another thread."""
+        n = len(self.ids)
+        return list(self.ids), {name: getattr(self, name)[:n].copy() for name in COLUMNS}
+
+    def load(self, ids, columns):
+        """Replace the table's contents with exported ids and columns."""
+        n = len(ids)
+        self.ids = list(ids)
+        self.slots = {device_id: slot for slot, device_id in enumerate(self.ids)}
+        capacity = max(1024, 2 * n)
+        for name, dtype in COLUMNS.items():
+            column = np.zeros(capacity, dtype=dtype)
+            column[:n] = columns[name][:n]
+            setattr(self, name, column)
+
+    # ---- listing ----
+    def rows(self, offset=0, limit=None):
+        """[{"device_id", "trust", "revoked"}] for a range of slots, built column-wise."""
+        n = len(self.ids)
+        end = n if limit is None else min(n, offset + limit)
+        ids = self.ids[offset:end]
+        trust = self.trust[offset:end].tolist()
+        revoked = self.revoked_flags[offset:end].tolist()
+        return [{"device_id": d, "trust": t, "revoked": r} for d, t, r in zip(ids, trust, revoked)]
+
+
+class RevokedView(MutableSet):
+    """Set-like view of the revoked column, standing in for CIDN's old revoked set."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __contains__(self, device_id):
+        slot = self.table.slots.get(device_id)
+        return slot is not None and bool(self.table.revoked_flags[slot])
+
+    def __iter__(self):
+        ids = self.table.ids
+        return iter([ids[i] for i in np.flatnonzero(self.table.revoked_flags[:len(ids)])])
+
+    def __len__(self):
+        return int(self.table.revoked_flags[:len(self.table.ids)].sum())
+
+    def add(self, device_id):
+        slot = self.table.slots.get(device_id)
+        if slot is not None:  # unknown devices have nothing to revoke
+            self.table.revoked_flags[slot] = True
+
+    def discard(self, device_id):
+        slot = self.table.slots.get(device_id)
+        if slot is not None:
+            self.table.revoked_flags[slot] = False